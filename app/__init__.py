@@ -1 +1 @@
-from app.config import logger, AUTHORIZED_USERS, ANTHROPIC_API_KEY, claude, bq_client, PROMPTS_PATH
+from app.config import logger, AUTHORIZED_USERS, ANTHROPIC_API_KEY, get_claude, get_bq_client, get_db, PROMPTS_PATH, MAX_CONCURRENT_QUESTIONS, QUESTION_QUEUE_SIZE, ENQUEUE_TIMEOUT, BQ_MAX_WORKERS, SHUTDOWN_GRACE_SECONDS, DEDUP_BACKEND, DEDUP_TTL_SECONDS, DEDUP_MAX_EVENTS, QUERY_CACHE_MAX_BYTES, QUERY_CACHE_DIR, QUERY_CACHE_DISK_MAX_BYTES, UPLOAD_FORMAT, MAX_BYTES_BILLED, MAX_BYTES_ESTIMATE, BQ_STREAMING, MAX_RESULT_ROWS, INTENT_MODE, ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES, THREAD_STATE_BACKEND, THREAD_STATE_REFRESH_SECONDS, THREAD_STATE_MAX_THREADS, EXECUTION_MODE, LOCAL_EXEC_WORKERS, LOCAL_EXEC_WARM, LOCAL_EXEC_MAX_ROWS, LOCAL_EXEC_MEMORY_MB, LOCAL_EXEC_CPU_SECONDS, LOCAL_EXEC_TIMEOUT, LOCAL_EXEC_MAX_TURNS, LOCAL_EXEC_UID_BASE, WARMUP, STARTED_AT, USER_DAILY_BUDGET_EUR, THREAD_BUDGET_EUR, BUDGET_STEP_DOWN_RATIO, ROLLUP_ENABLED, BATCH_REPORT_CHANNEL, BATCH_REPORT_MODEL, BATCH_POLL_SECONDS, BATCH_INLINE_WAIT_SECONDS, BATCH_STATE_BACKEND, REPORTS_TOKEN, THREAD_HISTORY_TTL, THREAD_HISTORY_MAX_THREADS
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import time
+import weakref
+from collections import OrderedDict
+import pandas as pd
+from app import logger, ANSWER_CACHE_PATH, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_ENTRIES
+from app.model_router import latest_message
+
+
+def normalize_filters(filters: dict) -> str:
+    """
+    JSON canónico de los filtros del LLM: claves ordenadas, valores como lista ordenada de strings.
+    """
+    def normalize_values(vals):
+        if vals is None or vals == "":
+            return []
+        if not isinstance(vals, (list, tuple)):
+            vals = [vals]
+        return sorted(str(v).strip() for v in vals)
+
+    where = {col: normalize_values(vals) for col, vals in (filters.get("filters") or {}).items()}
+    where = {col: vals for col, vals in where.items() if vals}
+    metrics = sorted(filters.get("metrics") or [])
+    return json.dumps({"filters": where, "metrics": metrics}, sort_keys=True)
+
+
+def normalize_question(question: str) -> str:
+    """
+    Último mensaje del hilo sin menciones, en minúsculas y sin puntuación: los mismos datos no implican la misma
+    respuesta ("top 3" vs "bottom 3", "explain why"...).
+    """
+    text = re.sub(r"<[@#!][^>]*>", " ", latest_message(question).lower())
+    return " ".join(re.findall(r"\w+(?:[.,]\w+)*", text))
+
+
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
+    digest = hashlib.sha256("|".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+_fingerprints = {}  # id(df) -> (weakref al DataFrame, huella)
+
+
+async def fingerprint(df: pd.DataFrame) -> str:
+    """
+    dataframe_fingerprint en un thread (hashea el DataFrame entero) y una sola vez por objeto: run_plan, la clave
+    de la answer cache y la subida del dataset la piden para el mismo DataFrame, que no se modifica después.
+    No se guarda en df.attrs: pandas los copia a los DataFrames derivados, con otros datos.
+    """
+    memo = _fingerprints.get(id(df))
+    if memo is not None and memo[0]() is df:
+        return memo[1]
+    digest = await asyncio.to_thread(dataframe_fingerprint, df)
+    key = id(df)
+    _fingerprints[key] = (weakref.ref(df, lambda _, key=key: _fingerprints.pop(key, None)), digest)
+    return digest
+
+
+async def answer_key(filters: dict, df: pd.DataFrame, file_requested: str = "no", question: str = "") -> str:
+    raw = f"{normalize_filters(filters)}\n{await fingerprint(df)}\n{file_requested}\n{normalize_question(question)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Respuestas finales de code execution (texto Slack + ficheros generados) por forma de pregunta y datos.
+    LRU/TTL en memoria con persistencia en SQLite local.
+    """
+    def __init__(self, path: str = ANSWER_CACHE_PATH, ttl: float = ANSWER_CACHE_TTL, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory = OrderedDict()  # key -> (created, entry)
+        self.stats = {"hits": 0, "misses": 0, "stores": 0}
+        self._initialized = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._initialized:
+            conn.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, created REAL, text TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS artifacts (key TEXT, position INTEGER, filename TEXT, content BLOB)")
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_key ON artifacts (key)")
+            self._initialized = True
+        return conn
+
+    def _load(self, key: str):
+        with self._connect() as conn:
+            row = conn.execute("SELECT created, text FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            files = conn.execute("SELECT filename, content FROM artifacts WHERE key = ? ORDER BY position", (key,)).fetchall()
+        return row[0], {"text": row[1], "files": [{"filename": f, "content": c} for f, c in files]}
+
+    def _save(self, key: str, created: float, entry: dict):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO answers (key, created, text) VALUES (?, ?, ?)", (key, created, entry["text"]))
+            conn.executemany("INSERT INTO artifacts (key, position, filename, content) VALUES (?, ?, ?, ?)",
+                             [(key, i, f["filename"], f["content"]) for i, f in enumerate(entry["files"])])
+            expired = [k for (k,) in conn.execute("SELECT key FROM answers WHERE created < ?", (time.time() - self.ttl,))]
+            conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in expired])
+            conn.executemany("DELETE FROM artifacts WHERE key = ?", [(k,) for k in expired])
+
+    def _remember(self, key: str, created: float, entry: dict):
+        self._memory[key] = (created, entry)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, key: str):
+        if not self.enabled:
+            return None
+        cached = self._memory.get(key)
+        if cached is None and self.path:
+            try:
+                cached = await asyncio.to_thread(self._load, key)
+            except Exception as e:
+                logger.error("Answer cache read failed: %s", e)
+        if cached is None or time.time() - cached[0] > self.ttl:
+            self._memory.pop(key, None)
+            self.stats["misses"] += 1
+            return None
+        self._remember(key, *cached)
+        self.stats["hits"] += 1
+        return cached[1]
+
+    async def put(self, key: str, text: str, files: list = None):
+        if not self.enabled:
+            return
+        created = time.time()
+        entry = {"text": text, "files": files or []}
+        self._remember(key, created, entry)
+        self.stats["stores"] += 1
+        if self.path:
+            try:
+                await asyncio.to_thread(self._save, key, created, entry)
+            except Exception as e:
+                logger.error("Answer cache write failed: %s", e)
+
+
+answer_cache = AnswerCache()
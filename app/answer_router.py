@@ -0,0 +1,62 @@
+import pandas as pd
+from app import logger
+from app.llms import call_claude_simple, encode_table, estimate_tokens
+from app.execution_code import run_code_execution
+from app.answer_cache import answer_key
+from app.utils_slack.slack_utils import ProgressiveMessage
+
+FAST_PATH_MAX_ROWS = 100
+FAST_PATH_MAX_COLUMNS = 12
+FAST_PATH_MAX_TOKENS = 6000
+
+
+def choose_answer_path(df: pd.DataFrame, file_requested: str = "no") -> tuple:
+    """
+    Devuelve ("simple" | "code_execution", motivo). Los resultados pequeños se contestan directamente con Haiku.
+    """
+    if file_requested == "yes":
+        return "code_execution", "file requested"
+    rows, columns = df.shape
+    if rows > FAST_PATH_MAX_ROWS or columns > FAST_PATH_MAX_COLUMNS:
+        return "code_execution", f"shape {df.shape}"
+    tokens = estimate_tokens(encode_table(df))
+    if tokens > FAST_PATH_MAX_TOKENS:
+        return "code_execution", f"~{tokens} tokens"
+    return "simple", f"shape {df.shape}, ~{tokens} tokens"
+
+
+def with_notes(text: str, notes: list) -> str:
+    """Añade los avisos sobre los datos (result_notes) al prompt del modelo."""
+    if not notes:
+        return text
+    return text + "\n\nNote about the data: " + " ".join(notes)
+
+
+def notes_for_user(output: str, notes: list) -> str:
+    """Los mismos avisos al final de la respuesta de Slack."""
+    if not notes:
+        return output
+    return output + "\n\n" + "\n".join(f"⚠️ _{note}_" for note in notes)
+
+
+async def answer(user_question: str, df: pd.DataFrame, file_requested: str, channel: str, user: str, threadts: str, filters: dict = None, schema: str = None, notes: list = None, question: str = None) -> str:
+    """
+    notes: avisos sobre los datos (bigQuery.result_notes) que ven tanto el modelo como el usuario.
+    question: pregunta tal como la escribió el usuario, si user_question lleva contexto añadido (clientes
+    detectados...); es la que entra en la clave de la answer cache y la que puntúa el router de modelos.
+    """
+    question = question or user_question
+    if df.empty:
+        return "No data available."
+    path, reason = choose_answer_path(df, file_requested)
+    logger.debug("🛣️ Answer path: %s (%s)", path, reason)
+    prompt = with_notes(user_question, notes)
+    if path == "simple":
+        progress = ProgressiveMessage(channel, threadts)
+        try:
+            return notes_for_user(await call_claude_simple(prompt, df, on_text=progress.on_text, schema=schema, question=question), notes)
+        finally:
+            await progress.close()
+    # Un resultado cortado no se cachea: la siguiente vez puede caber entero
+    cache_key = await answer_key(filters, df, file_requested, question) if filters and not df.attrs.get("truncated") else None
+    return notes_for_user(await run_code_execution(prompt, df, channel, user, threadts, cache_key=cache_key, question=question), notes)
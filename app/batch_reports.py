@@ -0,0 +1,297 @@
+import asyncio
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from app import get_claude, get_db, logger, PROMPTS_PATH, BATCH_REPORT_CHANNEL, BATCH_REPORT_MODEL, BATCH_POLL_SECONDS, BATCH_INLINE_WAIT_SECONDS, BATCH_STATE_BACKEND
+from app.bigQuery import latest_snapshot, plan_query, run_plan, run_query, result_notes
+from app.rollup import valid_snapshot
+from app.clients import TOPLINE_TABLE, TOPLINE_COLUMNS
+from app.profit_and_loss import PNL_TABLE, pnlPlan
+from app.llms import render_prompt, encode_table, record_usage, calculate_tokens_str
+from app.answer_router import with_notes, notes_for_user
+from app.model_router import BATCH_DISCOUNT
+from app.metrics import span
+from app.utils_slack.slack_utils import send_message, update_message
+from app.utils_slack.format_utils import format_for_slack
+
+REPORT_MAX_TOKENS = 1500
+BATCH_RESULTS_DAYS = 29  # la API guarda los resultados 29 días
+CLAIM_TIMEOUT = timedelta(minutes=10)  # una publicación que no terminó en este tiempo se puede retomar
+stats = {"runs": 0, "reports": 0, "succeeded": 0, "errored": 0, "empty": 0, "resumed": 0}
+
+
+def validate_snapshots(data_week: str = None, date_week: str = None):
+    """data_week (YYYY-MM-DD) y date_week (YYYY_WW) llegan del body de /reports/batch y acaban en SQL."""
+    for column, value in (("data_week", data_week), ("date_week", date_week)):
+        if value is not None and not valid_snapshot(column, value):
+            raise ValueError(f"{column} must look like {'YYYY-MM-DD' if column == 'data_week' else 'YYYY_WW'}")
+
+
+class MemoryBatchBackend:
+    """Stand-in local de Firestore (tests / desarrollo)."""
+    def __init__(self):
+        self.docs = {}
+
+    def save(self, batch_id: str, data: dict):
+        self.docs[batch_id] = data
+
+    def pending(self) -> list:
+        return [(k, v) for k, v in self.docs.items() if v["status"] in ("pending", "posting")]
+
+    def claim(self, batch_id: str, now: datetime) -> bool:
+        doc = self.docs.get(batch_id)
+        if doc is None or (doc["status"] == "posting" and doc["claimedAt"] > now - CLAIM_TIMEOUT):
+            return False
+        doc.update(status="posting", claimedAt=now)
+        return True
+
+    def mark_posted(self, batch_id: str, custom_id: str):
+        doc = self.docs.get(batch_id)
+        if doc is not None:
+            doc["reports"][custom_id]["posted"] = True
+
+    def delete(self, batch_id: str):
+        self.docs.pop(batch_id, None)
+
+
+class FirestoreBatchBackend:
+    """Batches enviados y aún sin publicar: cualquier instancia puede retomarlos aunque la que los lanzó ya no exista."""
+    def __init__(self, client_factory, collection: str = "batch-reports"):
+        self.client_factory = client_factory
+        self.collection_name = collection
+
+    @property
+    def collection(self):
+        return self.client_factory().collection(self.collection_name)
+
+    def save(self, batch_id: str, data: dict):
+        self.collection.document(batch_id).set(data)
+
+    def pending(self) -> list:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        query = self.collection.where(filter=FieldFilter("status", "in", ["pending", "posting"]))
+        return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def claim(self, batch_id: str, now: datetime) -> bool:
+        """Transacción: solo una instancia publica los informes de un batch."""
+        from google.cloud import firestore
+        ref = self.collection.document(batch_id)
+
+        @firestore.transactional
+        def take(transaction) -> bool:
+            snapshot = ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            doc = snapshot.to_dict()
+            if doc["status"] == "posting" and doc["claimedAt"] > now - CLAIM_TIMEOUT:
+                return False
+            transaction.update(ref, {"status": "posting", "claimedAt": now})
+            return True
+
+        return take(self.client_factory().transaction())
+
+    def mark_posted(self, batch_id: str, custom_id: str):
+        """Cada informe publicado se apunta: si la instancia cae a mitad, quien retome no lo repite."""
+        from google.cloud.firestore_v1.field_path import FieldPath
+        self.collection.document(batch_id).update({FieldPath("reports", custom_id, "posted").to_api_repr(): True})
+
+    def delete(self, batch_id: str):
+        self.collection.document(batch_id).delete()
+
+
+def build_batch_backend(backend_name: str = BATCH_STATE_BACKEND):
+    if backend_name == "firestore":
+        return FirestoreBatchBackend(get_db)
+    return MemoryBatchBackend()
+
+
+batch_backend = build_batch_backend()
+
+
+def pnl_report(country: str, date_week: str) -> dict:
+    return {
+        "kind": "pnl_country", "key": country, "table": PNL_TABLE,
+        "title": f"P&L {country} ({date_week})",
+        "question": f"Weekly P&L summary for country {country}: main items by month, EBITDA trend and anything unusual.",
+        "filters": {"filters": {"country": [country], "date_week": [date_week]}, "metrics": ["country", "year", "month", "item", "amount"]},
+    }
+
+
+def topline_report(am: str, data_week: str) -> dict:
+    return {
+        "kind": "topline_am", "key": am, "table": TOPLINE_TABLE,
+        "title": f"Topline {am} ({data_week})",
+        "question": f"Weekly topline summary for account manager {am}: revenue, gross profit and gross margin by country and month, trend and anything unusual.",
+        "filters": {"filters": {"am_name_l3": [am], "data_week": [data_week]}, "metrics": ["am_name_l3", "country", "month", "revenue", "gross_profit"]},
+    }
+
+
+async def distinct_values(table: str, column: str, snapshot_column: str, snapshot: str) -> list:
+    if not valid_snapshot(snapshot_column, snapshot):
+        raise ValueError(f"invalid {snapshot_column} snapshot {snapshot!r}")
+    df = await run_query(f"SELECT DISTINCT {column} FROM `{table}` WHERE {snapshot_column} = '{snapshot}' AND {column} IS NOT NULL")
+    return sorted(df[column].astype(str).tolist()) if not df.empty else []
+
+
+async def build_reports(data_week: str = None, date_week: str = None) -> list:
+    """Un informe de P&L por país y uno de topline por account manager del snapshot pedido (por defecto el último)."""
+    validate_snapshots(data_week, date_week)
+    data_week = data_week or await latest_snapshot(TOPLINE_TABLE)
+    date_week = date_week or await latest_snapshot(PNL_TABLE)
+    countries, ams = await asyncio.gather(
+        distinct_values(PNL_TABLE, "country", "date_week", date_week),
+        distinct_values(TOPLINE_TABLE, "am_name_l3", "data_week", data_week),
+    )
+    return [pnl_report(c, date_week) for c in countries] + [topline_report(am, data_week) for am in ams]
+
+
+async def load_report_data(report: dict):
+    """
+    Mismo camino que una pregunta: plan (pnlPlan / plan_query sobre build_query) y run_plan.
+    Devuelve (df, avisos sobre los datos) o (None, []) si la query se rechaza.
+    """
+    if report["table"] == PNL_TABLE:
+        plan, message = await pnlPlan(report["question"], report["filters"])
+    else:
+        plan = await plan_query(report["filters"], TOPLINE_TABLE, TOPLINE_COLUMNS)
+        message = "query rejected" if plan["decision"] == "rejected" else None
+    if plan is None or plan["decision"] == "rejected":
+        logger.warning("Report %s skipped: %s", report["title"], message)
+        return None, []
+    df = await run_plan(plan, report["table"])
+    return df, result_notes(df, plan)
+
+
+def batch_request(custom_id: str, report: dict, df, model: str, notes: list = None) -> dict:
+    prompt = render_prompt(PROMPTS_PATH + "batch_report.txt", report=with_notes(report["question"], notes),
+                           data=encode_table(df))
+    return {
+        "custom_id": custom_id,
+        "params": {"model": model, "max_tokens": REPORT_MAX_TOKENS, "messages": [{"role": "user", "content": prompt}]},
+    }
+
+
+def custom_id_for(index: int, report: dict) -> str:
+    # custom_id: ^[a-zA-Z0-9_-]{1,64}$
+    return f"{index:03d}-{report['kind']}-{re.sub(r'[^A-Za-z0-9_-]', '_', report['key'])}"[:64]
+
+
+async def wait_for_batch(batch_id: str, poll_seconds: float = BATCH_POLL_SECONDS, max_wait: float = BATCH_INLINE_WAIT_SECONDS):
+    """El batch terminado, o None si sigue en curso tras `max_wait` (lo retoma /reports/batch/resume)."""
+    started = time.monotonic()
+    while True:
+        batch = await get_claude().messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            return batch
+        if time.monotonic() - started > max_wait:
+            return None
+        await asyncio.sleep(poll_seconds)
+
+
+async def batch_results(batch_id: str) -> dict:
+    results = {}
+    async for entry in await get_claude().messages.batches.results(batch_id):
+        results[entry.custom_id] = entry.result
+    return results
+
+
+def report_text(report: dict, result) -> str:
+    if result is None or result.type != "succeeded":
+        error = getattr(getattr(result, "error", None), "error", None) or getattr(result, "type", "missing")
+        return f"*{report['title']}*\n⚠️ Report could not be generated ({error})."
+    message = result.message
+    record_usage(message, "batch_report", discount=BATCH_DISCOUNT)
+    text = "".join(block.text for block in message.content if getattr(block, "type", None) == "text")
+    text = notes_for_user(text, report.get("notes"))
+    return format_for_slack(f"*{report['title']}*\n{text}" + calculate_tokens_str(message, discount=BATCH_DISCOUNT))
+
+
+async def run_batch_reports(channel: str = BATCH_REPORT_CHANNEL, data_week: str = None, date_week: str = None,
+                            model: str = BATCH_REPORT_MODEL, poll_seconds: float = BATCH_POLL_SECONDS,
+                            max_wait: float = BATCH_INLINE_WAIT_SECONDS) -> dict:
+    """
+    Informes semanales en modo batch: todas las queries del snapshot a la vez, todos los prompts en un único
+    Message Batch (mitad de precio, sin ocupar los workers interactivos) y cada informe como respuesta
+    en un hilo de Slack cuando termina el batch. El batch queda guardado: si no termina en `max_wait`
+    (o la instancia se para), lo publica quien llame a resume_batches.
+    """
+    if not channel:
+        raise ValueError("BATCH_REPORT_CHANNEL is not configured")
+    stats["runs"] += 1
+    with span("batch_reports.queries") as record:
+        reports = await build_reports(data_week, date_week)
+        datasets = await asyncio.gather(*(load_report_data(report) for report in reports))
+        record["reports"] = len(reports)
+    requests, pending = [], {}
+    for index, (report, (df, notes)) in enumerate(zip(reports, datasets)):
+        if df is None or df.empty:
+            stats["empty"] += 1
+            continue
+        custom_id = custom_id_for(index, report)
+        requests.append(batch_request(custom_id, report, df, model, notes))
+        pending[custom_id] = {"title": report["title"], "notes": notes}
+    if not requests:
+        logger.warning("📊 No data for any batch report")
+        return {"batch_id": None, "reports": 0}
+
+    parent_ts = await send_message(channel, f"📊 Weekly reports: {len(requests)} reports are being generated...")
+    batch = await get_claude().messages.batches.create(requests=requests)
+    now = datetime.now(timezone.utc)
+    job = {"status": "pending", "channel": channel, "parent_ts": parent_ts, "reports": pending,
+           "created": now, "claimedAt": now, "expireAt": now + timedelta(days=BATCH_RESULTS_DAYS)}
+    await asyncio.to_thread(batch_backend.save, batch.id, job)
+    stats["reports"] += len(requests)
+    logger.info("📊 Batch %s submitted: %s reports", batch.id, len(requests))
+
+    with span("batch_reports.wait", batch_id=batch.id):
+        ended = await wait_for_batch(batch.id, poll_seconds, max_wait)
+    if ended is None:
+        logger.info("📊 Batch %s still running after %.0fs, left for /reports/batch/resume", batch.id, max_wait)
+        return {"batch_id": batch.id, "reports": len(pending), "status": "pending"}
+    return await finish_batch(batch.id, job)
+
+
+async def finish_batch(batch_id: str, job: dict) -> dict:
+    """
+    Publica los informes de un batch terminado. La reclamación evita que dos instancias los publiquen a la vez
+    y los ya publicados (posted) se saltan al retomar un batch que se quedó a medias.
+    """
+    if not await asyncio.to_thread(batch_backend.claim, batch_id, datetime.now(timezone.utc)):
+        return {"batch_id": batch_id, "status": "claimed elsewhere"}
+    channel, parent_ts, pending = job["channel"], job.get("parent_ts"), job["reports"]
+    results = await batch_results(batch_id)
+    succeeded = 0
+    for custom_id, report in sorted(pending.items()):
+        result = results.get(custom_id)
+        ok = result is not None and result.type == "succeeded"
+        succeeded += ok
+        if report.get("posted"):
+            continue
+        await send_message(channel, report_text(report, result), thread_ts=parent_ts)
+        await asyncio.to_thread(batch_backend.mark_posted, batch_id, custom_id)
+        stats["succeeded" if ok else "errored"] += 1
+    if parent_ts:
+        await update_message(channel, parent_ts, f"📊 Weekly reports: {succeeded}/{len(pending)} ready in this thread 🧵")
+    await asyncio.to_thread(batch_backend.delete, batch_id)
+    logger.info("📊 Batch %s done: %s/%s reports posted", batch_id, succeeded, len(pending))
+    return {"batch_id": batch_id, "reports": len(pending), "succeeded": succeeded}
+
+
+async def resume_batches() -> list:
+    """
+    Cloud Scheduler (cada pocos minutos): publica los batches guardados que ya han terminado. Así un batch de
+    horas no depende de que siga viva la instancia que lo lanzó.
+    """
+    jobs = await asyncio.to_thread(batch_backend.pending)
+    done = []
+    for batch_id, job in jobs:
+        if job["expireAt"] < datetime.now(timezone.utc):
+            logger.warning("📊 Batch %s results expired before being posted", batch_id)
+            await asyncio.to_thread(batch_backend.delete, batch_id)
+            continue
+        batch = await get_claude().messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            continue
+        stats["resumed"] += 1
+        done.append(await finish_batch(batch_id, job))
+    return done
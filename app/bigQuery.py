@@ -1,5 +1,39 @@
+import asyncio
+import resource
+import time
 import pandas as pd
-from app import logger, bq_client
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import bigquery
+from app import logger, get_bq_client, BQ_MAX_WORKERS, MAX_BYTES_BILLED, MAX_BYTES_ESTIMATE, BQ_STREAMING, MAX_RESULT_ROWS
+from app.query_cache import query_cache, cache_key, table_from_sql, normalize_sql
+from app.answer_cache import fingerprint
+from app.thread_state import current_thread_state
+from app.metrics import timed, span, annotate, record_bytes_processed
+from app.rollup import RollupStore
+from app.singleflight import SingleFlight, flight_key
+
+BQ_POLL_SECONDS = 0.5
+bq_executor = ThreadPoolExecutor(max_workers=BQ_MAX_WORKERS, thread_name_prefix="bq")
+query_flight = SingleFlight("run_query")
+
+# Columna que identifica la carga semanal de cada tabla
+SNAPSHOT_COLUMNS = {
+    "jt-prd-financial-pa.random_data.real_data": "data_week",
+    "jt-prd-financial-pa.random_data.pnl_data": "date_week",
+}
+SNAPSHOT_CHECK_SECONDS = 300
+_snapshots = {}  # table -> (snapshot, checked_at)
+
+# Dimensiones que se quitan del GROUP BY (de más a menos fina) cuando la query es demasiado cara
+COARSEN_ORDER = ["sfdc_name_l3", "am_name_l3", "subsidiary", "cohort", "customer_type", "service_type_l3", "data_type", "item", "month"]
+# Nombre para el usuario de las dimensiones que se pueden quitar (aviso de result_notes)
+DIMENSION_LABELS = {"sfdc_name_l3": "client", "am_name_l3": "account manager", "service_type_l3": "service type",
+                    "customer_type": "customer type", "data_type": "data type"}
+_estimates = {}  # cache_key -> bytes estimados por el dry run
+CATEGORY_MAX_RATIO = 0.5  # columnas de texto con menos valores únicos que esto (por fila) pasan a category
+_storage_client = None
 
 
 def build_query(filters: str, table: str, allowed_columns: list) -> str:
@@ -44,12 +78,262 @@ def build_query(filters: str, table: str, allowed_columns: list) -> str:
 
 
 
-def run_query(sql: str):
+@timed("run_query")
+async def run_query(sql: str, use_cache: bool = True, streaming: bool = BQ_STREAMING):
     #max_tries = 3
     #current_tries = 0
+    # Solo se cachean tablas con snapshot conocido: una nueva carga semanal cambia la clave
+    key = None
+    table = table_from_sql(sql)
+    if use_cache and table in SNAPSHOT_COLUMNS:
+        snapshot = await latest_snapshot(table)
+        if snapshot is not None:
+            key = cache_key(sql, snapshot)
+            cached = await query_cache.get(key)
+            if cached is not None:
+                logger.debug("⚡ Query cache hit (%s)", key[:12])
+                annotate(cache="hit", rows=len(cached))
+                return cached
     try:
-        query_job = bq_client.query(sql)
-        return query_job.to_dataframe()
+        # La misma SQL ya en marcha (preguntas repetidas en el canal) se espera en vez de relanzarla
+        df = await query_flight.do(flight_key(normalize_sql(sql), streaming), fetch_query, sql, key, streaming)
     except Exception as e:
         logger.debug("Error ejecutando query.")
+        annotate(error=str(e)[:200])
         return pd.DataFrame()
+    annotate(rows=len(df))
+    return df
+
+
+async def fetch_query(sql: str, key: str = None, streaming: bool = BQ_STREAMING) -> pd.DataFrame:
+    df = await execute_query(sql, streaming=streaming)
+    if key is not None and not df.attrs.get("truncated"):
+        await query_cache.put(key, df)
+    return df
+
+
+async def execute_query(sql: str, streaming: bool = BQ_STREAMING, compact: bool = True) -> pd.DataFrame:
+    # El cliente de BigQuery es síncrono: cada llamada bloqueante va al pool acotado
+    # y la espera del job se hace con sleep asíncrono, sin ocupar un thread.
+    # compact=False: tipos tal cual los da Arrow (el cubo del rollup hace su propia codificación).
+    loop = asyncio.get_running_loop()
+    job_config = bigquery.QueryJobConfig(maximum_bytes_billed=MAX_BYTES_BILLED)
+    query_job = await loop.run_in_executor(bq_executor, lambda: get_bq_client().query(sql, job_config=job_config))
+    while query_job.state != "DONE":
+        await asyncio.sleep(BQ_POLL_SECONDS)
+        await loop.run_in_executor(bq_executor, query_job.reload)
+    record_bytes_processed(query_job.total_bytes_processed)
+    if streaming:
+        return await loop.run_in_executor(bq_executor, read_arrow_results, query_job, compact)
+    return await loop.run_in_executor(bq_executor, query_job.to_dataframe)
+
+
+def storage_client():
+    global _storage_client
+    if _storage_client is None:
+        try:
+            from google.cloud import bigquery_storage
+            _storage_client = bigquery_storage.BigQueryReadClient()
+        except ImportError:
+            logger.warning("google-cloud-bigquery-storage not installed, streaming results over REST")
+            _storage_client = False
+    return _storage_client or None
+
+
+def read_arrow_results(query_job, compact: bool = True) -> pd.DataFrame:
+    """
+    Lee el resultado como record batches de Arrow (Storage Read API), corta en MAX_RESULT_ROWS
+    y convierte a un DataFrame compacto. Loguea la memoria pico estimada de la query.
+    Si se corta, el DataFrame lleva attrs["truncated"]: no se cachea y la respuesta lo avisa (result_notes).
+    """
+    rows = query_job.result()
+    batches, total_rows, truncated = [], 0, False
+    for batch in rows.to_arrow_iterable(bqstorage_client=storage_client()):
+        if total_rows + batch.num_rows > MAX_RESULT_ROWS:
+            batch = batch.slice(0, MAX_RESULT_ROWS - total_rows)
+            truncated = True
+        batches.append(batch)
+        total_rows += batch.num_rows
+        if truncated:
+            break
+    if not batches:
+        return query_job.to_dataframe()
+    table = pa.Table.from_batches(batches)
+    arrow_bytes = table.nbytes
+    df = compact_dataframe(arrow_to_pandas(table)) if compact else table.to_pandas(self_destruct=True)
+    df_bytes = int(df.memory_usage(deep=True).sum())
+    logger.info("📦 Query result: %s rows%s, arrow %.1f MB, dataframe %.1f MB, peak ~%.1f MB (process max RSS %.0f MB)",
+                total_rows, " (truncated)" if truncated else "", arrow_bytes / 1024 ** 2, df_bytes / 1024 ** 2,
+                (arrow_bytes + df_bytes) / 1024 ** 2, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    if truncated:
+        logger.warning("⚠️ Result truncated to MAX_RESULT_ROWS=%s", MAX_RESULT_ROWS)
+        df.attrs["truncated"] = True
+    return df
+
+
+def arrow_to_pandas(table: pa.Table) -> pd.DataFrame:
+    # Las dimensiones de texto repetidas se codifican como diccionario en Arrow y llegan a pandas como category
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_string(column.type) and table.num_rows:
+            distinct = pc.count_distinct(column, mode="all").as_py()
+            if distinct <= max(1, table.num_rows * CATEGORY_MAX_RATIO):
+                column = column.dictionary_encode()
+        columns.append(column)
+    table = pa.Table.from_arrays(columns, names=table.column_names)
+    return table.to_pandas(self_destruct=True, split_blocks=True)
+
+
+def compact_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    # Solo enteros (las dimensiones de texto ya llegan como category). Los importes (revenue, gross_profit,
+    # amount) se quedan en float64: en float32 las sumas de miles de filas se desvían en euros
+    for col in df.columns:
+        if pd.api.types.is_integer_dtype(df[col]) and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    return df
+
+
+async def latest_snapshot(table: str):
+    """
+    Último data_week/date_week cargado en la tabla. Se consulta como mucho cada SNAPSHOT_CHECK_SECONDS.
+    """
+    column = SNAPSHOT_COLUMNS.get(table)
+    if column is None:
+        return None
+    cached = _snapshots.get(table)
+    if cached and time.monotonic() - cached[1] < SNAPSHOT_CHECK_SECONDS:
+        return cached[0]
+    df = await run_query(f"SELECT MAX({column}) AS snapshot FROM `{table}`", use_cache=False)
+    if df.empty:
+        # Si falla la consulta mantenemos el último valor conocido
+        return cached[0] if cached else None
+    snapshot = str(df["snapshot"].iloc[0])
+    _snapshots[table] = (snapshot, time.monotonic())
+    return snapshot
+
+
+
+async def dry_run(sql: str) -> int:
+    loop = asyncio.get_running_loop()
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    query_job = await loop.run_in_executor(bq_executor, lambda: get_bq_client().query(sql, job_config=job_config))
+    return int(query_job.total_bytes_processed or 0)
+
+
+async def ensure_snapshot_filter(filters: dict, table: str) -> dict:
+    """
+    Sin filtro de semana la query recorre todas las cargas semanales: se fija la última.
+    """
+    filters = {**filters, "filters": dict(filters.get("filters") or {})}
+    where = filters["filters"]
+    column = SNAPSHOT_COLUMNS.get(table)
+    # week_label (w-0, w-1...) también identifica la carga en real_data
+    if column is None or where.get(column) or where.get("week_label"):
+        return filters
+    snapshot = await latest_snapshot(table)
+    if snapshot:
+        where[column] = [snapshot]
+        logger.info("🛡️ No snapshot filter, restricting %s to %s %s", table, column, snapshot)
+    return filters
+
+
+async def estimate_bytes(sql: str, table: str):
+    key = None
+    snapshot = await latest_snapshot(table) if table in SNAPSHOT_COLUMNS else None
+    if snapshot is not None:
+        key = cache_key(sql, snapshot)
+        if key in _estimates:
+            return _estimates[key]
+    try:
+        estimate = await dry_run(sql)
+    except Exception as e:
+        logger.error("Dry run failed: %s", e)
+        return None
+    if key is not None:
+        if len(_estimates) > 1000:
+            _estimates.clear()
+        _estimates[key] = estimate
+    return estimate
+
+
+async def plan_query(filters: dict, table: str, allowed_columns: list) -> dict:
+    """
+    Construye la SQL con filtro de snapshot y la estima con un dry run. Si supera MAX_BYTES_ESTIMATE
+    quita dimensiones del GROUP BY que no se usan en filtros (menos columnas leídas = menos bytes).
+    decision: ok | coarsened | rejected. Las dimensiones quitadas (dropped) se avisan con result_notes.
+    """
+    filters = await ensure_snapshot_filter(filters, table)
+    metrics = list(filters.get("metrics") or [])
+    sql = build_query(filters, table, allowed_columns)
+    if await rollup_store.serves(table, filters):
+        # Se contesta desde el cubo en memoria: no hace falta dry run
+        logger.info("💰 Query plan for %s: ok, served from rollup", table)
+        return {"sql": sql, "decision": "ok", "bytes_estimate": 0, "dropped": [], "filters": filters, "source": "rollup"}
+    estimate = await estimate_bytes(sql, table)
+    dropped = []
+    filtered = set((filters.get("filters") or {}).keys())
+    for dim in COARSEN_ORDER:
+        if estimate is None or estimate <= MAX_BYTES_ESTIMATE:
+            break
+        dims_left = [m for m in metrics if m not in ("revenue", "gross_profit", "amount")]
+        if dim not in metrics or dim in filtered or len(dims_left) <= 1:
+            continue
+        metrics.remove(dim)
+        dropped.append(dim)
+        sql = build_query({**filters, "metrics": metrics}, table, allowed_columns)
+        estimate = await estimate_bytes(sql, table)
+
+    if estimate is not None and estimate > MAX_BYTES_BILLED:
+        decision = "rejected"
+    elif dropped:
+        decision = "coarsened"
+    else:
+        decision = "ok"
+    estimate_mb = round(estimate / 1024 ** 2, 1) if estimate is not None else None
+    logger.info("💰 Query plan for %s: %s, estimate %s MB, dropped dims %s", table, decision, estimate_mb, dropped)
+    return {"sql": sql, "decision": decision, "bytes_estimate": estimate, "dropped": dropped, "filters": {**filters, "metrics": metrics}}
+
+
+
+async def run_plan(plan: dict, table: str) -> pd.DataFrame:
+    """
+    Ejecuta un plan de plan_query. En un follow-up del mismo hilo reutiliza la query anterior si sirve.
+    """
+    sql, filters = plan["sql"], plan["filters"]
+    state = current_thread_state()
+    previous_sql = state.reusable_query(table, plan["filters"]) if state else None
+    if previous_sql:
+        # Follow-up sobre los mismos datos: se reutiliza el dataset anterior (y su fichero ya subido)
+        logger.debug("♻️ Follow-up reuses previous dataset")
+        sql, filters = previous_sql, state.last_query["filters"]
+    logger.debug(f"SQL generated:\n{sql}")
+    with span("rollup_query") as record:
+        df = await rollup_store.query(table, filters)
+        record["hit"] = df is not None
+    if df is None:
+        df = await run_query(sql)
+    logger.debug("Shape: %s", df.shape)
+    if state and not df.empty and not previous_sql:
+        state.record_query(table, plan["filters"], sql, await fingerprint(df))
+    return df
+
+
+def result_notes(df: pd.DataFrame, plan: dict = None) -> list:
+    """Avisos sobre los datos que deben llegar al modelo y al usuario (dimensiones quitadas, resultado incompleto)."""
+    notes = []
+    dropped = (plan or {}).get("dropped")
+    if dropped:
+        labels = ", ".join(DIMENSION_LABELS.get(dim, dim) for dim in dropped)
+        notes.append(f"To keep the query within the cost limit the data is not broken down by {labels}: "
+                     "figures by those dimensions are not available, narrow the filters to get them.")
+    if df.attrs.get("truncated"):
+        notes.append(f"The query returned more than {MAX_RESULT_ROWS:,} rows and only the first {MAX_RESULT_ROWS:,} "
+                     "were loaded, so totals computed from this data are incomplete.")
+    return notes
+
+
+async def rollup_query(sql: str) -> pd.DataFrame:
+    return await execute_query(sql, compact=False)
+
+
+rollup_store = RollupStore(latest_snapshot, rollup_query)
@@ -1,85 +1,87 @@
-from rapidfuzz import fuzz, process
 import json
-from app.execution_code import run_code_execution
+from app.answer_router import answer
 from app import PROMPTS_PATH, logger
-from app.llms import call_claude_with_prompt, load_prompt
-from app.bigQuery import run_query, build_query
+from app.llms import call_claude_with_prompt, render_prompt
+from app.bigQuery import run_plan, plan_query, result_notes
+from app.customer_index import CustomerIndex, get_customer_index
+from app.intent import prefetched_filters
 
 
-def clientLogic(first_response, user_question: str, channel:str, user:str, threadts: str) -> str:
+TOPLINE_TABLE = "jt-prd-financial-pa.random_data.real_data"
+TOPLINE_COLUMNS = [
+    "data_week", "week_label", "sfdc_name_l3", "am_name_l3", "country",
+    "service_type_l3", "month", "customer_type", "cohort", "data_type"
+]
+# Descripción de las columnas para los prompts que contestan con los datos (answer / call_claude_simple)
+TOPLINE_SCHEMA = """Source table: detailed topline (revenue and gross profit by account)
+- data_week (DATE 'YYYY-MM-DD'): snapshot week (always a Monday)
+- week_label: w-0 (latest load), w-1 (previous load)...
+- sfdc_name_l3: account (client) name
+- am_name_l3: account manager name
+- month (DATE): first day of the month
+- country (BE, CO, DE, ES, FR, NO, PT, SE, UK, US)
+- service_type_l3: Staffing or Outsourcing
+- customer_type: Existing Business, New Business, pipeline Existing Business, pipeline New Business
+- cohort: year the client was signed
+- data_type: actuals, forecast, pipeline
+- revenue, gross_profit (euros); gross margin = gross_profit / revenue"""
+
+
+async def clientLogic(first_response, user_question: str, channel:str, user:str, threadts: str) -> str:
+    # toplinePlan añade los clientes detectados a la pregunta: la original se conserva para la answer cache
+    plan, prompt = await toplinePlan(first_response, user_question)
+    if plan is None:
+        return prompt
+    df = await run_plan(plan, TOPLINE_TABLE)
+    output = await answer(prompt, df, first_response.get("file_requested", "no"), channel, user, threadts, plan["filters"], schema=TOPLINE_SCHEMA, notes=result_notes(df, plan), question=user_question)
+    return output
+
+async def toplinePlan(first_response, user_question: str):
+    """
+    Matching de clientes + filtros + plan de la query de topline. Devuelve (plan, pregunta) o (None, respuesta al usuario).
+    """
     mentioned = first_response["clients_mentioned"] or []
-    proceed, user_question = clientSimilar(mentioned, user_question)
+    proceed, user_question, exact_customers = await clientSimilar(mentioned, user_question)
     if (proceed == "no"):
-        return user_question
-    filters_json = call_claude_with_prompt(load_prompt(PROMPTS_PATH + "query_filters.txt", user_input=user_question))
+        return None, user_question
+    filters_json = await prefetched_filters(first_response, "topline_query")
+    if filters_json is None:
+        filters_json = await call_claude_with_prompt(render_prompt(PROMPTS_PATH + "query_filters.txt", user_input=user_question))
+    elif exact_customers:
+        # Los filtros se generaron antes del matching: se sustituyen los nombres por los clientes exactos
+        filters_json["filters"] = {**filters_json.get("filters", {}), "sfdc_name_l3": exact_customers}
     logger.debug("🧠 Filters created: %s",json.dumps(filters_json))
-    allowed_columns = [
-        "data_week", "week_label", "sfdc_name_l3", "am_name_l3", "country",
-        "service_type_l3", "month", "customer_type", "cohort", "data_type"
-    ]
-    sql = build_query(filters_json, "jt-prd-financial-pa.random_data.real_data", allowed_columns)
-    logger.debug(f"SQL generated:\n{sql}")
-    df = run_query(sql)
-    logger.debug("Shape:", df.shape)
-    output = run_code_execution(user_question, df, channel, user, threadts)
-    return output
+    plan = await plan_query(filters_json, TOPLINE_TABLE, TOPLINE_COLUMNS)
+    if plan["decision"] == "rejected":
+        return None, "⚠️ That question would scan too much data. Could you narrow it down (period, country, client...)?"
+    return plan, user_question
 
-def clientSimilar(mentioned, user_question):
-    df_clients = get_customer_list()
-    all_clients = df_clients["sfdc_name_l3"].dropna().astype(str).tolist()
+async def clientSimilar(mentioned, user_question):
     if mentioned:
-        matched = match_customers(mentioned, all_clients, top_n=10)
+        index = await get_customer_index()
+        matched = match_customers(mentioned, index, top_n=10)
         logger.debug("🔍 Matching result: %s", json.dumps(matched))
         if matched["case"] == "direct_match":
             logger.debug("Found exact customers.")
             customer_string = ", ".join(matched["exact"])
             user_question += f"\n\nThese are the exact customers detected with an internal function based on the thread: {customer_string}"
-            return "yes", user_question
+            return "yes", user_question, matched["exact"]
         elif matched["case"] == "ambiguous_match":
             candidates = ", ".join(matched["candidates"])
             logger.debug("Found similar customers.")
-            return "no", f"❓ I couldn’t find exact matches for those clients. Did you mean one of these?\n{candidates}"
+            return "no", f"❓ I couldn’t find exact matches for those clients. Did you mean one of these?\n{candidates}", []
         elif matched["case"] == "not_found":
             logger.debug("No customer found.")
-            return "no","❌ I couldn’t find any customers matching that name. Could you rephrase or check the spelling?"
+            return "no","❌ I couldn’t find any customers matching that name. Could you rephrase or check the spelling?", []
     else:
         logger.debug("No clients mentioned.")
-        return "yes", user_question
-
-
+        return "yes", user_question, []
 
-def get_customer_list():
-    sql = """
-    SELECT DISTINCT sfdc_name_l3
-    FROM `jt-prd-financial-pa.random_data.real_data`
-    WHERE sfdc_name_l3 IS NOT NULL
-    """
 
-    df = run_query(sql)
-    logger.debug("Succesfull customer list.")
-    return df
 
-def match_customers(mentioned_clients: list, all_customers: list, top_n: int = 10):
+def match_customers(mentioned_clients: list, index: CustomerIndex, top_n: int = 10):
     try:
-        exact_matches = set()
-        fuzzy_candidates = set()
-
-        for name in mentioned_clients:
-            results = process.extract(name, all_customers, scorer=fuzz.token_sort_ratio, limit=top_n)
-            for match_name, score, _ in results:
-                if score >= 85:
-                    logger.debug("%s - score: %s", match_name, score)
-                    exact_matches.add(match_name)
-                elif 55 <= score < 85:
-                    logger.debug("%s - score: %s", match_name, score)
-                    fuzzy_candidates.add(match_name)
-
-        if exact_matches:
-            return {"case": "direct_match", "exact": list(exact_matches), "candidates": []}
-        elif fuzzy_candidates:
-            return {"case": "ambiguous_match", "exact": [], "candidates": list(fuzzy_candidates)}
-        else:
-            return {"case": "not_found", "exact": [], "candidates": []}
+        return index.match(mentioned_clients, top_n=top_n)
     except Exception as e:
         logger.error("Error en match customers")
         raise e
\ No newline at end of file
@@ -1,10 +1,10 @@
+import time
+STARTED_AT = time.perf_counter()  # inicio de la importación del paquete (informe de cold start)
 import logging
 import sys
-import anthropic
 import os
+import threading
 from dotenv import load_dotenv
-from google.cloud import bigquery, firestore
-from datetime import datetime, timedelta, timezone
 
 
 load_dotenv()
@@ -40,31 +40,115 @@ for noisy_logger in [
 
 
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-PROMPTS_PATH = "/app/app/prompts/"
-claude = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+PROMPTS_PATH = os.getenv("PROMPTS_PATH", "/app/app/prompts/")
 AUTHORIZED_USERS = ["U06BW8J6MRU", "U031RNA3J86", "U01BECSBLJ1", "U02CYBAR4JY", "U0CGEEKJT"] #miguel, gon, gato, dani, Juan
-bq_client = bigquery.Client()
-db = firestore.Client()
-
-
-class Thread:
-    def __init__(self, event: dict):
-        thread_id = event.get("thread_ts") or event.get("ts")
-        self.ref = db.collections("slack-bot").document(thread_id)
-        doc = self.ref.get()
-        if doc.exists:
-            data = doc.to_dict()
-            self.user_id = data.get("user_id")
-            self.thread_id = data.get("thread_id")
-            self.channel_id = data.get("channel_id")
-            self.messages = data.get("messages",[])
-            self.messages.append(event.get("text"))
-            self.claude_file_ids = data.get("file_ids", [])
-            self.expireAt = data.get("expireAt")
-        else:
-            self.user_id = event.get("user")
-            self.channel_id = event.get("channel")
-            self.messages = [event.get("text")]
-            self.thread_id = thread_id
-            self.claude_file_ids = []
-            self.expireAt = datetime.now(timezone.utc) + timedelta(days=7)
+
+# === CLIENTES ===
+# Se crean en el primer uso (o en el warm-up tras arrancar) y se reutilizan: importar app no abre conexiones
+# ni carga los SDKs, así uvicorn puede contestar a Slack cuanto antes en un cold start.
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _client(name: str, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                started = time.perf_counter()
+                client = factory()
+                _clients[name] = client
+                logger.info("🔌 %s client ready in %.0f ms", name, (time.perf_counter() - started) * 1000)
+    return client
+
+
+def get_claude():
+    def build():
+        import anthropic
+        return anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+    return _client("anthropic", build)
+
+
+def get_bq_client():
+    def build():
+        from google.cloud import bigquery
+        return bigquery.Client()
+    return _client("bigquery", build)
+
+
+def get_db():
+    def build():
+        from google.cloud import firestore
+        return firestore.Client()
+    return _client("firestore", build)
+
+# === ARRANQUE ===
+WARMUP = os.getenv("WARMUP", "1") == "1"  # pre-abre clientes y conexiones en segundo plano tras arrancar
+
+# === CONCURRENCIA ===
+MAX_CONCURRENT_QUESTIONS = int(os.getenv("MAX_CONCURRENT_QUESTIONS", "32"))  # workers del pool
+QUESTION_QUEUE_SIZE = int(os.getenv("QUESTION_QUEUE_SIZE", "100"))  # eventos en espera antes de aplicar backpressure
+ENQUEUE_TIMEOUT = float(os.getenv("ENQUEUE_TIMEOUT", "1.5"))  # segundos, por debajo del ack de 3s de Slack
+BQ_MAX_WORKERS = int(os.getenv("BQ_MAX_WORKERS", "8"))  # threads para llamadas bloqueantes de BigQuery
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "8"))  # Cloud Run da 10s entre SIGTERM y SIGKILL
+
+# === DEDUPLICACION DE EVENTOS ===
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "firestore")  # firestore | memory-shared | memory
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", "3600"))
+DEDUP_MAX_EVENTS = int(os.getenv("DEDUP_MAX_EVENTS", "10000"))
+
+# === CACHE DE QUERIES ===
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+QUERY_CACHE_DIR = os.getenv("QUERY_CACHE_DIR", "/tmp/query_cache")  # vacío desactiva el nivel de disco
+QUERY_CACHE_DISK_MAX_BYTES = int(os.getenv("QUERY_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# === COSTE DE QUERIES ===
+MAX_BYTES_BILLED = int(os.getenv("MAX_BYTES_BILLED", str(2 * 1024 ** 3)))  # tope por query (maximum_bytes_billed)
+MAX_BYTES_ESTIMATE = int(os.getenv("MAX_BYTES_ESTIMATE", str(1024 ** 3)))  # por encima se agrega a menos dimensiones
+BQ_STREAMING = os.getenv("BQ_STREAMING", "1") == "1"  # resultados por Storage Read API / record batches de Arrow
+MAX_RESULT_ROWS = int(os.getenv("MAX_RESULT_ROWS", "500000"))
+
+# === ROLLUP EN MEMORIA ===
+ROLLUP_ENABLED = os.getenv("ROLLUP_ENABLED", "1") == "1"  # último snapshot pre-agregado en memoria para las queries de build_query
+
+# === ESTADO DE HILOS ===
+THREAD_HISTORY_TTL = int(os.getenv("THREAD_HISTORY_TTL", "600"))  # segundos que se confía en el historial en memoria (0 = siempre Slack)
+THREAD_HISTORY_MAX_THREADS = int(os.getenv("THREAD_HISTORY_MAX_THREADS", "5000"))
+THREAD_STATE_BACKEND = os.getenv("THREAD_STATE_BACKEND", "firestore")  # firestore | memory
+THREAD_STATE_REFRESH_SECONDS = float(os.getenv("THREAD_STATE_REFRESH_SECONDS", "30"))  # se relee de Firestore (otra instancia pudo escribir)
+THREAD_STATE_MAX_THREADS = int(os.getenv("THREAD_STATE_MAX_THREADS", "2000"))  # hilos en memoria (LRU)
+
+# === CLASIFICACION ===
+INTENT_MODE = os.getenv("INTENT_MODE", "combined")  # combined | speculative | serial
+
+# === CODE EXECUTION ===
+UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "parquet")  # parquet | feather | csv.gz | csv
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "remote")  # remote | auto | local (local exige namespaces: ver local_executor)
+# Cada sandbox puede llegar a LOCAL_EXEC_MEMORY_MB: (workers + warm) x memoria tiene que caber en la instancia además de la app
+LOCAL_EXEC_WORKERS = int(os.getenv("LOCAL_EXEC_WORKERS", "1"))  # sandboxes locales a la vez
+LOCAL_EXEC_WARM = int(os.getenv("LOCAL_EXEC_WARM", str(LOCAL_EXEC_WORKERS)))  # procesos precalentados (pandas ya importado)
+LOCAL_EXEC_MAX_ROWS = int(os.getenv("LOCAL_EXEC_MAX_ROWS", "200000"))  # en auto, datasets mayores van al contenedor remoto
+LOCAL_EXEC_MEMORY_MB = int(os.getenv("LOCAL_EXEC_MEMORY_MB", "384"))  # límite de espacio de direcciones (pandas+pyarrow necesitan ~300)
+LOCAL_EXEC_UID_BASE = int(os.getenv("LOCAL_EXEC_UID_BASE", "61000"))  # cada sandbox corre con su propio uid sin privilegios
+LOCAL_EXEC_CPU_SECONDS = int(os.getenv("LOCAL_EXEC_CPU_SECONDS", "60"))
+LOCAL_EXEC_TIMEOUT = float(os.getenv("LOCAL_EXEC_TIMEOUT", "30"))  # segundos de reloj por ejecución de código
+LOCAL_EXEC_MAX_TURNS = int(os.getenv("LOCAL_EXEC_MAX_TURNS", "8"))
+
+# === PRESUPUESTO DE MODELOS ===
+USER_DAILY_BUDGET_EUR = float(os.getenv("USER_DAILY_BUDGET_EUR", "5"))  # gasto LLM por usuario y día (en THREAD_STATE_BACKEND, común a todas las instancias)
+THREAD_BUDGET_EUR = float(os.getenv("THREAD_BUDGET_EUR", "1"))  # gasto LLM por hilo de Slack
+BUDGET_STEP_DOWN_RATIO = float(os.getenv("BUDGET_STEP_DOWN_RATIO", "0.8"))  # a partir de aquí se usa el modelo barato
+
+# === INFORMES BATCH ===
+BATCH_REPORT_CHANNEL = os.getenv("BATCH_REPORT_CHANNEL", "")  # canal donde se publican los informes semanales
+BATCH_REPORT_MODEL = os.getenv("BATCH_REPORT_MODEL", "claude-sonnet-4-5-20250929")
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "60"))  # cada cuánto se consulta el estado del batch
+BATCH_INLINE_WAIT_SECONDS = int(os.getenv("BATCH_INLINE_WAIT_SECONDS", "600"))  # después lo retoma /reports/batch/resume
+BATCH_STATE_BACKEND = os.getenv("BATCH_STATE_BACKEND", "firestore")  # firestore | memory: batches pendientes de publicar
+REPORTS_TOKEN = os.getenv("REPORTS_TOKEN", "")  # cabecera x-reports-token; sin token los endpoints /reports/* están cerrados
+
+# === CACHE DE RESPUESTAS ===
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "/tmp/answer_cache.sqlite")  # vacío = solo memoria
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))  # 0 desactiva la cache
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
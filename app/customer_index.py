@@ -0,0 +1,128 @@
+import asyncio
+import time
+import numpy as np
+from collections import defaultdict
+from rapidfuzz import fuzz, process, utils
+from app import logger
+from app.bigQuery import latest_snapshot, run_query
+from app.singleflight import SingleFlight
+
+CUSTOMER_TABLE = "jt-prd-financial-pa.random_data.real_data"
+CUSTOMER_INDEX_TTL = 6 * 3600  # segundos
+PREFILTER_MIN_CUSTOMERS = 2000  # por debajo se compara contra todos
+PREFILTER_LIMIT = 500  # candidatos por mención tras el filtro de n-gramas
+EXACT_SCORE = 85
+FUZZY_SCORE = 55
+
+
+def _ngrams(processed: str, n: int = 3) -> set:
+    grams = set()
+    for token in processed.split():
+        padded = f" {token} "
+        grams.update(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+    return grams
+
+
+class CustomerIndex:
+    """
+    Lista de clientes precalculada: nombres normalizados y un índice invertido de trigramas
+    para reducir candidatos antes de puntuar todas las menciones con cdist.
+    """
+    def __init__(self, names: list, data_week=None):
+        self.names = names
+        self.data_week = data_week
+        self.built_at = time.monotonic()
+        self.processed = [utils.default_process(n) for n in names]
+        postings = defaultdict(list)
+        for i, name in enumerate(self.processed):
+            for gram in _ngrams(name):
+                postings[gram].append(i)
+        self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _candidates(self, processed_mentions: list) -> np.ndarray:
+        if len(self.names) <= PREFILTER_MIN_CUSTOMERS:
+            return np.arange(len(self.names))
+        selected = []
+        for mention in processed_mentions:
+            hits = [self.postings[g] for g in _ngrams(mention) if g in self.postings]
+            if not hits:
+                continue
+            counts = np.bincount(np.concatenate(hits), minlength=len(self.names))
+            nonzero = np.flatnonzero(counts)
+            if len(nonzero) > PREFILTER_LIMIT:
+                nonzero = nonzero[np.argpartition(counts[nonzero], -PREFILTER_LIMIT)[-PREFILTER_LIMIT:]]
+            selected.append(nonzero)
+        if not selected:
+            return np.array([], dtype=np.int32)
+        return np.unique(np.concatenate(selected))
+
+    def match(self, mentioned: list, top_n: int = 10) -> dict:
+        queries = [utils.default_process(m) for m in mentioned]
+        candidates = self._candidates(queries)
+        exact_matches, fuzzy_candidates = {}, {}
+        if len(candidates):
+            choices = [self.processed[i] for i in candidates]
+            scores = process.cdist(queries, choices, scorer=fuzz.token_sort_ratio, score_cutoff=FUZZY_SCORE, workers=-1)
+            for row in scores:
+                top = np.argsort(row)[::-1][:top_n]
+                for j in top:
+                    score = float(row[j])
+                    if score < FUZZY_SCORE:
+                        break
+                    name = self.names[candidates[j]]
+                    logger.debug("%s - score: %s", name, score)
+                    target = exact_matches if score >= EXACT_SCORE else fuzzy_candidates
+                    target[name] = max(score, target.get(name, 0))
+
+        def by_score(d):
+            return sorted(d, key=d.get, reverse=True)
+
+        if exact_matches:
+            return {"case": "direct_match", "exact": by_score(exact_matches), "candidates": []}
+        elif fuzzy_candidates:
+            return {"case": "ambiguous_match", "exact": [], "candidates": by_score(fuzzy_candidates)}
+        else:
+            return {"case": "not_found", "exact": [], "candidates": []}
+
+
+async def get_customer_list():
+    sql = f"""
+    SELECT DISTINCT sfdc_name_l3
+    FROM `{CUSTOMER_TABLE}`
+    WHERE sfdc_name_l3 IS NOT NULL
+    """
+
+    df = await run_query(sql)
+    logger.debug("Succesfull customer list.")
+    return df
+
+
+_index = None
+index_flight = SingleFlight("customer_index")
+
+
+async def get_customer_index() -> CustomerIndex:
+    """
+    Índice en memoria del proceso. Se reconstruye al cambiar el data_week de la tabla o al expirar la TTL.
+    """
+    global _index
+    data_week = await latest_snapshot(CUSTOMER_TABLE)
+    if _index is not None and _index.data_week == data_week and time.monotonic() - _index.built_at < CUSTOMER_INDEX_TTL:
+        return _index
+    # Una sola reconstrucción a la vez por data_week: el resto de preguntas espera la que está en marcha
+    return await index_flight.do(str(data_week), rebuild_customer_index, data_week)
+
+
+async def rebuild_customer_index(data_week) -> CustomerIndex:
+    global _index
+    df_clients = await get_customer_list()
+    names = df_clients["sfdc_name_l3"].dropna().astype(str).unique().tolist() if not df_clients.empty else []
+    if not names and _index is not None:
+        logger.warning("Customer list empty, keeping previous index")
+        return _index
+    _index = await asyncio.to_thread(CustomerIndex, names, data_week)
+    logger.debug("Customer index built: %s customers (data_week %s)", len(_index), data_week)
+    return _index
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from app import logger, get_db, DEDUP_BACKEND, DEDUP_TTL_SECONDS, DEDUP_MAX_EVENTS
+
+
+class TTLCache:
+    """
+    Conjunto acotado: expira las claves tras `ttl` segundos y descarta las más antiguas al superar `maxsize`.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._items:
+            key, expires = next(iter(self._items.items()))
+            if expires > now and len(self._items) <= self.maxsize:
+                break
+            self._items.popitem(last=False)
+
+    def add(self, key) -> bool:
+        """Devuelve True si la clave no estaba (o había expirado)."""
+        now = time.monotonic()
+        expires = self._items.get(key)
+        if expires is not None and expires > now:
+            return False
+        self._items[key] = now + self.ttl
+        self._items.move_to_end(key)
+        self._evict(now)
+        return True
+
+    def __contains__(self, key) -> bool:
+        expires = self._items.get(key)
+        return expires is not None and expires > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class MemoryDedupBackend:
+    """Stand-in local del backend compartido (tests / desarrollo)."""
+    def __init__(self):
+        self.docs = {}
+
+    def claim(self, event_id: str, expire_at: datetime) -> bool:
+        now = datetime.now(timezone.utc)
+        current = self.docs.get(event_id)
+        if current is not None and current > now:
+            return False
+        self.docs[event_id] = expire_at
+        return True
+
+
+class FirestoreDedupBackend:
+    """Backend compartido entre instancias: `create()` es atómico y falla si el documento ya existe."""
+    def __init__(self, client_factory, collection: str = "slack-events"):
+        self.client_factory = client_factory  # el cliente de Firestore se crea en el primer claim
+        self.collection_name = collection
+
+    @property
+    def collection(self):
+        return self.client_factory().collection(self.collection_name)
+
+    def claim(self, event_id: str, expire_at: datetime) -> bool:
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            # expireAt permite configurar una TTL policy en Firestore para borrar los documentos
+            self.collection.document(event_id).create({"expireAt": expire_at})
+            return True
+        except AlreadyExists:
+            return False
+
+
+class EventDeduplicator:
+    def __init__(self, backend=None, ttl: float = DEDUP_TTL_SECONDS, maxsize: int = DEDUP_MAX_EVENTS):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.backend = backend
+        self.ttl = ttl
+
+    async def is_duplicate(self, event_id: str) -> bool:
+        if not event_id:
+            return False
+        if not self.local.add(event_id):
+            return True
+        if self.backend is None:
+            return False
+        expire_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        try:
+            claimed = await asyncio.to_thread(self.backend.claim, event_id, expire_at)
+        except Exception as e:
+            # Si el backend compartido falla preferimos procesar el evento a perderlo
+            logger.error("Dedup backend error for %s: %s", event_id, e)
+            return False
+        return not claimed
+
+
+def build_deduplicator(backend_name: str = DEDUP_BACKEND) -> EventDeduplicator:
+    if backend_name == "firestore":
+        return EventDeduplicator(backend=FirestoreDedupBackend(get_db))
+    if backend_name == "memory-shared":
+        return EventDeduplicator(backend=MemoryDedupBackend())
+    return EventDeduplicator()
+
+
+deduplicator = build_deduplicator()
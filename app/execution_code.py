@@ -1,27 +1,105 @@
-import os, tempfile
+import io
+import asyncio
 import time
 import pandas as pd
 from threading import Event
-from concurrent.futures import ThreadPoolExecutor
-from app import claude, logger
-from app.utils_slack.slack_utils import update_message, uploadFiles, completeUpload
+from app import get_claude, logger, UPLOAD_FORMAT
+from app.utils_slack.slack_utils import update_message, uploadFiles, completeUpload, ProgressiveMessage
 from app.utils_slack.format_utils import format_for_slack
 from app.llms import calculate_tokens_str, code_execution_call
+from app.answer_cache import answer_cache, fingerprint
+from app.thread_state import current_thread_state
+from app.metrics import span
+from app.local_executor import choose_execution_mode, run_local_analysis, SandboxError
+from app.model_router import model_router
+from app.singleflight import SingleFlight
 
-def run_code_execution(prompt: str, df: pd.DataFrame, channel: str, user: str, threadts: str, model: str = "claude-sonnet-4-5-20250929") -> str:  #claude-3-5-haiku-latest claude-sonnet-4-20250514
+# formato -> (nombre del fichero, mime type, instrucción para el modelo)
+UPLOAD_FORMATS = {
+    "parquet": ("data.parquet", "application/vnd.apache.parquet",
+                "The attached file data.parquet is a Parquet file: load it with pandas.read_parquet."),
+    "feather": ("data.feather", "application/vnd.apache.arrow.file",
+                "The attached file data.feather is an Arrow Feather file: load it with pandas.read_feather."),
+    "csv.gz": ("data.csv.gz", "application/gzip",
+               "The attached file data.csv.gz is a gzip-compressed CSV: load it with pandas.read_csv(path, compression='gzip')."),
+    "csv": ("data.csv", "text/csv", "The attached file data.csv is a CSV file."),
+}
+RELAY_CHUNK_SIZE = 256 * 1024
+MAX_CACHED_ARTIFACT_BYTES = 10 * 1024 * 1024  # ficheros más grandes no se guardan en la cache de respuestas
+DICTIONARY_MAX_RATIO = 0.5  # columnas de texto con menos valores únicos que esto (por fila) pasan a category
+upload_flight = SingleFlight("dataset_upload")
+
+
+def encode_dimensions(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convierte las dimensiones de texto repetidas a category para que Parquet/Feather las guarden con diccionario.
+    """
+    out = df.copy(deep=False)
+    for col in out.columns:
+        if out[col].dtype == object or pd.api.types.is_string_dtype(out[col]):
+            if out[col].nunique(dropna=False) <= max(1, len(out) * DICTIONARY_MAX_RATIO):
+                out[col] = out[col].astype("category")
+    return out
+
+
+def serialize_dataframe(df: pd.DataFrame, fmt: str = UPLOAD_FORMAT) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == "parquet":
+        encode_dimensions(df).to_parquet(buffer, index=False, compression="zstd")
+    elif fmt == "feather":
+        encode_dimensions(df).reset_index(drop=True).to_feather(buffer, compression="zstd")
+    elif fmt == "csv.gz":
+        df.to_csv(buffer, index=False, compression={"method": "gzip", "compresslevel": 6})
+    else:
+        buffer.write(df.to_csv(index=False).encode("utf-8"))
+    return buffer.getvalue()
+
+async def upload_dataset(df: pd.DataFrame, fmt: str) -> str:
+    filename, mime_type, _ = UPLOAD_FORMATS[fmt]
+    payload = await asyncio.to_thread(serialize_dataframe, df, fmt)
+    logger.debug("Dataset serialized as %s: %s rows, %s bytes", fmt, len(df), len(payload))
+    with span("upload", bytes=len(payload)):
+        uploaded = await get_claude().beta.files.upload(file=(filename, payload, mime_type))
+    return uploaded.id
+
+async def run_code_execution(prompt: str, df: pd.DataFrame, channel: str, user: str, threadts: str, model: str = None, upload_format: str = UPLOAD_FORMAT, cache_key: str = None, question: str = None) -> str:  #claude-3-5-haiku-latest claude-sonnet-4-20250514
     if df.empty:
         return("No data available.")
-    with tempfile.NamedTemporaryFile(mode="w+", suffix=".csv", delete=False) as tmp_file:
-        df.to_csv(tmp_file.name, index=False)
-        tmp_path = tmp_file.name
-    
-    logger.debug("file created at " + tmp_path)
-
-    with open(tmp_path, "rb") as f:
-            uploaded = claude.beta.files.upload(file=("data.csv", f, "text/csv"))
+    if cache_key:
+        cached = await answer_cache.get(cache_key)
+        if cached is not None:
+            logger.debug("♻️ Answer cache hit (%s)", cache_key[:12])
+            return await replay_cached_answer(cached, channel, threadts)
+    # La complejidad se mide sobre la pregunta del usuario, no sobre el contexto añadido al prompt
+    model = model or model_router.choose("analysis", question or prompt, df)
+    if choose_execution_mode(df) == "local":
+        try:
+            return await run_local_analysis(prompt, df, channel, user, threadts, model=model, cache_key=cache_key)
+        except SandboxError as e:
+            logger.warning("⚠️ Local sandbox failed, falling back to the code execution container: %s", e)
+    fmt = upload_format if upload_format in UPLOAD_FORMATS else "csv"
+    file_hint = UPLOAD_FORMATS[fmt][2]
+    # En un hilo con estado, el mismo dataset ya subido se reutiliza; los ficheros se borran al caducar el hilo
+    state = current_thread_state()
+    dataset_key = f"{fmt}-{await fingerprint(df)}"
+    uploaded_id = state.datasets.get(dataset_key) if state else None
+    if uploaded_id:
+        logger.debug("♻️ Reusing uploaded dataset %s", uploaded_id)
+    elif state:
+        # Preguntas del mismo hilo que suben el mismo dataset a la vez comparten la subida. La clave incluye el
+        # hilo: cada hilo borra sus ficheros al caducar y no puede borrar uno que otro hilo sigue usando
+        uploaded_id = await upload_flight.do((state.thread_id, dataset_key), upload_dataset, df, fmt)
+        state.add_dataset(dataset_key, uploaded_id)
+    else:
+        # Sin estado el fichero se borra al terminar: no se comparte
+        uploaded_id = await upload_dataset(df, fmt)
     try:
-        update_message(channel=channel, ts=threadts, new_text="🔬Analyzing...")
-        response = code_execution_call(file_id=uploaded.id, model=model, prompt=prompt)
+        await update_message(channel=channel, ts=threadts, new_text="🔬Analyzing...")
+        progress = ProgressiveMessage(channel, threadts)
+        try:
+            response = await code_execution_call(file_id=uploaded_id, model=model, prompt=prompt, file_hint=file_hint, on_text=progress.on_text)
+        finally:
+            await progress.close()
         file_ids = []
         
         for block in response.content:
@@ -33,13 +111,8 @@ def run_code_execution(prompt: str, df: pd.DataFrame, channel: str, user: str, t
                         if file_id:
                             file_ids.append(file_id)
         print(file_ids)
-        final_ids = []
-        for id in file_ids:
-            logger.debug(id)
-            file_response = claude.beta.files.download(id)
-            data = claude.beta.files.retrieve_metadata(id)
-            file_id = uploadFiles(file_response, data.filename)
-            final_ids.append({"id": file_id, "title": data.filename})
+        artifacts = [] if cache_key else None
+        final_ids = await relay_files(file_ids, artifacts)
 
         logger.debug(response)
 
@@ -48,21 +121,71 @@ def run_code_execution(prompt: str, df: pd.DataFrame, channel: str, user: str, t
         output_text = output_text.strip()
 
         logger.debug("code execution did not fail")
-        token_str = calculate_tokens_str(response, fx=0.86, input_dollar_per_M=1, output_dollar_per_M=5)
+        token_str = calculate_tokens_str(response)
         logger.debug(token_str)
         output = format_for_slack(output_text + token_str)
+        if cache_key and len(final_ids) == len(artifacts):
+            await answer_cache.put(cache_key, output_text, artifacts)
         if len(final_ids) > 0 :
-            completeUpload(channel, threadts, final_ids, format_for_slack(output_text+ token_str))
+            await completeUpload(channel, threadts, final_ids, format_for_slack(output_text+ token_str))
             return "Analysis Completed"
         return output
     finally:
-        try:
-            claude.beta.files.delete(uploaded.id)
-            logger.debug("deleted file")
-        except Exception as e:
-            logger.error(f"Could not delete file: {e}")
-        try:
-            os.remove(tmp_path)
-            logger.debug("removed path")
-        except Exception as e:
-            logger.error(f"could not delete path: {e}")
\ No newline at end of file
+        if state is None:
+            try:
+                await get_claude().beta.files.delete(uploaded_id)
+                logger.debug("deleted file")
+            except Exception as e:
+                logger.error(f"Could not delete file: {e}")
+
+
+
+async def _tee(chunks, sink: list):
+    async for chunk in chunks:
+        sink.append(chunk)
+        yield chunk
+
+
+async def relay_file(file_id: str, artifacts: list = None) -> dict:
+    """
+    Pasa un fichero generado por Claude a Slack en streaming: metadata y descarga en paralelo, sin cargarlo entero en memoria.
+    Si se pasa `artifacts`, guarda una copia de los ficheros pequeños para la cache de respuestas.
+    """
+    metadata_task = asyncio.create_task(get_claude().beta.files.retrieve_metadata(file_id))
+    try:
+        async with get_claude().beta.files.with_streaming_response.download(file_id) as file_response:
+            metadata = await metadata_task
+            chunks = file_response.iter_bytes(RELAY_CHUNK_SIZE)
+            kept = [] if artifacts is not None and metadata.size_bytes <= MAX_CACHED_ARTIFACT_BYTES else None
+            if kept is not None:
+                chunks = _tee(chunks, kept)
+            slack_file_id = await uploadFiles(chunks, metadata.filename, metadata.size_bytes)
+            if kept is not None:
+                artifacts.append({"filename": metadata.filename, "content": b"".join(kept)})
+    finally:
+        if not metadata_task.done():
+            metadata_task.cancel()
+    logger.debug("Relayed %s -> %s (%s, %s bytes)", file_id, slack_file_id, metadata.filename, metadata.size_bytes)
+    return {"id": slack_file_id, "title": metadata.filename}
+
+
+async def relay_files(file_ids: list, artifacts: list = None) -> list:
+    results = await asyncio.gather(*(relay_file(id, artifacts) for id in file_ids), return_exceptions=True)
+    final_ids = []
+    for id, result in zip(file_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Could not relay file {id}: {result}")
+            continue
+        final_ids.append(result)
+    return final_ids
+
+
+
+async def replay_cached_answer(cached: dict, channel: str, threadts: str) -> str:
+    output = format_for_slack(cached["text"] + "\n\n_♻️ Cached answer_")
+    if not cached["files"]:
+        return output
+    final_ids = await asyncio.gather(*(
+        uploadFiles(f["content"], f["filename"], len(f["content"])) for f in cached["files"]))
+    await completeUpload(channel, threadts, [{"id": id, "title": f["filename"]} for id, f in zip(final_ids, cached["files"])], output)
+    return "Analysis Completed"
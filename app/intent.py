@@ -0,0 +1,120 @@
+import asyncio
+from app import PROMPTS_PATH, logger, INTENT_MODE
+from app.llms import call_claude_tool, call_claude_with_prompt, render_prompt
+from app.prompt_registry import prompt_registry
+from app.profit_and_loss import calculate_current_week
+
+QUERY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "filters": {"type": "object", "description": "column_name -> list of values"},
+        "metrics": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["filters", "metrics"],
+}
+
+ROUTE_TOOL = {
+    "name": "route_question",
+    "description": "Classify the user's latest message and, when it is actionable, return the query filters for every table it needs.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "proceed": {"type": "string", "enum": ["yes", "no"]},
+            "tables": {"type": "array", "items": {"type": "string", "enum": ["profitAndLoss", "detailed_topline"]}},
+            "client_related": {"type": "string", "enum": ["yes", "no"]},
+            "file_requested": {"type": "string", "enum": ["yes", "no"]},
+            "clients_mentioned": {"type": "array", "items": {"type": "string"}},
+            "reply_to_user": {"type": "string"},
+            "topline_query": {**QUERY_SCHEMA, "description": "Filters for detailed_topline. Only when tables includes detailed_topline."},
+            "pnl_query": {**QUERY_SCHEMA, "description": "Filters for profitAndLoss. Only when tables includes profitAndLoss."},
+        },
+        "required": ["proceed", "tables", "client_related", "file_requested", "clients_mentioned", "reply_to_user"],
+    },
+}
+
+ROUTE_INSTRUCTIONS = """You answer through the route_question tool only, never with free text.
+Part 1 decides the routing fields (proceed, tables, client_related, file_requested, clients_mentioned, reply_to_user).
+If proceed is "yes", also fill topline_query following Part 2 when tables includes "detailed_topline",
+and pnl_query following Part 3 when tables includes "profitAndLoss".
+Wherever the parts below ask for a JSON answer, put that JSON in the matching tool field instead."""
+
+
+def route_system_blocks() -> list:
+    parts = [
+        ROUTE_INSTRUCTIONS,
+        "# Part 1 - Intent classification\n\n" + prompt_registry.get(PROMPTS_PATH + "first_response_copy.txt").instructions,
+        "# Part 2 - detailed_topline filters (topline_query)\n\n" + prompt_registry.get(PROMPTS_PATH + "query_filters.txt").instructions,
+        "# Part 3 - profitAndLoss filters (pnl_query)\n\n" + prompt_registry.get(PROMPTS_PATH + "query_pNl.txt").instructions,
+    ]
+    return [{"type": "text", "text": "\n\n---\n\n".join(parts), "cache_control": {"type": "ephemeral"}}]
+
+
+async def classify_combined(user_question: str) -> dict:
+    content = f'Current Week: "{calculate_current_week()}"\n\nThis is the full chat history between the user and you:\n{user_question}'
+    return await call_claude_tool(route_system_blocks(), content, ROUTE_TOOL)
+
+
+async def classify_speculative(user_question: str) -> dict:
+    """
+    Clasificación y filtros en paralelo. Los filtros que no hacen falta (o todos, si proceed == "no") se cancelan.
+    """
+    current_week = calculate_current_week()
+    classification = asyncio.create_task(call_claude_with_prompt(
+        render_prompt(PROMPTS_PATH + "first_response_copy.txt", user_input=user_question)))
+    speculative = {
+        "topline_query": asyncio.create_task(call_claude_with_prompt(
+            render_prompt(PROMPTS_PATH + "query_filters.txt", user_input=user_question))),
+        "pnl_query": asyncio.create_task(call_claude_with_prompt(
+            render_prompt(PROMPTS_PATH + "query_pNl.txt", user_input=user_question, current_week=current_week))),
+    }
+    try:
+        first_response = await classification
+    except Exception:
+        for task in speculative.values():
+            task.cancel()
+        raise
+    tables = first_response.get("tables") or []
+    needed = set()
+    if first_response.get("proceed") != "no":
+        if "detailed_topline" in tables:
+            needed.add("topline_query")
+        if "profitAndLoss" in tables:
+            needed.add("pnl_query")
+    for field, task in speculative.items():
+        if field in needed:
+            first_response[field] = task
+        else:
+            task.cancel()
+    logger.debug("Speculative filters kept: %s", sorted(needed))
+    return first_response
+
+
+async def classify_question(user_question: str, mode: str = INTENT_MODE) -> dict:
+    """
+    combined: una sola llamada con tool use | speculative: llamadas en paralelo | serial: solo clasificación
+    """
+    if mode == "combined":
+        try:
+            return await classify_combined(user_question)
+        except Exception as e:
+            logger.error("Combined routing call failed, falling back to serial: %s", e)
+    elif mode == "speculative":
+        return await classify_speculative(user_question)
+    return await call_claude_with_prompt(
+        render_prompt(PROMPTS_PATH + "first_response_copy.txt", user_input=user_question))
+
+
+async def prefetched_filters(first_response: dict, field: str):
+    """
+    Filtros ya generados por classify_question (dict, o task en modo especulativo). None si hay que pedirlos.
+    """
+    value = first_response.get(field)
+    if isinstance(value, asyncio.Task):
+        try:
+            value = await value
+        except Exception as e:
+            logger.error("Speculative %s failed: %s", field, e)
+            return None
+    if not isinstance(value, dict) or not value.get("metrics"):
+        return None
+    return value
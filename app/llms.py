@@ -1,96 +1,213 @@
+import time
 import pandas as pd
-from app import claude, logger
-from pathlib import Path
+from app import get_claude, logger
+from app.prompt_registry import prompt_registry
 from app.utils_slack.format_utils import format_for_slack, safe_json_parse
+from app.metrics import timed, record_llm_usage
+from app.model_router import model_router, cost_eur
+from app.singleflight import SingleFlight, flight_key
+
+llm_flight = SingleFlight("llm")
 
 def load_prompt(file_name: str, **kwargs) -> str:
     try:
-        path = Path(file_name)
-        logger.info("leido file")
-        text = path.read_text(encoding="utf-8")
-        logger.info("leido texto")
-        final_text = text.format(**kwargs)
-        logger.info("formateado texto")
-        return final_text
+        return prompt_registry.get(file_name).render(**kwargs)
+    except Exception as e:
+        logger.debug("Fallo en cargar prompt")
+        raise
+
+def render_prompt(file_name: str, **kwargs) -> list:
+    """
+    Igual que load_prompt pero en bloques: el prefijo estático va con cache_control para el prompt caching.
+    """
+    try:
+        return prompt_registry.get(file_name).render_blocks(**kwargs)
     except Exception as e:
         logger.debug("Fallo en cargar prompt")
         raise
 
-def call_claude_with_prompt(prompt: str) -> str:
+@timed("call_claude_with_prompt")
+async def call_claude_with_prompt(prompt: str | list, model: str = None) -> str:
     try:
         #logger.debug(prompt)
-        response = claude.messages.create(
-            model="claude-haiku-4-5-20251001", 
+        response = await create_message(
+            "routing",
+            model=model or model_router.choose("routing"),
             max_tokens=1000,
             messages=[{"role": "user", "content": prompt}]
         )
         output = response.content[0].text
         logger.debug(output)
+        logger.debug("Prompt cache: read %s - written %s",
+                     getattr(response.usage, "cache_read_input_tokens", 0),
+                     getattr(response.usage, "cache_creation_input_tokens", 0))
         safe_json = safe_json_parse(output)
         logger.debug(safe_json)
-        token_str = calculate_tokens_str(response, 0.86, 1, 5)
+        token_str = calculate_tokens_str(response)
         logger.debug(token_str)
         return safe_json
     except Exception as e:
         logger.debug("Fallo en la llamada a claude.")
         raise
 
-def calculate_tokens_str(response, fx: float, input_dollar_per_M: float, output_dollar_per_M: float) -> str:
-    input_tokens = response.usage.input_tokens
-    output_tokens = response.usage.output_tokens
-    input_cost = round(int(input_tokens) * fx * input_dollar_per_M/  1000000,2)
-    output_cost = round(int(output_tokens) * fx * output_dollar_per_M /  1000000,2)
+@timed("call_claude_tool")
+async def call_claude_tool(system: list, content, tool: dict, model: str = None, max_tokens: int = 2000) -> dict:
+    """
+    Llamada con tool use forzado: devuelve directamente el input de la herramienta (JSON validado por el schema).
+    """
+    try:
+        response = await create_message(
+            "routing",
+            model=model or model_router.choose("routing"),
+            max_tokens=max_tokens,
+            system=system,
+            tools=[tool],
+            tool_choice={"type": "tool", "name": tool["name"]},
+            messages=[{"role": "user", "content": content}]
+        )
+        tool_input = next(block.input for block in response.content if getattr(block, "type", None) == "tool_use")
+        logger.debug(tool_input)
+        token_str = calculate_tokens_str(response)
+        logger.debug(token_str)
+        return tool_input
+    except Exception as e:
+        logger.debug("Fallo en la llamada a claude.")
+        raise
+
+def calculate_tokens(response, discount: float = 1.0) -> dict:
+    """
+    Tokens y coste (€) con los precios del modelo que contestó, incluida la lectura/escritura de prompt cache.
+    discount < 1 para respuestas de la Message Batches API.
+    """
+    input_tokens = int(response.usage.input_tokens)
+    output_tokens = int(response.usage.output_tokens)
+    cache_read = int(getattr(response.usage, "cache_read_input_tokens", 0) or 0)
+    cache_write = int(getattr(response.usage, "cache_creation_input_tokens", 0) or 0)
+    costs = cost_eur(getattr(response, "model", None), input_tokens, output_tokens, cache_write=cache_write, cache_read=cache_read)
+    costs = {kind: cost * discount for kind, cost in costs.items()}
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "cache_read": cache_read, "cache_write": cache_write, **costs}
+
+def record_usage(response, stage: str = None, started: float = None, discount: float = 1.0):
+    """Tokens y coste (€) como números para /metrics, la traza de la petición y los presupuestos del router."""
+    try:
+        usage = calculate_tokens(response, discount)
+        model = getattr(response, "model", None) or "unknown"
+        record_llm_usage(model, usage["input_tokens"], usage["output_tokens"], usage["total_cost"],
+                         cache_read=usage["cache_read"], cache_write=usage["cache_write"])
+        model_router.record(stage, model, usage["total_cost"], time.perf_counter() - started if started else None)
+    except Exception as e:
+        logger.error("Could not record token usage: %s", e)
+
+def calculate_tokens_str(response, discount: float = 1.0) -> str:
+    usage = calculate_tokens(response, discount)
+    input_cost = round(usage["input_cost"], 2)
+    output_cost = round(usage["output_cost"], 2)
     total_cost = input_cost + output_cost
-    input_str = "\n\nInput tokens: " + str(input_tokens) + " - Cost €: " + str(input_cost)
-    output_str = "\nOutput tokens: "+ str(output_tokens) + " - Cost €: " + str(output_cost) + " - Total cost: " + str(total_cost)
+    input_str = "\n\nInput tokens: " + str(usage["input_tokens"]) + " - Cost €: " + str(input_cost)
+    output_str = "\nOutput tokens: "+ str(usage["output_tokens"]) + " - Cost €: " + str(output_cost) + " - Total cost: " + str(total_cost)
     return input_str + output_str
 
 
-def call_claude_simple(user_question: str, df: pd.DataFrame) ->str:
-    df_json = df.to_json(orient="records")
+def encode_table(df: pd.DataFrame) -> str:
+    """
+    Tabla compacta para el prompt: cabecera una sola vez y filas separadas por '|' (to_json repite las columnas en cada fila).
+    """
+    return df.to_csv(sep="|", index=False, float_format="%.2f").strip()
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+async def stream_message(messages_api, on_text=None, **kwargs):
+    """
+    Llamada en streaming. `on_text(delta, snapshot)` recibe cada trozo de texto y el bloque acumulado.
+    Devuelve el mensaje final, igual que messages.create.
+    """
+    async with messages_api.stream(**kwargs) as stream:
+        async for event in stream:
+            if event.type == "text" and on_text is not None:
+                on_text(event.text, event.snapshot)
+        return await stream.get_final_message()
+
+async def create_message(stage: str, **kwargs):
+    """
+    messages.create con single-flight: la misma petición (prompt, input y modelo) ya en marcha se comparte
+    y el uso se registra una sola vez.
+    """
+    async def create():
+        started = time.perf_counter()
+        response = await get_claude().messages.create(**kwargs)
+        record_usage(response, stage, started)
+        return response
+    return await llm_flight.do(flight_key(stage, kwargs), create)
+
+async def stream_once(stage: str, messages_api, on_text=None, **kwargs):
+    """Igual que create_message pero en streaming: solo la primera llamada recibe los trozos de texto."""
+    async def stream():
+        started = time.perf_counter()
+        response = await stream_message(messages_api, on_text=on_text, **kwargs)
+        record_usage(response, stage, started)
+        return response
+    return await llm_flight.do(flight_key(stage, kwargs), stream)
+
+@timed("call_claude_simple")
+async def call_claude_simple(user_question: str, df: pd.DataFrame, on_text=None, model: str = None, schema: str = None, question: str = None) ->str:
+    """
+    schema: descripción de la tabla de la que salen los datos (TOPLINE_SCHEMA, PNL_SCHEMA...).
+    question: pregunta original del usuario si user_question lleva contexto añadido (para el router).
+    """
+    df_table = encode_table(df)
+    schema = schema or "Columns: " + ", ".join(f"{col} ({dtype})" for col, dtype in df.dtypes.astype(str).items())
     prompt = f"""
-    You are a data analyst. I will give you a question and a dataset in JSON format.
-    Available columns in source table:
-    - date_week: (DATE)'YYYY-MM-DD': snapshot week (always a Monday)
-    - week_label: wk0, wk-1
-    - salesforce name : client name
-    - month: month of the year
-    - country (BE, CO, DE, ES, FR, NO, PT, SE, UK, US)
-    - service type (Staffing or Outsourcing)
-    - customer type: (EB (existing business), NB (new business), Pipeline NB, Pipeline EB)
-    - cohort: year the client was signed
-    - data_type: (actuals, forecast)
-    - revenue
-    - gross_profit
-    - gross_margin (= gross_profit / revenue)
+    You are a data analyst. I will give you a question and a dataset as a pipe-separated table (first line is the header).
+    {schema}
     Question:
     {user_question}
-    Data (JSON):
-    {df_json}
+    Data (pipe-separated):
+    {df_table}
     Based on the dataset, answer the question clearly and accurately.
     """
-    response = claude.messages.create(
-            model="claude-haiku-4-5-20251001", 
+    response = await stream_once(
+            "simple_answer",
+            get_claude().messages,
+            on_text=on_text,
+            model=model or model_router.choose("simple_answer", question or user_question, df),
             max_tokens=1000,
             messages=[{"role": "user", "content": prompt}]
         )
     output = response.content[0].text
     #logger.debug(output)
-    token_str = calculate_tokens_str(response, 0.86, 1, 5)
+    token_str = calculate_tokens_str(response)
     return format_for_slack(output + token_str)
 
-def code_execution_call(file_id, model, prompt):
-    response = claude.beta.messages.create(
+@timed("code_execution_call")
+async def code_execution_call(file_id, model, prompt, file_hint: str = "", on_text=None):
+    return await stream_once(
+            "analysis",
+            get_claude().beta.messages,
+            on_text=on_text,
             model=model,
             betas=["code-execution-2025-08-25", "files-api-2025-04-14", "context-1m-2025-08-07"],
             max_tokens=4096,
             messages=[{
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": "Based on the attached file and the provided prompt, generate an answer that is concise (approximately 60-per-cent condensed) but still retains essential details, in response to the following question:" + prompt},
+                    {"type": "text", "text": file_hint + " Based on the attached file and the provided prompt, generate an answer that is concise (approximately 60-per-cent condensed) but still retains essential details, in response to the following question:" + prompt},
                     {"type": "container_upload", "file_id": file_id}
                 ]
             }],
             tools=[{"type": "code_execution_20250825", "name": "code_execution"}]
         )
-    return response
\ No newline at end of file
+
+@timed("local_analysis_call")
+async def local_analysis_call(model: str, system: list, messages: list, tools: list, on_text=None):
+    """Un turno del bucle de análisis local (tool use propio en vez del contenedor de code execution)."""
+    return await stream_once(
+            "analysis",
+            get_claude().messages,
+            on_text=on_text,
+            model=model,
+            max_tokens=4096,
+            system=system,
+            tools=tools,
+            messages=messages
+        )
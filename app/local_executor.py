@@ -0,0 +1,335 @@
+import asyncio
+import base64
+import contextlib
+import itertools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from functools import lru_cache
+from types import SimpleNamespace
+import pandas as pd
+from app import logger, EXECUTION_MODE, LOCAL_EXEC_WORKERS, LOCAL_EXEC_WARM, LOCAL_EXEC_MAX_ROWS, LOCAL_EXEC_MEMORY_MB, LOCAL_EXEC_CPU_SECONDS, LOCAL_EXEC_TIMEOUT, LOCAL_EXEC_MAX_TURNS, LOCAL_EXEC_UID_BASE
+from app.llms import local_analysis_call, calculate_tokens_str, encode_table
+from app.metrics import span
+from app.answer_cache import answer_cache
+from app.utils_slack.slack_utils import update_message, uploadFiles, completeUpload, ProgressiveMessage
+from app.utils_slack.format_utils import format_for_slack
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+SPAWN_TIMEOUT = 20.0
+MAX_ARTIFACT_BYTES = 10 * 1024 * 1024  # límite para devolver o cachear un fichero generado
+LOCAL_EXEC_MAX_MEMORY_RATIO = 0.1  # el DataFrame no debe ocupar más de esta fracción del límite (el worker ya usa ~300 MB)
+NAMESPACES = ["unshare", "--net", "--mount", "--pid", "--fork", "--kill-child", "--mount-proc"]
+# Dentro de los namespaces (aún root): sin red (solo lo), código de la app y homes tapados, raíz en solo lectura
+# salvo el directorio de trabajo, y exec del worker con un uid propio, sin capabilities y con no_new_privs
+ISOLATION_SCRIPT = """set -e
+workdir=$1 uid=$2 python=$3 memory=$4 cpu=$5
+shift 5
+mount --make-rprivate /
+mount --bind "$workdir" "$workdir"
+for dir in "$@"; do mount -t tmpfs -o ro,size=4k tmpfs "$dir"; done
+mount -o remount,bind,ro /
+cd "$workdir"
+exec setpriv --reuid="$uid" --regid="$uid" --clear-groups --no-new-privs --inh-caps=-all --bounding-set=-all \\
+  "$python" -I "$workdir/sandbox_worker.py" "$memory" "$cpu"
+"""
+
+
+def hidden_dirs() -> list:
+    """Directorios que el sandbox no ve: el repo (config, .env) y los homes, salvo el que contiene el intérprete."""
+    repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    candidates = [repo, "/app", "/root", "/home", "/var/run/secrets"]
+    interpreter = {os.path.realpath(sys.prefix), os.path.realpath(sys.base_prefix)}
+    return [d for d in dict.fromkeys(candidates) if os.path.isdir(d)
+            and not any(p == d or p.startswith(d.rstrip("/") + "/") for p in interpreter)]
+
+
+_uids = itertools.count()
+
+PYTHON_TOOL = {
+    "name": "run_python",
+    "description": (
+        "Run Python code in a sandbox where the dataset is already loaded as the pandas DataFrame `df` "
+        "(pandas as pd and numpy as np are imported). Variables persist between calls. Print what you need to see. "
+        "Save charts and files for the user into the outputs/ directory (e.g. plt.savefig('outputs/chart.png')); "
+        "open matplotlib figures are saved automatically. There is no network access."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {"code": {"type": "string", "description": "Python code to execute"}},
+        "required": ["code"],
+    },
+}
+
+
+class SandboxError(Exception):
+    pass
+
+
+@lru_cache(maxsize=1)
+def isolation_available() -> bool:
+    """
+    El sandbox local solo se usa si se pueden crear los namespaces y bajar de uid (root con CAP_SYS_ADMIN
+    y util-linux). Si no, todo va al contenedor remoto.
+    """
+    if os.geteuid() != 0 or not shutil.which("unshare") or not shutil.which("setpriv"):
+        logger.warning("🔒 Local sandbox unavailable: needs root, unshare and setpriv")
+        return False
+    try:
+        probe = subprocess.run(NAMESPACES + ["sh", "-c", "mount --make-rprivate / && mount -o remount,bind,ro /"],
+                               capture_output=True, timeout=10)
+    except Exception as e:
+        logger.warning("🔒 Local sandbox unavailable: %s", e)
+        return False
+    if probe.returncode != 0:
+        logger.warning("🔒 Local sandbox unavailable: %s", probe.stderr.decode(errors="replace").strip()[:200])
+    return probe.returncode == 0
+
+
+class Sandbox:
+    """
+    Proceso Python aislado: namespaces de red, mounts y pids propios, uid sin privilegios distinto por sandbox,
+    raíz en solo lectura, límites de CPU/memoria/procesos y su propio directorio de trabajo.
+    """
+    def __init__(self, process, workdir: str):
+        self.process = process
+        self.workdir = workdir
+
+    @classmethod
+    async def start(cls) -> "Sandbox":
+        if not isolation_available():
+            raise SandboxError("sandbox isolation (namespaces + unprivileged uid) is not available")
+        uid = LOCAL_EXEC_UID_BASE + next(_uids) % 1000
+        workdir = tempfile.mkdtemp(prefix="sandbox-")
+        # El código de la app queda tapado dentro del sandbox: el worker se copia al directorio de trabajo
+        shutil.copy(WORKER_PATH, os.path.join(workdir, "sandbox_worker.py"))
+        os.chown(workdir, uid, uid)
+        env = {
+            "PATH": "/usr/bin:/bin", "HOME": workdir, "MPLBACKEND": "Agg", "MPLCONFIGDIR": workdir,
+            "OMP_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1", "MKL_NUM_THREADS": "1",
+            # Sin reservas virtuales grandes (jemalloc de Arrow, arenas de glibc) que se coman RLIMIT_AS
+            "ARROW_DEFAULT_MEMORY_POOL": "system", "MALLOC_ARENA_MAX": "1",
+        }
+        process = await asyncio.create_subprocess_exec(
+            *NAMESPACES, "--", "sh", "-c", ISOLATION_SCRIPT, "sandbox", workdir, str(uid), sys.executable,
+            str(LOCAL_EXEC_MEMORY_MB), str(LOCAL_EXEC_CPU_SECONDS), *hidden_dirs(),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            cwd=workdir, env=env, limit=2 * MAX_ARTIFACT_BYTES, start_new_session=True,
+        )
+        sandbox = cls(process, workdir)
+        try:
+            await sandbox._read(SPAWN_TIMEOUT)
+        except Exception:
+            await sandbox.close()
+            raise
+        return sandbox
+
+    @property
+    def alive(self) -> bool:
+        return self.process.returncode is None
+
+    async def _read(self, timeout: float) -> dict:
+        try:
+            line = await asyncio.wait_for(self.process.stdout.readline(), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise SandboxError(f"sandbox timed out after {timeout:.0f}s")
+        if not line:
+            await self.process.wait()
+            raise SandboxError(f"sandbox exited with code {self.process.returncode} (CPU/memory limit?)")
+        return json.loads(line)
+
+    async def request(self, message: dict, timeout: float = LOCAL_EXEC_TIMEOUT) -> dict:
+        if not self.alive:
+            raise SandboxError("sandbox is not running")
+        self.process.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+        await self.process.stdin.drain()
+        return await self._read(timeout)
+
+    async def load(self, df: pd.DataFrame) -> dict:
+        path = os.path.join(self.workdir, "dataset.parquet")
+        await asyncio.to_thread(df.to_parquet, path, index=False)
+        return await self.request({"op": "load", "path": path})
+
+    async def run(self, code: str) -> dict:
+        return await self.request({"op": "exec", "code": code})
+
+    async def read_output(self, name: str):
+        """
+        El fichero lo lee el propio worker (con su uid y sin ver nada fuera del sandbox): el proceso host es root
+        y un enlace simbólico en outputs/ le haría leer cualquier fichero del host.
+        """
+        if not self.alive:
+            return None
+        try:
+            result = await self.request({"op": "read", "name": os.path.basename(name), "max_bytes": MAX_ARTIFACT_BYTES})
+        except SandboxError as e:
+            logger.warning("Could not read sandbox output %s: %s", name, e)
+            return None
+        return base64.b64decode(result["content"]) if result.get("ok") else None
+
+    def kill(self):
+        # setpriv borra el PDEATHSIG de --kill-child: se mata todo el grupo (unshare y el worker)
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self.process.pid, signal.SIGKILL)
+
+    async def close(self):
+        if self.alive:
+            self.kill()
+            await self.process.wait()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class SandboxPool:
+    """
+    Como mucho `size` sandboxes a la vez. Cada sandbox sirve a un único análisis; se mantienen `warm`
+    procesos arrancados con pandas ya importado para no pagar el arranque en cada pregunta.
+    """
+    def __init__(self, size: int = LOCAL_EXEC_WORKERS, warm: int = LOCAL_EXEC_WARM):
+        self.size = size
+        self.warm = warm
+        self._idle = []
+        self._semaphore = None
+        self._refilling = None
+
+    async def acquire(self) -> Sandbox:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        await self._semaphore.acquire()
+        try:
+            while self._idle:
+                sandbox = self._idle.pop()
+                if sandbox.alive:
+                    return sandbox
+                await sandbox.close()
+            return await Sandbox.start()
+        except Exception:
+            self._semaphore.release()
+            raise
+        finally:
+            self._refill()
+
+    async def release(self, sandbox: Sandbox):
+        try:
+            await sandbox.close()
+        finally:
+            self._semaphore.release()
+            self._refill()
+
+    async def prewarm(self):
+        await self._start_warm()
+
+    def _refill(self):
+        if self._refilling is None or self._refilling.done():
+            self._refilling = asyncio.create_task(self._start_warm())
+
+    async def _start_warm(self):
+        while len(self._idle) < self.warm:
+            try:
+                self._idle.append(await Sandbox.start())
+            except Exception as e:
+                logger.error("Could not start warm sandbox: %s", e)
+                return
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(sandbox.close() for sandbox in idle), return_exceptions=True)
+
+
+sandbox_pool = SandboxPool()
+
+
+def choose_execution_mode(df: pd.DataFrame, mode: str = EXECUTION_MODE) -> str:
+    """
+    local | remote. En auto, los datasets moderados se analizan en local y los pesados en el contenedor remoto.
+    """
+    if mode == "remote" or not isolation_available():
+        return "remote"
+    if mode == "local":
+        return mode
+    if len(df) > LOCAL_EXEC_MAX_ROWS:
+        return "remote"
+    if df.memory_usage(deep=True).sum() > LOCAL_EXEC_MEMORY_MB * 1024 * 1024 * LOCAL_EXEC_MAX_MEMORY_RATIO:
+        return "remote"
+    return "local"
+
+
+def dataset_description(df: pd.DataFrame) -> str:
+    dtypes = ", ".join(f"{col} ({dtype})" for col, dtype in df.dtypes.astype(str).items())
+    return f"Rows: {len(df)}\nColumns: {dtypes}\nFirst rows (pipe-separated):\n{encode_table(df.head(5))}"
+
+
+def tool_result(result: dict) -> str:
+    parts = []
+    if result.get("stdout"):
+        parts.append(result["stdout"])
+    if result.get("error"):
+        parts.append("Error:\n" + result["error"])
+    if result.get("files"):
+        parts.append("Files saved for the user: " + ", ".join(result["files"]))
+    return "\n".join(parts) or "(no output)"
+
+
+async def run_local_analysis(prompt: str, df: pd.DataFrame, channel: str, user: str, threadts: str,
+                             model: str = "claude-sonnet-4-5-20250929", cache_key: str = None) -> str:
+    """
+    Bucle de tool use con el DataFrame ya cargado en un sandbox local: sin subida a la Files API
+    ni arranque del contenedor remoto. Lanza SandboxError si el sandbox falla (el llamante usa el remoto).
+    """
+    with span("sandbox_acquire"):
+        sandbox = await sandbox_pool.acquire()
+    try:
+        with span("sandbox_load", rows=len(df)):
+            await sandbox.load(df)
+        await update_message(channel=channel, ts=threadts, new_text="🔬Analyzing...")
+        system = [{"type": "text", "text": (
+            "You are a data analyst. Answer the user's question by analysing the dataset with the run_python tool. "
+            "Keep the final answer concise (approximately 60-per-cent condensed) but retain the essential details.\n\n"
+            + dataset_description(df))}]
+        messages = [{"role": "user", "content": prompt}]
+        files, usage = [], {"input_tokens": 0, "output_tokens": 0, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+        output_text = ""
+        for turn in range(LOCAL_EXEC_MAX_TURNS):
+            progress = ProgressiveMessage(channel, threadts)
+            try:
+                response = await local_analysis_call(model, system, messages, [PYTHON_TOOL], on_text=progress.on_text)
+            finally:
+                await progress.close()
+            for kind in usage:
+                usage[kind] += getattr(response.usage, kind, 0) or 0
+            text_blocks = [block.text for block in response.content if getattr(block, "type", None) == "text"]
+            output_text = (text_blocks[-1] if text_blocks else output_text).strip()
+            tool_uses = [block for block in response.content if getattr(block, "type", None) == "tool_use"]
+            if response.stop_reason != "tool_use" or not tool_uses:
+                break
+            messages.append({"role": "assistant", "content": response.content})
+            results = []
+            for block in tool_uses:
+                with span("sandbox_exec"):
+                    result = await sandbox.run(block.input.get("code", ""))
+                files += [name for name in result.get("files", []) if name not in files]
+                results.append({"type": "tool_result", "tool_use_id": block.id, "content": tool_result(result),
+                                "is_error": bool(result.get("error"))})
+            messages.append({"role": "user", "content": results})
+        else:
+            logger.warning("Local analysis hit %s turns", LOCAL_EXEC_MAX_TURNS)
+        artifacts = []
+        for name in files:
+            content = await sandbox.read_output(name)
+            if content is not None:
+                artifacts.append({"filename": os.path.basename(name), "content": content})
+    finally:
+        await sandbox_pool.release(sandbox)
+
+    token_str = calculate_tokens_str(SimpleNamespace(model=model, usage=SimpleNamespace(**usage)))
+    output = format_for_slack(output_text + token_str)
+    if cache_key:
+        await answer_cache.put(cache_key, output_text, artifacts)
+    if not artifacts:
+        return output
+    final_ids = await asyncio.gather(*(uploadFiles(f["content"], f["filename"], len(f["content"])) for f in artifacts))
+    await completeUpload(channel, threadts, [{"id": id, "title": f["filename"]} for id, f in zip(final_ids, artifacts)], output)
+    return "Analysis Completed"
@@ -1,17 +1,147 @@
-from fastapi import FastAPI, Request, BackgroundTasks
-from app.slack_events import handler
+import asyncio
+import hmac
+import importlib
+import sys
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from app import logger, WARMUP, REPORTS_TOKEN, SHUTDOWN_GRACE_SECONDS
+from app.workers import enqueue, start_workers, stop_workers, queue_stats
+from app.utils_slack.validators import is_valid_message_event
+from app.utils_slack.thread_history import thread_history
+from app.metrics import render_metrics, register_gauge
+from app.thread_state import cleanup_loop, thread_store
+from app.warmup import warm_up, record_ready, startup
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_workers()
+    cleanup_task = asyncio.create_task(cleanup_loop())
+    warmup_task = asyncio.create_task(warm_up()) if WARMUP else None
+    record_ready()
+    yield
+    cleanup_task.cancel()
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await asyncio.gather(stop_workers(), stop_background_tasks())
+    await thread_store.flush()
+    if "app.local_executor" in sys.modules:
+        await sys.modules["app.local_executor"].sandbox_pool.close()
+    if "app.utils_slack.slack_utils" in sys.modules:
+        # Después de drenar la cola y los informes: nadie más va a llamar a Slack
+        await sys.modules["app.utils_slack.slack_utils"].transport.close()
+
+
+app = FastAPI(lifespan=lifespan)
+background_tasks = set()  # informes batch en curso (referencia fuerte hasta que terminen)
+
+
+async def stop_background_tasks(grace: float = SHUTDOWN_GRACE_SECONDS):
+    """Al parar se da a los informes batch el mismo margen que a la cola; los que no terminan se cancelan."""
+    if not background_tasks:
+        return
+    done, pending = await asyncio.wait(list(background_tasks), timeout=grace)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning("🛑 Shutdown: %s batch report runs cancelled (submitted batches are posted by /reports/batch/resume)", len(pending))
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def loaded(module: str):
+    """Módulo ya importado o None: /metrics no fuerza la carga del pipeline."""
+    return sys.modules.get(module)
+
+
+def slack_stats(key: str):
+    slack = loaded("app.utils_slack.slack_utils")
+    return {m: v.get(key, 0) for m, v in slack.transport.metrics().items()} if slack else None
+
+
+register_gauge("slackbot_queue", "Event queue and worker pool", queue_stats)
+register_gauge("slackbot_startup_seconds", "Cold start: import, ready and warm-up steps", lambda: startup)
+register_gauge("slackbot_query_cache", "Query cache counters", lambda: loaded("app.query_cache") and loaded("app.query_cache").query_cache.summary())
+register_gauge("slackbot_answer_cache", "Answer cache counters", lambda: loaded("app.answer_cache") and loaded("app.answer_cache").answer_cache.stats)
+register_gauge("slackbot_slack_calls", "Slack API calls per method", lambda: slack_stats("calls"))
+register_gauge("slackbot_slack_rate_limited", "Slack 429 responses per method", lambda: slack_stats("rate_limited"))
+register_gauge("slackbot_rollup", "In-memory rollup hits, fallthroughs and loaded rows", lambda: loaded("app.bigQuery") and loaded("app.bigQuery").rollup_store.metrics())
+register_gauge("slackbot_singleflight", "Work executed vs coalesced onto an identical in-flight call", lambda: loaded("app.singleflight") and loaded("app.singleflight").metrics())
+register_gauge("slackbot_thread_history", "Thread history cache hits, misses and messages seen", lambda: loaded("app.utils_slack.thread_history") and loaded("app.utils_slack.thread_history").thread_history.stats)
+register_gauge("slackbot_batch_reports", "Batch report runs and reports per outcome", lambda: loaded("app.batch_reports") and loaded("app.batch_reports").stats)
+register_gauge("slackbot_model_router", "Model choices per stage and step-downs", lambda: loaded("app.model_router") and loaded("app.model_router").model_router.metrics())
 
 
 @app.post("/slack/events")
-async def slack_events(req: Request, background_tasks: BackgroundTasks):
+async def slack_events(req: Request):
+    # Reintentos de Slack: el evento original ya fue aceptado, se descartan sin leer el body.
+    # Solo se dejan pasar los reintentos por http_error (nuestro 503 de backpressure).
+    retry_num = req.headers.get("x-slack-retry-num")
+    if retry_num and req.headers.get("x-slack-retry-reason") != "http_error":
+        logger.info("Dropping Slack retry #%s (%s)", retry_num, req.headers.get("x-slack-retry-reason"))
+        return {"ok": True}
     body = await req.json()
     if body.get("type") == "url_verification":
         print("Verification request from Slack")
         return {"challenge": body["challenge"]}
-    background_tasks.add_task(handler, body)
+    event = body.get("event", {})
+    if not is_valid_message_event(event):
+        # Ediciones (también las actualizaciones progresivas del propio bot), borrados y mensajes de bots:
+        # se aplican al historial aquí mismo, sin reclamar el event_id ni ocupar la cola
+        thread_history.observe(event)
+        return {"ok": True}
+    if not await enqueue(body):
+        # Sin hueco en la cola: Slack reintentará el evento más tarde
+        logger.warning("⏳ Queue full, rejecting event %s", body.get("event_id"))
+        return JSONResponse(status_code=503, content={"ok": False})
     return {"ok": True}
 
 
+def reports_authorized(req: Request) -> bool:
+    """Sin REPORTS_TOKEN configurado los endpoints de informes quedan cerrados."""
+    token = req.headers.get("x-reports-token") or ""
+    return bool(REPORTS_TOKEN) and hmac.compare_digest(token.encode(), REPORTS_TOKEN.encode())
+
+
+@app.post("/reports/batch")
+async def batch_reports(req: Request):
+    """
+    Lanza los informes semanales (Cloud Scheduler los lunes). Body opcional: channel, data_week, date_week.
+    Contesta enseguida; el batch se sigue en segundo plano y los informes llegan a Slack al terminar.
+    """
+    if not reports_authorized(req):
+        return JSONResponse(status_code=401, content={"ok": False})
+    body = await req.json() if await req.body() else {}
+    # Fuera del event loop, como el pipeline: importa pandas, BigQuery...
+    reports = await asyncio.to_thread(importlib.import_module, "app.batch_reports")
+    options = {key: body[key] for key in ("channel", "data_week", "date_week") if body.get(key)}
+    try:
+        reports.validate_snapshots(options.get("data_week"), options.get("date_week"))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
+
+    async def run():
+        try:
+            await reports.run_batch_reports(**options)
+        except Exception as e:
+            logger.error("❌ Batch reports failed: %s", e)
+
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return JSONResponse(status_code=202, content={"ok": True})
+
+
+@app.post("/reports/batch/resume")
+async def resume_batch_reports(req: Request):
+    """Cloud Scheduler cada pocos minutos: publica los batches guardados que ya han terminado."""
+    if not reports_authorized(req):
+        return JSONResponse(status_code=401, content={"ok": False})
+    reports = await asyncio.to_thread(importlib.import_module, "app.batch_reports")
+    done = await reports.resume_batches()
+    return {"ok": True, "posted": done}
+
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,216 @@
+import functools
+import json
+import time
+import uuid
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from app import logger
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+BYTES_BUCKETS = (1e6, 1e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9, 1e10)
+TOKEN_BUCKETS = (100, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000)
+_trace = ContextVar("trace", default=None)
+_span = ContextVar("span", default=None)
+
+
+class Histogram:
+    """Histograma acumulativo estilo Prometheus, con una serie por combinación de labels."""
+    def __init__(self, name: str, help_text: str, buckets: tuple, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._series = {}  # valores de labels -> [counts por bucket, sum, count]
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            position = bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    @staticmethod
+    def _labels(labels: list, bound) -> str:
+        le = bound if isinstance(bound, str) else f"{bound:g}"
+        return ",".join(labels + [f'le="{le}"'])
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, (counts, total, count) in series:
+            labels = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{{{self._labels(labels, bound)}}} {cumulative}")
+            lines.append(f"{self.name}_bucket{{{self._labels(labels, '+Inf')}}} {count}")
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total:g}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {key: {"count": count, "sum": total} for key, (_, total, count) in self._series.items()}
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            self._values[key] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            labels = ",".join(f'{label}="{v}"' for label, v in zip(self.labels, key))
+            lines.append(f"{self.name}{{{labels}}} {value:g}" if labels else f"{self.name} {value:g}")
+        return lines
+
+
+stage_seconds = Histogram("slackbot_stage_duration_seconds", "Duration of each pipeline stage", LATENCY_BUCKETS, ("stage", "status"))
+bq_bytes = Histogram("slackbot_bigquery_bytes_processed", "Bytes processed per BigQuery job", BYTES_BUCKETS)
+llm_tokens = Histogram("slackbot_llm_tokens", "Tokens per LLM call", TOKEN_BUCKETS, ("model", "kind"))
+llm_cost = Counter("slackbot_llm_cost_eur_total", "Estimated LLM cost in EUR", ("model",))
+llm_tokens_total = Counter("slackbot_llm_tokens_total", "LLM tokens", ("model", "kind"))
+request_cost = Histogram("slackbot_request_cost_eur", "LLM cost per answered question in EUR", (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+METRICS = [stage_seconds, bq_bytes, llm_tokens, llm_tokens_total, llm_cost, request_cost]
+_gauges = {}  # nombre -> función que devuelve {labels: valor} o un número
+_trace_sinks = []  # callbacks que reciben cada traza terminada (benchmark)
+
+
+def add_trace_sink(fn):
+    _trace_sinks.append(fn)
+
+
+def register_gauge(name: str, help_text: str, fn):
+    _gauges[name] = (help_text, fn)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for name, (help_text, fn) in _gauges.items():
+        try:
+            values = fn()
+        except Exception as e:
+            logger.error("Gauge %s failed: %s", name, e)
+            continue
+        if values is None:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        if isinstance(values, dict):
+            lines += [f'{name}{{key="{key}"}} {float(value):g}' for key, value in values.items() if isinstance(value, (int, float))]
+        else:
+            lines.append(f"{name} {float(values):g}")
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """
+    Mide una etapa: histograma por stage y, si hay traza activa, entrada en la traza de la petición.
+    Se puede anotar el span devuelto (p.ej. bytes procesados).
+    """
+    record = {"stage": stage, **attrs}
+    token = _span.set(record)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield record
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        _span.reset(token)
+        record["ms"] = round(elapsed * 1000, 1)
+        if status != "ok":
+            record["status"] = status
+        stage_seconds.observe(elapsed, stage=stage, status=status)
+        trace = _trace.get()
+        if trace is not None:
+            trace["spans"].append(record)
+
+
+def timed(stage: str):
+    """Decorador de span para funciones async."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attrs):
+    """Añade atributos al span en curso (no hace nada fuera de un span)."""
+    record = _span.get()
+    if record is not None:
+        record.update(attrs)
+
+
+def record_bytes_processed(value):
+    if value is None:
+        return
+    bq_bytes.observe(value)
+    annotate(bytes_processed=int(value))
+
+
+def record_llm_usage(model: str, input_tokens: int, output_tokens: int, cost_eur: float, cache_read: int = 0, cache_write: int = 0):
+    for kind, tokens in (("input", input_tokens), ("output", output_tokens), ("cache_read", cache_read), ("cache_write", cache_write)):
+        if tokens:
+            llm_tokens.observe(tokens, model=model, kind=kind)
+            llm_tokens_total.inc(tokens, model=model, kind=kind)
+    llm_cost.inc(cost_eur, model=model)
+    annotate(model=model, input_tokens=input_tokens, output_tokens=output_tokens, cost_eur=round(cost_eur, 5))
+    trace = _trace.get()
+    if trace is not None:
+        trace["input_tokens"] += input_tokens
+        trace["output_tokens"] += output_tokens
+        trace["cost_eur"] += cost_eur
+
+
+def start_trace(**attrs):
+    trace = {"trace_id": uuid.uuid4().hex[:16], **attrs, "spans": [], "input_tokens": 0, "output_tokens": 0, "cost_eur": 0.0}
+    return _trace.set(trace)
+
+
+def current_trace():
+    return _trace.get()
+
+
+def finish_trace(token):
+    """Cierra la traza y la escribe como una sola línea JSON."""
+    trace = _trace.get()
+    _trace.reset(token)
+    if trace is None:
+        return
+    trace["cost_eur"] = round(trace["cost_eur"], 5)
+    if trace["cost_eur"]:
+        request_cost.observe(trace["cost_eur"])
+    logger.info("TRACE %s", json.dumps(trace, default=str))
+    for sink in _trace_sinks:
+        try:
+            sink(trace)
+        except Exception as e:
+            logger.error("Trace sink failed: %s", e)
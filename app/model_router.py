@@ -0,0 +1,149 @@
+import re
+import time
+from collections import defaultdict, deque
+import pandas as pd
+from app import logger, USER_DAILY_BUDGET_EUR, THREAD_BUDGET_EUR, BUDGET_STEP_DOWN_RATIO
+from app.thread_state import current_thread_state, current_user, thread_store
+
+HAIKU = "claude-haiku-4-5-20251001"
+SONNET = "claude-sonnet-4-5-20250929"
+OPUS = "claude-opus-4-1-20250805"
+USD_TO_EUR = 0.86
+BATCH_DISCOUNT = 0.5  # la Message Batches API cobra la mitad de input y output
+
+# $ por millón de tokens: input, output, escritura y lectura de prompt cache
+MODEL_PRICES = {
+    HAIKU: {"input": 1.0, "output": 5.0, "cache_write": 1.25, "cache_read": 0.10},
+    SONNET: {"input": 3.0, "output": 15.0, "cache_write": 3.75, "cache_read": 0.30},
+    OPUS: {"input": 15.0, "output": 75.0, "cache_write": 18.75, "cache_read": 1.50},
+}
+
+# Candidatos por etapa, del más barato/rápido al más capaz, y complejidad a partir de la que se sube de modelo
+STAGE_MODELS = {
+    "routing": [HAIKU],
+    "simple_answer": [HAIKU, SONNET],
+    "analysis": [HAIKU, SONNET],
+}
+STAGE_STEP_UP = {"simple_answer": 3, "analysis": 1}
+STAGE_SLO_SECONDS = {"routing": 5, "simple_answer": 20, "analysis": 90}
+LATENCY_WINDOW = 50
+LATENCY_MIN_SAMPLES = 10
+LATENCY_MAX_AGE_SECONDS = 600  # un modelo descartado por latencia vuelve a probarse cuando caducan sus muestras
+COMPLEX_HINTS = re.compile(
+    r"\b(compar\w*|vs|versus|trend\w*|forecast\w*|why|explain\w*|driver\w*|yoy|wow|growth|correlat\w*|"
+    r"chart|plot|graph\w*|breakdown|evolution|rank\w*|variance|margin\w*|cohort\w*)\b", re.IGNORECASE)
+
+
+def model_price(model: str) -> dict:
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    # Alias o snapshots nuevos del mismo modelo (claude-sonnet-4-5, claude-haiku-4-5-latest...)
+    for family, known in (("haiku", HAIKU), ("sonnet", SONNET), ("opus", OPUS)):
+        if family in (model or ""):
+            return MODEL_PRICES[known]
+    logger.warning("No price table for model %s, using Sonnet prices", model)
+    return MODEL_PRICES[SONNET]
+
+
+def cost_eur(model: str, input_tokens: int, output_tokens: int, cache_write: int = 0, cache_read: int = 0) -> dict:
+    price = model_price(model)
+    input_cost = (input_tokens * price["input"] + cache_write * price["cache_write"] + cache_read * price["cache_read"]) * USD_TO_EUR / 1000000
+    output_cost = output_tokens * price["output"] * USD_TO_EUR / 1000000
+    return {"input_cost": input_cost, "output_cost": output_cost, "total_cost": input_cost + output_cost}
+
+
+def latest_message(question: str) -> str:
+    """user_question trae el historial del hilo ("[fecha] texto" por línea): la última línea es la pregunta actual."""
+    lines = [line for line in (question or "").strip().splitlines() if line.strip()]
+    return re.sub(r"^\s*\[[^\]]*\]\s*", "", lines[-1]) if lines else ""
+
+
+def question_complexity(question: str, df: pd.DataFrame = None, state=None) -> int:
+    text = latest_message(question)
+    score = min(2, len(COMPLEX_HINTS.findall(text)))
+    if len(text) > 200:
+        score += 1
+    if df is not None:
+        if len(df) > 1000:
+            score += 1
+        if len(df.columns) > 8:
+            score += 1
+    # Un hilo largo suele ser el usuario refinando una respuesta que no le convenció
+    if state is not None and len(state.messages) > 2:
+        score += 1
+    return score
+
+
+class ModelRouter:
+    """
+    Elige el modelo de cada etapa según la complejidad de la pregunta, el tamaño del resultado y el hilo,
+    y baja al modelo barato/rápido si el usuario o el hilo están cerca del presupuesto o si el modelo
+    incumple el SLO de latencia. El gasto diario por usuario vive en thread_store (compartido entre instancias).
+    """
+    def __init__(self, user_daily_budget: float = USER_DAILY_BUDGET_EUR, thread_budget: float = THREAD_BUDGET_EUR,
+                 step_down_ratio: float = BUDGET_STEP_DOWN_RATIO):
+        self.user_daily_budget = user_daily_budget
+        self.thread_budget = thread_budget
+        self.step_down_ratio = step_down_ratio
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))  # (stage, model) -> (monotonic, segundos)
+        self.stats = defaultdict(int)
+
+    def user_spend(self, user: str) -> float:
+        return thread_store.user_spend(user)
+
+    def budget_pressure(self, state, user: str = None) -> str:
+        if self.user_daily_budget and user and self.user_spend(user) >= self.user_daily_budget * self.step_down_ratio:
+            return "user daily budget"
+        if state is None:
+            return ""
+        if self.thread_budget and state.cost_eur >= self.thread_budget * self.step_down_ratio:
+            return "thread budget"
+        return ""
+
+    def latency_p90(self, stage: str, model: str):
+        oldest = time.monotonic() - LATENCY_MAX_AGE_SECONDS
+        samples = [seconds for at, seconds in self._latencies.get((stage, model), ()) if at >= oldest]
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+    def choose(self, stage: str, question: str = "", df: pd.DataFrame = None) -> str:
+        """question: la pregunta del usuario tal cual, no el prompt con contexto añadido."""
+        candidates = STAGE_MODELS[stage]
+        state = current_thread_state()
+        complexity = question_complexity(question, df, state)
+        index = len(candidates) - 1 if complexity >= STAGE_STEP_UP.get(stage, 99) else 0
+        reason = f"complexity {complexity}"
+        pressure = self.budget_pressure(state, current_user())
+        if pressure and index > 0:
+            index = 0
+            reason = f"step down: close to {pressure}"
+            self.stats["step_down_budget"] += 1
+        while index > 0:
+            p90 = self.latency_p90(stage, candidates[index])
+            if p90 is None or p90 <= STAGE_SLO_SECONDS[stage] * self.step_down_ratio:
+                break
+            index -= 1
+            reason = f"step down: p90 {p90:.1f}s close to SLO {STAGE_SLO_SECONDS[stage]}s"
+            self.stats["step_down_latency"] += 1
+        model = candidates[index]
+        self.stats[f"{stage}:{model}"] += 1
+        logger.debug("🧭 Model for %s: %s (%s)", stage, model, reason)
+        return model
+
+    def record(self, stage: str, model: str, cost: float, seconds: float = None):
+        """Gasto del usuario que pregunta (por día) y del hilo en curso, y latencia observada por etapa y modelo."""
+        state, user = current_thread_state(), current_user()
+        if state is not None:
+            state.add_cost(cost)
+        if user:
+            thread_store.add_user_cost(user, cost)
+        if stage and seconds is not None:
+            self._latencies[(stage, model)].append((time.monotonic(), seconds))
+
+    def metrics(self) -> dict:
+        return dict(self.stats)
+
+
+model_router = ModelRouter()
@@ -0,0 +1,153 @@
+import asyncio
+import pandas as pd
+from app import logger
+from app.bigQuery import run_plan, result_notes
+from app.clients import toplinePlan, TOPLINE_TABLE
+from app.profit_and_loss import pnlPlan, PNL_TABLE
+from app.intent import prefetched_filters
+from app.execution_code import run_code_execution
+from app.answer_cache import answer_key
+from app.answer_router import with_notes, notes_for_user
+
+TOPLINE_METRICS = ["revenue", "gross_profit"]
+# Dimensiones que nunca se suman entre sí: tipo de dato (actuals, forecast...) y snapshot (semana de carga)
+SLICE_COLUMNS = ["data_type", "date_week", "week_label"]
+MULTI_TABLE_NOTE = (
+    "\n\nThe attached dataset combines two tables aligned on {keys}: "
+    "detailed_topline metrics ({topline}) and profitAndLoss items (columns prefixed with pnl_, one per item). "
+    "When a table has several data types or snapshots that are not alignment keys, its columns carry them "
+    "as suffixes (e.g. pnl_Revenues_actuals, revenue_2025_39). "
+    "Rows only present in one of the tables have empty values for the other one."
+)
+
+
+def normalize_time_dimensions(df: pd.DataFrame, table: str) -> pd.DataFrame:
+    """
+    Lleva las dimensiones de tiempo de ambas tablas al mismo formato: year/month enteros y semana "YYYY_WW".
+    data_type pasa a minúsculas ("Actuals" en el P&L, "actuals" en topline).
+    """
+    df = df.copy()
+    if table == TOPLINE_TABLE:
+        if "month" in df.columns:
+            month = pd.to_datetime(df["month"].astype(str), errors="coerce")
+            df["year"] = month.dt.year.astype("Int64")
+            df["month"] = month.dt.month.astype("Int64")
+        if "data_week" in df.columns:
+            week = pd.to_datetime(df["data_week"].astype(str), errors="coerce").dt.isocalendar()
+            df["date_week"] = week["year"].astype(str) + "_" + week["week"].astype(str).str.zfill(2)
+    else:
+        # year viene como "2,025" y month como "1".."12"
+        if "year" in df.columns:
+            df["year"] = pd.to_numeric(df["year"].astype(str).str.replace(",", ""), errors="coerce").astype("Int64")
+        if "month" in df.columns:
+            df["month"] = pd.to_numeric(df["month"].astype(str), errors="coerce").astype("Int64")
+        if "date_week" in df.columns:
+            df["date_week"] = df["date_week"].astype(str)
+    if "country" in df.columns:
+        df["country"] = df["country"].astype(str)
+    if "data_type" in df.columns:
+        df["data_type"] = df["data_type"].astype(str).str.strip().str.lower().str.replace(r"\s+", "_", regex=True)
+    return df
+
+
+def join_keys(topline: pd.DataFrame, pnl: pd.DataFrame) -> list:
+    keys = ["country"] if "country" in topline.columns and "country" in pnl.columns else []
+    if {"year", "month"} <= set(topline.columns) & set(pnl.columns):
+        keys += ["year", "month"]
+    elif "date_week" in topline.columns and "date_week" in pnl.columns:
+        keys.append("date_week")
+    return keys
+
+
+def slice_columns(df: pd.DataFrame, keys: list) -> list:
+    """Tipos de dato y snapshots con más de un valor que no son clave: no se pueden sumar, van a columnas."""
+    columns = [col for col in SLICE_COLUMNS if col in df.columns and col not in keys]
+    if "date_week" in df.columns and "week_label" in columns:
+        columns.remove("week_label")  # misma carga que date_week
+    return [col for col in columns if df[col].nunique(dropna=False) > 1]
+
+
+def widen(df: pd.DataFrame, keys: list, pivot: list, values, prefix: str = "") -> pd.DataFrame:
+    """
+    Suma `values` por keys + pivot y pasa pivot a columnas: prefix_valor1_valor2. Con `values` str el nombre
+    de la métrica no entra en la columna (pnl_Revenues_actuals); con una lista sí (revenue_actuals).
+    """
+    grouped = df.groupby(keys + pivot, dropna=False, observed=True)[values].sum()
+    if pivot:
+        grouped = grouped.unstack(pivot)
+    elif isinstance(values, str):
+        grouped = grouped.to_frame(prefix)
+        prefix = ""
+    names = []
+    for col in grouped.columns:
+        parts = [prefix] + [str(part) for part in (col if isinstance(col, tuple) else (col,))]
+        names.append("_".join(part for part in parts if part))
+    grouped.columns = names
+    return grouped.reset_index()
+
+
+def align_datasets(topline: pd.DataFrame, pnl: pd.DataFrame) -> tuple:
+    """
+    Agrega cada tabla a las dimensiones comunes y las une (outer). Las partidas del P&L pasan a columnas.
+    data_type y el snapshot son clave si están en ambas tablas con valores comunes; si no, sufijos de columna.
+    Devuelve (df, claves usadas).
+    """
+    topline = normalize_time_dimensions(topline, TOPLINE_TABLE)
+    pnl = normalize_time_dimensions(pnl, PNL_TABLE)
+    keys = join_keys(topline, pnl)
+    if not keys:
+        # Sin dimensiones comunes no se puede alinear: se apilan con una columna de origen
+        logger.debug("No shared dimensions, stacking datasets")
+        return pd.concat([topline.assign(source="detailed_topline"), pnl.assign(source="profitAndLoss")], ignore_index=True), []
+    for col in ("data_type", "date_week"):
+        if col in topline.columns and col in pnl.columns and col not in keys \
+                and set(topline[col].dropna()) & set(pnl[col].dropna()):
+            keys.append(col)
+    metrics = [m for m in TOPLINE_METRICS if m in topline.columns]
+    left = widen(topline, keys, slice_columns(topline, keys), metrics)
+    right_slices = slice_columns(pnl, keys)
+    if "item" in pnl.columns:
+        right = widen(pnl, keys, ["item"] + right_slices, "amount", "pnl")
+    else:
+        right = widen(pnl, keys, right_slices, "amount", "pnl_amount")
+    combined = left.merge(right, on=keys, how="outer").sort_values(keys, ignore_index=True)
+    return combined, keys
+
+
+def combined_filters(topline_filters: dict, pnl_filters: dict) -> dict:
+    """Filtros de ambas tablas con prefijo, para la clave de la answer cache."""
+    filters, metrics = {}, []
+    for prefix, plan_filters in (("topline", topline_filters), ("pnl", pnl_filters)):
+        filters.update({f"{prefix}.{col}": vals for col, vals in (plan_filters.get("filters") or {}).items()})
+        metrics += [f"{prefix}.{m}" for m in plan_filters.get("metrics") or []]
+    return {"filters": filters, "metrics": metrics}
+
+
+async def multiTableLogic(first_response, user_question: str, channel: str, user: str, threadts: str) -> str:
+    """
+    Una query por tabla, lanzadas a la vez: la latencia es la de la más lenta, no la suma.
+    """
+    async def plan_pnl():
+        return await pnlPlan(user_question, await prefetched_filters(first_response, "pnl_query"))
+
+    (topline_plan, question), (pnl_plan, message) = await asyncio.gather(
+        toplinePlan(first_response, user_question), plan_pnl())
+    if topline_plan is None:
+        return question
+    if pnl_plan is None:
+        return message
+    topline_df, pnl_df = await asyncio.gather(run_plan(topline_plan, TOPLINE_TABLE), run_plan(pnl_plan, PNL_TABLE))
+    logger.debug("Multi-table shapes: topline %s, pnl %s", topline_df.shape, pnl_df.shape)
+    if topline_df.empty and pnl_df.empty:
+        return "No data available."
+    notes = result_notes(topline_df, topline_plan) + result_notes(pnl_df, pnl_plan)
+    truncated = topline_df.attrs.get("truncated") or pnl_df.attrs.get("truncated")
+    df, keys = align_datasets(topline_df, pnl_df)
+    logger.debug("🔗 Combined dataset on %s: %s", keys or "no shared keys", df.shape)
+    prompt = with_notes(question + MULTI_TABLE_NOTE.format(
+        keys=", ".join(keys) or "no shared dimensions (see the source column)",
+        topline=", ".join(m for m in TOPLINE_METRICS if m in df.columns) or "none"), notes)
+    file_requested = first_response.get("file_requested", "no")
+    cache_key = None if truncated else \
+        await answer_key(combined_filters(topline_plan["filters"], pnl_plan["filters"]), df, file_requested, user_question)
+    return notes_for_user(await run_code_execution(prompt, df, channel, user, threadts, cache_key=cache_key, question=user_question), notes)
@@ -1,37 +1,38 @@
 import json
 from app import PROMPTS_PATH, logger
 from app.utils_slack.slack_utils import send_message, update_message
-from app.llms import call_claude_with_prompt, load_prompt
+from app.llms import call_claude_with_prompt, render_prompt
 from app.clients import clientLogic
 from app.profit_and_loss import pnlLogic
+from app.multi_table import multiTableLogic
+from app.intent import classify_question, prefetched_filters
 
-def process_question(user_question: str, channel:str, user:str, threadts: str) -> str:
+async def process_question(user_question: str, channel:str, user:str, threadts: str) -> str:
     try:
         #logger.debug("User History: %s", user_question)
-        first_response = call_claude_with_prompt(
-            load_prompt(PROMPTS_PATH + "first_response_copy.txt", user_input = user_question)
-            )
-        logger.debug("🧠 Queryable JSON: %s", json.dumps(first_response))
+        first_response = await classify_question(user_question)
+        logger.debug("🧠 Queryable JSON: %s", json.dumps(first_response, default=str))
         if (first_response["proceed"] == "no"): ##if (first_response["proceed"] == "no"):
-            send_message(channel, first_response["reply_to_user"], threadts)
+            await send_message(channel, first_response["reply_to_user"], threadts)
             return
-        threadts = send_message(channel=channel, thread_ts=threadts, text="💭 Thinking...")
+        threadts = await send_message(channel=channel, thread_ts=threadts, text="💭 Thinking...")
         #"""
         tables = first_response["tables"]
         if len(tables) > 1:
-            logger.debug("Multiple-table logic not implemented")
-            output = "Multiple-table logic not implemented"
-            update_message(channel, threadts, output)
+            logger.debug("Multi-table Logic")
+            output = await multiTableLogic(first_response, user_question, channel, user, threadts)
+            await update_message(channel, threadts, output)
             return
         elif tables[0] == "profitAndLoss":
             logger.debug("General Logic")
-            output = pnlLogic(user_question, channel, user, threadts)
-            update_message(channel, threadts, output)
+            pnl_filters = await prefetched_filters(first_response, "pnl_query")
+            output = await pnlLogic(user_question, channel, user, threadts, first_response.get("file_requested", "no"), pnl_filters)
+            await update_message(channel, threadts, output)
             return
         elif tables[0] == "detailed_topline":
             logger.debug("ToplineLogic")
-            output = clientLogic(first_response, user_question, channel, user, threadts)
-            update_message(channel, threadts, output)
+            output = await clientLogic(first_response, user_question, channel, user, threadts)
+            await update_message(channel, threadts, output)
             return
         """
 
@@ -65,5 +66,5 @@ def process_question(user_question: str, channel:str, user:str, threadts: str) -
         """
 
     except Exception as e:
-        send_message(channel, f"Error procesando la pregunta: {e}", threadts)
+        await send_message(channel, f"Error procesando la pregunta: {e}", threadts)
         
@@ -1,24 +1,45 @@
 import json
-from app.execution_code import run_code_execution
+from app.answer_router import answer
 from app import PROMPTS_PATH, logger
-from app.llms import call_claude_with_prompt, load_prompt
-from app.bigQuery import run_query, build_query
+from app.llms import call_claude_with_prompt, render_prompt
+from app.bigQuery import run_plan, plan_query, result_notes
 from datetime import date
 
-def pnlLogic(user_question: str, channel:str, user:str, threadts: str) -> str:
-    current_week = calculate_current_week()
-    filters_json = call_claude_with_prompt(load_prompt(PROMPTS_PATH + "query_pNl.txt", user_input=user_question, current_week=current_week))
-    logger.debug("🧠 Filters created: %s",json.dumps(filters_json))
-    allowed_columns = [
-        "country", "subsidiary", "year", "month", "date_week", "item", "data_type"
-    ]
-    sql = build_query(filters_json, "jt-prd-financial-pa.random_data.pnl_data", allowed_columns)
-    logger.debug(f"SQL generated:\n{sql}")
-    df = run_query(sql)
-    logger.debug("Shape:", df.shape)
-    output = run_code_execution(user_question, df, channel, user, threadts)
+PNL_TABLE = "jt-prd-financial-pa.random_data.pnl_data"
+PNL_COLUMNS = [
+    "country", "subsidiary", "year", "month", "date_week", "item", "data_type"
+]
+PNL_SCHEMA = """Source table: profit and loss
+- country: country code or HQ (ES, UK, CO, SE, DE, FR, BE, PT, US, HQ, NO)
+- subsidiary: subsidiary or business unit
+- year: four-digit year with a comma as thousand delimiter (e.g. 2,025)
+- month: month number (1-12)
+- date_week: ISO year-week of the load (e.g. 2025_39), the snapshot
+- item: P&L item (Revenues, Gross Profit, Personnel, OPEX, EBITDA...)
+- data_type: Actuals, Forecast or Action Plan (never add up different data types)
+- amount: value of the item, in euros or FTEs depending on the item"""
+
+async def pnlLogic(user_question: str, channel:str, user:str, threadts: str, file_requested: str = "no", filters_json: dict = None) -> str:
+    plan, message = await pnlPlan(user_question, filters_json)
+    if plan is None:
+        return message
+    df = await run_plan(plan, PNL_TABLE)
+    output = await answer(user_question, df, file_requested, channel, user, threadts, plan["filters"], schema=PNL_SCHEMA, notes=result_notes(df, plan))
     return output
 
+async def pnlPlan(user_question: str, filters_json: dict = None):
+    """
+    Filtros + plan de la query de P&L. Devuelve (plan, None) o (None, respuesta al usuario).
+    """
+    if filters_json is None:
+        current_week = calculate_current_week()
+        filters_json = await call_claude_with_prompt(render_prompt(PROMPTS_PATH + "query_pNl.txt", user_input=user_question, current_week=current_week))
+    logger.debug("🧠 Filters created: %s",json.dumps(filters_json))
+    plan = await plan_query(filters_json, PNL_TABLE, PNL_COLUMNS)
+    if plan["decision"] == "rejected":
+        return None, "⚠️ That question would scan too much data. Could you narrow it down (period, country, client...)?"
+    return plan, None
+
 def calculate_current_week() -> str:
     fecha = date.today()
     year, week, weekday = fecha.isocalendar()
@@ -0,0 +1,57 @@
+import os
+import re
+from threading import Lock
+from app import logger
+
+# Primer placeholder real ({user_input}), no las llaves escapadas ({{ }}) de los ejemplos JSON
+PLACEHOLDER = re.compile(r"(?<!\{)\{(\w+)\}(?!\})")
+
+
+class PromptTemplate:
+    """
+    Plantilla compilada: prefijo estático (cacheable en Anthropic) y sufijo con los placeholders.
+    """
+    def __init__(self, path: str, text: str, mtime: float):
+        self.path = path
+        self.mtime = mtime
+        match = PLACEHOLDER.search(text)
+        split_at = text.rfind("\n", 0, match.start()) + 1 if match else len(text)
+        self.static_prefix = text[:split_at].format()
+        self.dynamic_suffix = text[split_at:]
+        self.fields = set(PLACEHOLDER.findall(self.dynamic_suffix))
+        # Instrucciones sin la cabecera final de input ("---" + "[INPUT]", "##Input:"...), para componer prompts
+        separator = self.static_prefix.rfind("\n---")
+        self.instructions = (self.static_prefix[:separator] if separator > 0 else self.static_prefix).strip()
+
+    def render(self, **kwargs) -> str:
+        return self.static_prefix + self.dynamic_suffix.format(**kwargs)
+
+    def render_blocks(self, **kwargs) -> list:
+        blocks = []
+        if self.static_prefix:
+            blocks.append({"type": "text", "text": self.static_prefix, "cache_control": {"type": "ephemeral"}})
+        blocks.append({"type": "text", "text": self.dynamic_suffix.format(**kwargs)})
+        return blocks
+
+
+class PromptRegistry:
+    def __init__(self):
+        self._templates = {}
+        self._lock = Lock()
+
+    def get(self, path: str) -> PromptTemplate:
+        mtime = os.stat(path).st_mtime
+        template = self._templates.get(path)
+        if template is not None and template.mtime == mtime:
+            return template
+        with self._lock:
+            template = self._templates.get(path)
+            if template is None or template.mtime != mtime:
+                with open(path, encoding="utf-8") as f:
+                    template = PromptTemplate(path, f.read(), mtime)
+                self._templates[path] = template
+                logger.debug("Prompt compiled: %s (static %s chars)", path, len(template.static_prefix))
+        return template
+
+
+prompt_registry = PromptRegistry()
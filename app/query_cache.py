@@ -0,0 +1,112 @@
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from pathlib import Path
+import pandas as pd
+from app import logger, QUERY_CACHE_MAX_BYTES, QUERY_CACHE_DIR, QUERY_CACHE_DISK_MAX_BYTES
+
+
+def normalize_sql(sql: str) -> str:
+    sql = re.sub(r"--[^\n]*", " ", sql)
+    sql = re.sub(r"\s+", " ", sql).strip()
+    return sql.rstrip(";").strip()
+
+
+def table_from_sql(sql: str):
+    match = re.search(r"FROM\s+`([^`]+)`", sql, re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+def cache_key(sql: str, snapshot: str) -> str:
+    return hashlib.sha256(f"{snapshot}\n{normalize_sql(sql)}".encode("utf-8")).hexdigest()
+
+
+class QueryCache:
+    """
+    Cache de resultados en dos niveles: LRU en memoria acotada por bytes y ficheros Parquet en disco local.
+    """
+    def __init__(self, max_bytes: int = QUERY_CACHE_MAX_BYTES, cache_dir: str = QUERY_CACHE_DIR, disk_max_bytes: int = QUERY_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._memory = OrderedDict()  # key -> (df, size)
+        self.memory_bytes = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "disk_errors": 0}
+
+    def _remember(self, key: str, df: pd.DataFrame):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        if key in self._memory:
+            self.memory_bytes -= self._memory.pop(key)[1]
+        self._memory[key] = (df, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_bytes:
+            _, (_, evicted_size) = self._memory.popitem(last=False)
+            self.memory_bytes -= evicted_size
+            self.stats["evictions"] += 1
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.parquet"
+
+    def _read_disk(self, key: str):
+        path = self._path(key)
+        if not path.exists():
+            return None
+        os.utime(path)  # el mtime hace de marca LRU para el recorte del disco
+        return pd.read_parquet(path)
+
+    def _write_disk(self, key: str, df: pd.DataFrame):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path(key).with_suffix(".tmp")
+        df.to_parquet(tmp_path, index=False)
+        tmp_path.replace(self._path(key))
+        files = sorted(self.cache_dir.glob("*.parquet"), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files)
+        while files and total > self.disk_max_bytes:
+            oldest = files.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+
+    async def get(self, key: str):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return self._memory[key][0].copy()
+        if self.cache_dir is not None:
+            try:
+                df = await asyncio.to_thread(self._read_disk, key)
+            except Exception as e:
+                logger.error("Query cache disk read failed: %s", e)
+                self.stats["disk_errors"] += 1
+                df = None
+            if df is not None:
+                self.stats["disk_hits"] += 1
+                self._remember(key, df)
+                return df.copy()
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, df: pd.DataFrame):
+        self._remember(key, df)
+        if self.cache_dir is not None:
+            try:
+                await asyncio.to_thread(self._write_disk, key, df)
+            except Exception as e:
+                logger.error("Query cache disk write failed: %s", e)
+                self.stats["disk_errors"] += 1
+
+    def summary(self) -> dict:
+        lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        return {
+            **self.stats,
+            "entries": len(self._memory),
+            "memory_bytes": self.memory_bytes,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+query_cache = QueryCache()
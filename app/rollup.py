@@ -0,0 +1,225 @@
+import asyncio
+import re
+import time
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+from app import logger, ROLLUP_ENABLED, MAX_RESULT_ROWS
+
+# Tablas que se sirven desde memoria: columna de snapshot, etiquetas relativas a la carga, dimensiones y medidas
+ROLLUP_TABLES = {
+    "jt-prd-financial-pa.random_data.real_data": {
+        "snapshot": "data_week",
+        "labels": ["week_label"],
+        "dims": ["data_week", "week_label", "sfdc_name_l3", "am_name_l3", "country",
+                 "service_type_l3", "month", "customer_type", "cohort", "data_type"],
+        "measures": ["revenue", "gross_profit"],
+    },
+    "jt-prd-financial-pa.random_data.pnl_data": {
+        "snapshot": "date_week",
+        "labels": [],
+        "dims": ["country", "subsidiary", "year", "month", "date_week", "item", "data_type"],
+        "measures": ["amount"],
+    },
+}
+
+
+# Formato de cada columna de snapshot: lo que se interpola en SQL tiene que ajustarse exactamente
+SNAPSHOT_FORMATS = {"data_week": re.compile(r"^\d{4}-\d{2}-\d{2}$"), "date_week": re.compile(r"^\d{4}_\d{2}$")}
+
+
+def valid_snapshot(column: str, value) -> bool:
+    pattern = SNAPSHOT_FORMATS.get(column)
+    return pattern is not None and isinstance(value, str) and bool(pattern.match(value))
+
+
+def value_key(value) -> str:
+    """Valor tal y como llega entre comillas en el WHERE de build_query ('2025-09-29', '2024', 'ES')."""
+    if isinstance(value, (pd.Timestamp, datetime)) and value == value.replace(hour=0, minute=0, second=0, microsecond=0):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def filter_values(filters: dict) -> dict:
+    """Filtros de build_query normalizados: escalares a lista y vacíos fuera."""
+    where = {}
+    for col, vals in (filters.get("filters") or {}).items():
+        if vals is None or vals == "":
+            continue
+        if isinstance(vals, (int, float, str)):
+            vals = [vals]
+        where[col] = [value_key(v) for v in vals]
+    return where
+
+
+class RollupCube:
+    """
+    Un snapshot de una tabla pre-agregado por todas sus dimensiones. Cada dimensión se guarda codificada
+    con diccionario (códigos int + valores únicos ordenados, 0 = NULL) y cada medida como array float64 de
+    NumPy, con una máscara de valores no nulos (SUM de solo NULLs es NULL, como en BigQuery).
+    """
+    def __init__(self, table: str, snapshot: str, df: pd.DataFrame, dims: list, measures: list, labels: list = ()):
+        self.table = table
+        self.snapshot = snapshot
+        self.rows = len(df)
+        self.labels = list(labels)
+        self.codes, self.values, self.lookup = {}, {}, {}
+        for dim in dims:
+            column = df[dim]
+            if pd.api.types.is_float_dtype(column) and (column.dropna() % 1 == 0).all():
+                # INT64 con NULLs llega como float: 2024.0 no casaría con el filtro '2024'
+                column = column.astype("Int64")
+            codes, uniques = pd.factorize(column, sort=True)
+            dtype = np.int16 if len(uniques) < 2 ** 15 - 1 else np.int32
+            self.codes[dim] = (codes + 1).astype(dtype)
+            self.values[dim] = np.concatenate([np.array([None], dtype=object), np.asarray(uniques, dtype=object)])
+            self.lookup[dim] = {value_key(v): code for code, v in enumerate(self.values[dim]) if code}
+        raw = {m: pd.to_numeric(df[m], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan) for m in measures}
+        self.present = {m: ~np.isnan(values) for m, values in raw.items()}
+        self.measures = {m: np.nan_to_num(values) for m, values in raw.items()}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for group in (self.codes, self.measures, self.present) for a in group.values())
+
+    def serves(self, filters: dict, snapshot_column: str) -> bool:
+        """
+        Solo si el cubo tiene todas las filas que leería BigQuery: filtro de snapshot igual al cargado
+        (o etiquetas de semana presentes en él), dimensiones y medidas conocidas.
+        """
+        metrics = filters.get("metrics") or []
+        if not metrics or any(m not in self.codes and m not in self.measures for m in metrics):
+            return False
+        where = filter_values(filters)
+        if any(col not in self.codes for col in where):
+            return False
+        if snapshot_column in where:
+            return set(where[snapshot_column]) == {value_key(self.snapshot)}
+        # week_label es relativa a la carga: las etiquetas del snapshot cargado solo existen en él
+        labels = [col for col in self.labels if col in where]
+        return bool(labels) and all(v in self.lookup[col] for col in labels for v in where[col])
+
+    def query(self, filters: dict) -> pd.DataFrame:
+        """SELECT dims, SUM(medidas) ... WHERE dim IN (...) GROUP BY dims ORDER BY dims, con group-by vectorizado."""
+        metrics = filters["metrics"]
+        dims = [m for m in metrics if m in self.codes]
+        measures = [m for m in metrics if m in self.measures]
+        mask = np.ones(self.rows, dtype=bool)
+        for col, vals in filter_values(filters).items():
+            wanted = [self.lookup[col][v] for v in vals if v in self.lookup[col]]
+            mask &= np.isin(self.codes[col], wanted)
+        rows = np.flatnonzero(mask)
+        if not dims:
+            return pd.DataFrame({m: [self.measures[m][rows].sum() if self.present[m][rows].any() else None] for m in metrics})
+        # Clave combinada en base mixta: ordenarla equivale a ORDER BY dims (los diccionarios están ordenados)
+        sizes = [len(self.values[d]) for d in dims]
+        if np.prod(sizes, dtype=float) < 2 ** 62:
+            key = np.zeros(len(rows), dtype=np.int64)
+            for dim, size in zip(dims, sizes):
+                key = key * size + self.codes[dim][rows]
+            groups, inverse = np.unique(key, return_inverse=True)
+            group_codes = []
+            for size in reversed(sizes):
+                groups, code = np.divmod(groups, size)
+                group_codes.insert(0, code)
+        else:
+            stacked = np.stack([self.codes[d][rows] for d in dims], axis=1)
+            unique_rows, inverse = np.unique(stacked, axis=0, return_inverse=True)
+            group_codes = list(unique_rows.T)
+        inverse = inverse.ravel()
+        n_groups = len(group_codes[0])
+        out = {}
+        for m in metrics:
+            if m in self.measures:
+                sums = np.bincount(inverse, weights=self.measures[m][rows], minlength=n_groups)
+                present = np.bincount(inverse, weights=self.present[m][rows], minlength=n_groups)
+                out[m] = np.where(present > 0, sums, np.nan)
+            else:
+                out[m] = self.values[m][group_codes[dims.index(m)]]
+        return pd.DataFrame(out)
+
+
+class RollupStore:
+    """
+    Cubos en memoria del último snapshot de cada tabla. Se cargan una vez por snapshot con una sola query
+    agregada; mientras carga (o si no cabe) las preguntas siguen yendo a BigQuery.
+    """
+    def __init__(self, snapshot_fn, query_fn, tables: dict = ROLLUP_TABLES, enabled: bool = ROLLUP_ENABLED):
+        # query_fn debe devolver los resultados sin compactar (medidas en float64)
+        self.snapshot_fn = snapshot_fn
+        self.query_fn = query_fn
+        self.tables = tables
+        self.enabled = enabled
+        self._cubes = {}
+        self._loading = {}
+        self._failed = {}  # table -> snapshot que no se pudo cargar (no se reintenta hasta la siguiente carga)
+        self.stats = {"hits": 0, "fallthrough": 0, "loads": 0, "load_errors": 0}
+
+    def load_sql(self, table: str, snapshot: str) -> str:
+        spec = self.tables[table]
+        if not valid_snapshot(spec["snapshot"], snapshot):
+            raise ValueError(f"invalid {spec['snapshot']} snapshot {snapshot!r}")
+        dims = ", ".join(spec["dims"])
+        sums = ", ".join(f"SUM({m}) AS {m}" for m in spec["measures"])
+        return f"SELECT {dims}, {sums} FROM `{table}` WHERE {spec['snapshot']} = '{snapshot}' GROUP BY {dims}"
+
+    async def _load(self, table: str, snapshot: str):
+        started = time.perf_counter()
+        spec = self.tables[table]
+        try:
+            df = await self.query_fn(self.load_sql(table, snapshot))
+            if df.attrs.get("truncated") or len(df) >= MAX_RESULT_ROWS:
+                raise ValueError(f"{len(df)} rows, result may be truncated at MAX_RESULT_ROWS")
+            cube = await asyncio.to_thread(RollupCube, table, snapshot, df, spec["dims"], spec["measures"], spec["labels"])
+        except Exception as e:
+            logger.error("Could not load rollup for %s (%s): %s", table, snapshot, e)
+            self._failed[table] = snapshot
+            self.stats["load_errors"] += 1
+            return None
+        self._cubes[table] = cube
+        self.stats["loads"] += 1
+        logger.info("🧊 Rollup %s @ %s: %s rows, %.1f MB in %.0f ms", table, snapshot, cube.rows,
+                    cube.nbytes / 1024 ** 2, (time.perf_counter() - started) * 1000)
+        return cube
+
+    async def cube(self, table: str):
+        """Cubo del snapshot actual o None. Si falta, se carga en segundo plano sin hacer esperar a la pregunta."""
+        if not self.enabled or table not in self.tables:
+            return None
+        snapshot = await self.snapshot_fn(table)
+        if snapshot is None:
+            return None
+        cube = self._cubes.get(table)
+        if cube is not None and cube.snapshot == snapshot:
+            return cube
+        loading = self._loading.get(table)
+        if self._failed.get(table) != snapshot and (loading is None or loading.done()):
+            self._loading[table] = asyncio.create_task(self._load(table, snapshot))
+        return None
+
+    async def serves(self, table: str, filters: dict) -> bool:
+        cube = await self.cube(table)
+        return cube is not None and cube.serves(filters, self.tables[table]["snapshot"])
+
+    async def query(self, table: str, filters: dict):
+        """Resultado desde memoria, o None si hay que ir a BigQuery."""
+        cube = await self.cube(table)
+        if cube is None or not cube.serves(filters, self.tables[table]["snapshot"]):
+            self.stats["fallthrough"] += 1
+            return None
+        self.stats["hits"] += 1
+        return await asyncio.to_thread(cube.query, filters)
+
+    async def prewarm(self):
+        if not self.enabled:
+            return
+        for table in self.tables:
+            snapshot = await self.snapshot_fn(table)
+            cube = self._cubes.get(table)
+            if snapshot is not None and (cube is None or cube.snapshot != snapshot):
+                await self._load(table, snapshot)
+
+    def metrics(self) -> dict:
+        return {**self.stats, **{f"rows:{table.split('.')[-1]}": cube.rows for table, cube in self._cubes.items()}}
@@ -0,0 +1,140 @@
+"""
+Proceso sandbox del ejecutor local. app/local_executor.py lo lanza dentro de namespaces de red, mounts y pids
+propios y con un uid sin privilegios (`python -I sandbox_worker.py <memory_mb> <cpu_seconds>`); habla JSON por
+líneas: stdin recibe órdenes y el descriptor original de stdout las respuestas. Solo importa la librería
+estándar y las librerías de análisis, nunca el paquete app. Si el aislamiento no está, se niega a arrancar.
+"""
+import base64
+import contextlib
+import io
+import json
+import os
+import resource
+import socket
+import stat
+import sys
+import traceback
+
+MAX_OUTPUT_CHARS = 20000
+MAX_FILE_BYTES = 50 * 1024 * 1024
+
+
+def set_limits(memory_mb: int, cpu_seconds: int):
+    memory = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (MAX_FILE_BYTES, MAX_FILE_BYTES))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (256, 256))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    # Ni fork ni hilos nuevos: el uid es propio de este sandbox, así que cuenta solo sus tareas
+    tasks = len(os.listdir("/proc/self/task"))
+    resource.setrlimit(resource.RLIMIT_NPROC, (tasks, tasks))
+
+
+def check_isolation():
+    """Fail closed: sin root y sin más interfaz de red que loopback (namespace de red propio)."""
+    problems = []
+    if os.geteuid() == 0 or os.getuid() == 0:
+        problems.append("running as root")
+    interfaces = [name for _, name in socket.if_nameindex()]
+    if interfaces != ["lo"]:
+        problems.append(f"network interfaces {interfaces}")
+    if problems:
+        sys.stderr.write(f"sandbox isolation missing: {', '.join(problems)}\n")
+        sys.exit(3)
+
+
+def output_files(outputs: str) -> dict:
+    """Ficheros regulares de outputs/ con su mtime; los enlaces simbólicos y demás se ignoran (lstat)."""
+    files = {}
+    for name in os.listdir(outputs):
+        info = os.lstat(os.path.join(outputs, name))
+        if stat.S_ISREG(info.st_mode):
+            files[name] = info.st_mtime_ns
+    return files
+
+
+def read_output(outputs: str, name: str, max_bytes: int):
+    """Contenido de un fichero generado, sin seguir enlaces y solo si es regular y cabe en max_bytes."""
+    try:
+        fd = os.open(os.path.join(outputs, os.path.basename(name)), os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError:
+        return None
+    with os.fdopen(fd, "rb") as f:
+        info = os.fstat(f.fileno())
+        if not stat.S_ISREG(info.st_mode) or info.st_size > max_bytes:
+            return None
+        return f.read(max_bytes + 1)[:max_bytes]
+
+
+def save_open_figures(outputs: str):
+    """Las gráficas que el código deja abiertas sin guardar se exportan como PNG."""
+    plt = sys.modules.get("matplotlib.pyplot")
+    if plt is None:
+        return
+    for number in plt.get_fignums():
+        path = os.path.join(outputs, f"figure_{number}.png")
+        if not os.path.exists(path):
+            plt.figure(number).savefig(path, dpi=120, bbox_inches="tight")
+    plt.close("all")
+
+
+def main():
+    memory_mb, cpu_seconds = int(sys.argv[1]), int(sys.argv[2])
+    # Las respuestas van por una copia del stdout original; lo que escriba el código (o C) acaba en stderr
+    protocol = os.fdopen(os.dup(1), "w", buffering=1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    check_isolation()
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
+    # Un solo hilo de Arrow, y sus pools creados ahora (ida y vuelta a parquet) antes de limitar NPROC
+    pa.set_cpu_count(1)
+    pa.set_io_thread_count(1)
+    pd.read_parquet(io.BytesIO(pd.DataFrame({"x": [0]}).to_parquet()))
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot  # noqa: F401 (precarga)
+    except ImportError:
+        pass
+    set_limits(memory_mb, cpu_seconds)
+    outputs = os.path.join(os.getcwd(), "outputs")
+    os.makedirs(outputs, exist_ok=True)
+    namespace = {"pd": pd, "np": np, "df": None, "__name__": "__analysis__"}
+
+    def reply(message: dict):
+        protocol.write(json.dumps(message, default=str) + "\n")
+
+    reply({"ready": True})
+    for line in sys.stdin:
+        message = json.loads(line)
+        if message["op"] == "load":
+            namespace["df"] = pd.read_parquet(message["path"])
+            os.remove(message["path"])
+            reply({"ok": True, "shape": list(namespace["df"].shape)})
+        elif message["op"] == "exec":
+            before = output_files(outputs)
+            buffer = io.StringIO()
+            error = None
+            with contextlib.redirect_stdout(buffer), contextlib.redirect_stderr(buffer):
+                try:
+                    exec(compile(message["code"], "<analysis>", "exec"), namespace)
+                    save_open_figures(outputs)
+                except BaseException:
+                    error = traceback.format_exc(limit=-3)
+            output = buffer.getvalue()
+            if len(output) > MAX_OUTPUT_CHARS:
+                output = output[:MAX_OUTPUT_CHARS] + f"\n... [{len(output) - MAX_OUTPUT_CHARS} chars truncated]"
+            files = sorted(name for name, mtime in output_files(outputs).items() if before.get(name) != mtime)
+            reply({"ok": error is None, "stdout": output, "error": error, "files": files})
+        elif message["op"] == "read":
+            content = read_output(outputs, message["name"], message["max_bytes"])
+            reply({"ok": content is not None,
+                   "content": base64.b64encode(content).decode("ascii") if content is not None else None})
+
+
+if __name__ == "__main__":
+    main()
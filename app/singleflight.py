@@ -0,0 +1,70 @@
+import asyncio
+import hashlib
+import json
+from app import logger
+
+flights = {}  # nombre -> SingleFlight (gauge slackbot_singleflight)
+
+
+def flight_key(*parts) -> str:
+    """Hash estable de los argumentos de una llamada (prompts en bloques, modelo, fingerprints...)."""
+    payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Trabajo idéntico en curso se ejecuta una sola vez: quien llega con la misma clave mientras la primera
+    ejecución sigue en marcha espera su resultado (o su excepción) en vez de lanzar la suya.
+    Si se cancelan todos los que esperan, se cancela también la ejecución.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight = {}
+        self._waiters = {}  # task -> llamantes esperando
+        self.stats = {"executions": 0, "coalesced": 0, "errors": 0, "cancelled": 0}
+        flights[name] = self
+
+    async def do(self, key: str, fn, *args, **kwargs):
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+            logger.debug("🔗 %s coalesced (%s)", self.name, str(key)[:12])
+        else:
+            self.stats["executions"] += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # shield: si un llamante se cancela, los demás siguen esperando la misma ejecución
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    # Nadie espera ya el resultado (p.ej. filtros especulativos descartados): se cancela
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+                    task.cancel()
+                    self.stats["cancelled"] += 1
+
+    def _finished(self, key: str, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["errors"] += 1
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+
+def metrics() -> dict:
+    out = {}
+    for name, flight in flights.items():
+        for kind, value in flight.stats.items():
+            out[f"{name}:{kind}"] = value
+        out[f"{name}:in_flight"] = flight.in_flight
+    return out
@@ -1,15 +1,20 @@
 import json
+import asyncio
 from app.utils_slack.validators import is_valid_message_event, is_authorized_user
 from app.utils_slack.slack_utils import get_thread_history, send_message
+from app.utils_slack.thread_history import thread_history
 from app.processing import process_question
+from app.dedup import deduplicator
+from app.thread_state import thread_store, set_current_thread_state, reset_current_thread_state
+from app.metrics import span, start_trace, finish_trace
 from app import logger
 
-processed_events = set()
-
-def handler(body: dict):
+async def handler(body: dict):
     
     event = body.get("event", {})
     event_id = body.get("event_id")
+    # Las ediciones, borrados y mensajes de bots se aplican al historial en /slack/events sin llegar aquí
+    thread_history.observe(event)
 
     if not is_valid_message_event(event):
         #logger.info(event)
@@ -17,10 +22,9 @@ def handler(body: dict):
         return
 
     # Evita reprocesar el mismo evento
-    if event_id in processed_events:
+    if await deduplicator.is_duplicate(event_id):
         logger.warning("Duplicate event: %s", event_id)
         return
-    processed_events.add(event_id)
 
     logger.info("Processing event: %s", json.dumps(event))
     user, channel, text, thread_ts = (
@@ -36,9 +40,25 @@ def handler(body: dict):
 
     if not is_authorized_user(user):
         logger.warning("Unauthorized user: %s", user)
-        send_message(channel, "Under Maintenance.", thread_ts)
+        await send_message(channel, "Under Maintenance.", thread_ts)
         return
 
-    thread_text = get_thread_history(channel, thread_ts)
-    process_question(thread_text, channel, user, thread_ts)
+    trace_token = start_trace(event_id=event_id, channel=channel, user=user, thread_ts=thread_ts)
+    try:
+        with span("handler"):
+            thread_text, state, _ = await asyncio.gather(
+                get_thread_history(channel, thread_ts),
+                thread_store.load(thread_ts, channel, user),
+                thread_store.load_user_spend(user),
+            )
+            state.add_message(text)
+            token = set_current_thread_state(state, user)
+            try:
+                await process_question(thread_text, channel, user, thread_ts)
+            finally:
+                reset_current_thread_state(token)
+                thread_store.mark_dirty(state)
+                await thread_store.flush()
+    finally:
+        finish_trace(trace_token)
     return
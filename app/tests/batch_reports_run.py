@@ -0,0 +1,73 @@
+"""
+Informes batch de punta a punta con los fakes (app/tests/fakes.py): queries contra el BigQuery de SQLite,
+Message Batch contra el FakeBatches y publicación en el Slack falso. Imprime el hilo resultante.
+
+    python app/tests/batch_reports_run.py
+    python app/tests/batch_reports_run.py --latency-scale 0.5 --via-endpoint
+    python app/tests/batch_reports_run.py --resume   # sin espera en línea: publica /reports/batch/resume
+
+Se ejecuta como script (no con -m): los fakes tienen que instalarse antes de que se importe el paquete app.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import fakes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(fakes.TESTS_DIR)))  # raíz del repo, para importar app
+CHANNEL = "C_REPORTS"
+TOKEN = "reports-token"
+
+
+async def run(latency_scale: float, via_endpoint: bool, resume: bool) -> dict:
+    from app.batch_reports import run_batch_reports, stats
+    slack = fakes.attach_slack(latency_scale)
+    logging.getLogger().setLevel(logging.WARNING)
+    started = time.perf_counter()
+    if via_endpoint or resume:
+        import httpx
+        from app.main import app, background_tasks
+        headers = {"x-reports-token": TOKEN}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+            response = await client.post("/reports/batch", json={"channel": CHANNEL})
+            print(f"POST /reports/batch without token -> {response.status_code}")
+            response = await client.post("/reports/batch", json={"date_week": "2025_39' OR '1'='1"}, headers=headers)
+            print(f"POST /reports/batch with invalid date_week -> {response.status_code}")
+            if resume:
+                print(await run_batch_reports(channel=CHANNEL, poll_seconds=0.2, max_wait=0))
+                posted = []
+                while not posted:
+                    await asyncio.sleep(0.5)
+                    response = await client.post("/reports/batch/resume", headers=headers)
+                    posted = response.json()["posted"]
+                    print(f"POST /reports/batch/resume -> {response.status_code} {posted}")
+            else:
+                response = await client.post("/reports/batch", json={"channel": CHANNEL}, headers=headers)
+                print(f"POST /reports/batch -> {response.status_code}")
+                await asyncio.gather(*list(background_tasks))
+    else:
+        print(await run_batch_reports(channel=CHANNEL, poll_seconds=0.2))
+    print(f"done in {time.perf_counter() - started:.2f}s, stats {stats}")
+    for (channel, thread_ts), messages in slack.threads.items():
+        if channel == CHANNEL:
+            print(f"\n🧵 {channel} {thread_ts}: {len(messages)} messages")
+            for message in messages[:4]:
+                print("  -", message["text"].splitlines()[0][:100])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch reports with local fakes for Slack, Anthropic and BigQuery")
+    parser.add_argument("--latency-scale", type=float, default=0.2)
+    parser.add_argument("--via-endpoint", action="store_true", help="lanza los informes con POST /reports/batch")
+    parser.add_argument("--resume", action="store_true", help="no espera al batch: lo publica /reports/batch/resume")
+    args = parser.parse_args()
+    fakes.install(args.latency_scale)
+    os.environ.setdefault("BATCH_POLL_SECONDS", "0.2")
+    os.environ["REPORTS_TOKEN"] = TOKEN
+    asyncio.run(run(args.latency_scale, args.via_endpoint, args.resume))
+
+
+if __name__ == "__main__":
+    main()
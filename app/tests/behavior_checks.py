@@ -0,0 +1,235 @@
+"""
+Comprobaciones con asserts del comportamiento que prometen las peticiones, sobre los fakes (app/tests/fakes.py):
+backpressure de la cola y deduplicación de eventos, clave y aciertos de la answer cache, reutilización del
+dataset subido en un hilo y reanudación de los informes batch sin repetir los ya publicados.
+
+    python app/tests/behavior_checks.py
+    python app/tests/behavior_checks.py answer_cache batch_resume   # solo algunas
+
+Se ejecuta como script (no con -m): los fakes tienen que instalarse antes de que se importe el paquete app.
+Sale con código 1 si alguna comprobación falla.
+"""
+import asyncio
+import logging
+import os
+import sys
+import traceback
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import fakes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(fakes.TESTS_DIR)))  # raíz del repo, para importar app
+# Un worker y un hueco en la cola: el tercer evento a la vez tiene que rebotar con 503
+os.environ.update({"MAX_CONCURRENT_QUESTIONS": "1", "QUESTION_QUEUE_SIZE": "1", "ENQUEUE_TIMEOUT": "0.2", "WARMUP": "0",
+                   "EXECUTION_MODE": "remote"})
+LATENCY_SCALE = 0.01
+CHANNEL = "C_CHECKS"
+
+
+def message_body(event_id: str, text: str = "What is the revenue by country for 2025?", **event) -> dict:
+    from app import AUTHORIZED_USERS
+    return {"type": "event_callback", "event_id": event_id, "event": {
+        "type": "message", "user": AUTHORIZED_USERS[0], "channel": CHANNEL, "text": text, "ts": f"{event_id}.1", **event}}
+
+
+async def check_queue_backpressure():
+    """Cola llena -> 503 (Slack reintenta); el reintento por http_error se acepta y el resto se descarta."""
+    import httpx
+    from app import workers
+    from app.main import app
+    release, started = asyncio.Event(), asyncio.Event()
+    handled = []
+
+    async def blocking_handler(body):
+        handled.append(body["event_id"])
+        started.set()
+        await release.wait()
+
+    async def pipeline():
+        return blocking_handler
+
+    original, workers.load_pipeline = workers.load_pipeline, pipeline
+    try:
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://checks") as client:
+                assert (await client.post("/slack/events", json=message_body("Ev1"))).status_code == 200
+                await asyncio.wait_for(started.wait(), timeout=5)  # Ev1 ocupa el único worker
+                assert (await client.post("/slack/events", json=message_body("Ev2"))).status_code == 200  # a la cola
+                full = await client.post("/slack/events", json=message_body("Ev3"))
+                assert full.status_code == 503, f"queue full answered {full.status_code}"
+                # Reintento de Slack que no viene de un 503 nuestro: se descarta sin encolar
+                retry = await client.post("/slack/events", json=message_body("Ev2"),
+                                          headers={"x-slack-retry-num": "1", "x-slack-retry-reason": "http_timeout"})
+                assert retry.status_code == 200 and workers.event_queue.qsize() == 1
+                release.set()
+                await asyncio.wait_for(workers.event_queue.join(), timeout=5)
+                # El reintento del evento rechazado (http_error) entra cuando hay hueco
+                retry = await client.post("/slack/events", json=message_body("Ev3"),
+                                          headers={"x-slack-retry-num": "1", "x-slack-retry-reason": "http_error"})
+                assert retry.status_code == 200
+                await asyncio.wait_for(workers.event_queue.join(), timeout=5)
+    finally:
+        workers.load_pipeline = original
+        release.set()
+    assert handled == ["Ev1", "Ev2", "Ev3"], handled
+
+
+async def check_dedup():
+    """Un event_id se procesa una vez, también entre instancias que comparten backend; las ediciones no lo reclaman."""
+    from app.dedup import EventDeduplicator, MemoryDedupBackend
+    from app.utils_slack.validators import is_valid_message_event
+    shared = MemoryDedupBackend()
+    first, second = EventDeduplicator(shared, ttl=60), EventDeduplicator(shared, ttl=60)
+    assert not await first.is_duplicate("EvA")
+    assert await first.is_duplicate("EvA"), "same instance processed the event twice"
+    assert await second.is_duplicate("EvA"), "another instance processed the event again"
+    assert not await second.is_duplicate("EvB")
+    expiring = EventDeduplicator(MemoryDedupBackend(), ttl=0.05)
+    assert not await expiring.is_duplicate("EvC")
+    await asyncio.sleep(0.1)
+    assert not await expiring.is_duplicate("EvC"), "expired event still treated as duplicate"
+    edit = {"type": "message", "subtype": "message_changed", "channel": CHANNEL, "message": {"ts": "1.1", "text": "x", "bot_id": "B"}}
+    assert not is_valid_message_event(edit), "edits must not reach the dedup claim"
+    assert not is_valid_message_event({**message_body("EvD")["event"], "bot_id": "B1"})
+    assert is_valid_message_event(message_body("EvE")["event"])
+
+
+async def check_answer_key():
+    """Reformular sin cambiar la pregunta acierta; cambiar lo que se pide, los filtros o los datos falla."""
+    from app.answer_cache import answer_key
+    filters = {"filters": {"country": ["ES"], "month": ["2025-01-01"]}, "metrics": ["sfdc_name_l3", "revenue"]}
+    df = pd.DataFrame({"sfdc_name_l3": ["a", "b"], "revenue": [1.0, 2.0]})
+    key = await answer_key(filters, df, "no", "[2025-10-01 10:00:00] Top 3 clients in ES?")
+    same = [
+        "[2025-10-02 09:00:00] top 3 clients in es",
+        "older message\n[2025-10-02 09:00:00] <@U123> Top 3 clients, in ES!",
+    ]
+    for question in same:
+        assert await answer_key(filters, df, "no", question) == key, f"miss on rewording: {question!r}"
+    reordered = {"filters": {"month": ["2025-01-01"], "country": "ES"}, "metrics": ["revenue", "sfdc_name_l3"]}
+    assert await answer_key(reordered, df, "no", "top 3 clients in ES") == key, "miss on reordered filters"
+    different = [
+        (filters, df, "no", "Bottom 3 clients in ES?"),
+        (filters, df, "no", "explain why revenue dropped in ES"),
+        (filters, df, "yes", "Top 3 clients in ES?"),
+        ({**filters, "filters": {"country": ["FR"]}}, df, "no", "Top 3 clients in ES?"),
+        (filters, df.assign(revenue=[1.0, 3.0]), "no", "Top 3 clients in ES?"),
+    ]
+    for args in different:
+        assert await answer_key(*args) != key, f"hit for a different question: {args[3]!r} {args[2]}"
+
+
+async def check_answer_cache_hit():
+    """La segunda vez la misma respuesta sale de la cache, sin volver a llamar al modelo."""
+    from app import get_claude
+    from app.answer_cache import answer_cache, answer_key
+    from app.execution_code import run_code_execution
+    fakes.attach_slack(LATENCY_SCALE)
+    df = pd.DataFrame({"country": ["ES", "FR"], "revenue": [10.0, 20.0]})
+    key = await answer_key({"filters": {}, "metrics": ["country", "revenue"]}, df, "no", "revenue by country")
+    messages = get_claude().beta.messages  # code execution va por la API beta
+    calls = messages.calls
+    first = await run_code_execution("revenue by country", df, CHANNEL, "U1", "1.1", cache_key=key)
+    assert messages.calls == calls + 1
+    hits = answer_cache.stats["hits"]
+    second = await run_code_execution("revenue by country", df, CHANNEL, "U1", "1.2", cache_key=key)
+    assert messages.calls == calls + 1, "cache hit still called the model"
+    assert answer_cache.stats["hits"] == hits + 1 and "Cached answer" in second and first != second
+
+
+async def check_thread_dataset_reuse():
+    """Un follow-up del mismo hilo con los mismos datos reutiliza el fichero subido; otro hilo sube el suyo."""
+    from app import get_claude
+    from app.execution_code import run_code_execution
+    from app.thread_state import ThreadState, set_current_thread_state, reset_current_thread_state
+    fakes.attach_slack(LATENCY_SCALE)
+    files = get_claude().beta.files
+    df = pd.DataFrame({"country": ["ES", "FR"], "revenue": [10.0, 20.0]})
+
+    async def ask(state, question):
+        token = set_current_thread_state(state, "U1")
+        try:
+            await run_code_execution(question, df.copy(), CHANNEL, "U1", state.thread_id)
+        finally:
+            reset_current_thread_state(token)
+
+    before = len(files.uploaded)
+    thread = ThreadState("100.1", CHANNEL, "U1")
+    await ask(thread, "revenue by country")
+    await ask(thread, "and as a share of the total?")
+    assert len(files.uploaded) == before + 1, f"{len(files.uploaded) - before} uploads for one thread"
+    assert len(thread.datasets) == 1 and thread.file_ids == list(thread.datasets.values())
+    other = ThreadState("200.1", CHANNEL, "U1")
+    await ask(other, "revenue by country")
+    assert len(files.uploaded) == before + 2 and other.datasets != thread.datasets
+
+
+async def check_batch_resume():
+    """Resume publica solo los informes que faltan de un batch a medias y no repite batches ya publicados."""
+    from app.batch_reports import run_batch_reports, resume_batches, batch_backend, CLAIM_TIMEOUT
+    slack = fakes.attach_slack(LATENCY_SCALE)
+    submitted = await run_batch_reports(channel=CHANNEL, poll_seconds=0.05, max_wait=0)
+    batch_id = submitted["batch_id"]
+    assert submitted["status"] == "pending" and submitted["reports"] > 3, submitted
+    assert await resume_batches() == [], "resumed a batch that has not ended"
+    await asyncio.sleep(fakes.LATENCY["batch"] * LATENCY_SCALE * 1.5)
+
+    # Otra instancia lo está publicando ahora mismo: no se toca
+    job = batch_backend.docs[batch_id]
+    job.update(status="posting", claimedAt=datetime.now(timezone.utc))
+    assert [r.get("status") for r in await resume_batches()] == ["claimed elsewhere"]
+
+    # Esa instancia murió tras publicar tres informes y su reclamación caducó
+    done_ids = sorted(job["reports"])[:3]
+    for custom_id in done_ids:
+        batch_backend.mark_posted(batch_id, custom_id)
+    job["claimedAt"] = datetime.now(timezone.utc) - CLAIM_TIMEOUT - timedelta(seconds=1)
+    thread = slack.threads[(CHANNEL, job["parent_ts"])]
+    replies = len(thread)
+    titles = {custom_id: report["title"] for custom_id, report in job["reports"].items()}
+    finished = await resume_batches()
+    assert [r["batch_id"] for r in finished] == [batch_id] and finished[0]["succeeded"] == len(titles), finished
+    posted = [message["text"] for message in thread[replies:]]
+    assert len(posted) == len(titles) - len(done_ids), f"{len(posted)} reports posted on resume"
+    for custom_id in done_ids:
+        assert not any(titles[custom_id] in text for text in posted), f"{titles[custom_id]} posted twice"
+    assert batch_id not in batch_backend.docs
+    assert await resume_batches() == [] and len(thread) == replies + len(posted), "finished batch posted again"
+
+
+CHECKS = {
+    "queue_backpressure": check_queue_backpressure,
+    "dedup": check_dedup,
+    "answer_key": check_answer_key,
+    "answer_cache": check_answer_cache_hit,
+    "thread_dataset_reuse": check_thread_dataset_reuse,
+    "batch_resume": check_batch_resume,
+}
+
+
+async def run(names: list) -> int:
+    from app import logger
+    logger.setLevel(logging.ERROR)
+    failures = 0
+    for name in names:
+        try:
+            await CHECKS[name]()
+            print(f"✅ {name}")
+        except Exception:
+            failures += 1
+            print(f"❌ {name}\n{traceback.format_exc()}")
+    return failures
+
+
+def main() -> int:
+    names = sys.argv[1:] or list(CHECKS)
+    unknown = [name for name in names if name not in CHECKS]
+    if unknown:
+        print(f"unknown checks {unknown}, available: {', '.join(CHECKS)}")
+        return 2
+    fakes.install(latency_scale=LATENCY_SCALE)
+    return 1 if asyncio.run(run(names)) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,410 @@
+"""
+Stand-ins locales de Slack, Anthropic y BigQuery para el benchmark de carga.
+install() tiene que llamarse antes de que se cree ningún cliente (app.config los crea en el primer uso)
+y antes de importar `app`, que lee la configuración del entorno al importarse.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import runpy
+import sqlite3
+import tempfile
+import time
+from threading import Lock
+from types import SimpleNamespace
+import pandas as pd
+import pyarrow as pa
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPTS_DIR = os.path.join(os.path.dirname(TESTS_DIR), "prompts") + "/"
+TOPLINE_TABLE = "jt-prd-financial-pa.random_data.real_data"
+PNL_TABLE = "jt-prd-financial-pa.random_data.pnl_data"
+MONTHS_2025 = [f"2025-{m:02d}-01" for m in range(1, 13)]
+
+# Latencias base (segundos) de cada servicio, multiplicadas por latency_scale
+LATENCY = {
+    "haiku": 0.6,
+    "sonnet": 4.0,
+    "files": 0.3,
+    "slack": 0.05,
+    "bigquery": 0.4,
+    "batch": 10.0,
+}
+
+# Preguntas del benchmark: texto -> respuesta del router (input de la tool route_question)
+QUESTIONS = {
+    "What is the revenue by country for 2025?": {
+        "proceed": "yes", "tables": ["detailed_topline"], "client_related": "no", "file_requested": "no",
+        "clients_mentioned": [], "reply_to_user": "",
+        "topline_query": {"filters": {"month": MONTHS_2025}, "metrics": ["country", "revenue", "gross_profit"]},
+    },
+    "Monthly revenue and gross profit by client in ES": {
+        "proceed": "yes", "tables": ["detailed_topline"], "client_related": "no", "file_requested": "no",
+        "clients_mentioned": [], "reply_to_user": "",
+        "topline_query": {"filters": {"country": ["ES"], "month": MONTHS_2025},
+                          "metrics": ["sfdc_name_l3", "month", "revenue", "gross_profit"]},
+    },
+    "How is sf12 doing this year?": {
+        "proceed": "yes", "tables": ["detailed_topline"], "client_related": "yes", "file_requested": "no",
+        "clients_mentioned": ["sf12"], "reply_to_user": "",
+        "topline_query": {"filters": {"sfdc_name_l3": ["sf12"], "month": MONTHS_2025}, "metrics": ["month", "revenue", "gross_profit"]},
+    },
+    "EBITDA by country this year": {
+        "proceed": "yes", "tables": ["profitAndLoss"], "client_related": "no", "file_requested": "no",
+        "clients_mentioned": [], "reply_to_user": "",
+        "pnl_query": {"filters": {"year": ["2,025"], "item": ["EBITDA"]}, "metrics": ["country", "year", "month", "item", "amount"]},
+    },
+    "Compare revenue with EBITDA per country and month": {
+        "proceed": "yes", "tables": ["detailed_topline", "profitAndLoss"], "client_related": "no", "file_requested": "no",
+        "clients_mentioned": [], "reply_to_user": "",
+        "topline_query": {"filters": {"month": MONTHS_2025}, "metrics": ["country", "month", "revenue"]},
+        "pnl_query": {"filters": {"year": ["2,025"], "item": ["EBITDA"]}, "metrics": ["country", "year", "month", "item", "amount"]},
+    },
+    "hello!": {
+        "proceed": "no", "tables": [], "client_related": "no", "file_requested": "no",
+        "clients_mentioned": [], "reply_to_user": "Hi! Ask me about revenue, gross profit or the P&L.",
+    },
+}
+ANSWER_TEXT = ("**Summary**\n- Revenue grew 4.2% vs last month, driven by ES and FR.\n"
+               "- Gross margin stays around 9%.\n\n| country | revenue |\n|---|---|\n| ES | 1,234,567 |\n| FR | 987,654 |\n")
+
+
+def _sleep_seconds(service: str, scale: float) -> float:
+    # Jitter de ±25% para que los percentiles no salgan planos
+    return LATENCY[service] * scale * random.uniform(0.75, 1.25)
+
+
+# === BIGQUERY ===
+
+def load_mock_data(csv_path: str = None) -> pd.DataFrame:
+    """Datos de topline del mock CSV. Si no existe se genera con random_data_to_csv.py."""
+    if csv_path is None:
+        csv_path = os.path.join(tempfile.gettempdir(), "mock_data.csv")
+    if not os.path.exists(csv_path):
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(csv_path))
+        try:
+            runpy.run_path(os.path.join(TESTS_DIR, "random_data_to_csv.py"), run_name="__main__")
+        finally:
+            os.chdir(cwd)
+    df = pd.read_csv(csv_path)
+    df["week_label"] = "w-0"
+    return df
+
+
+def build_pnl_data(topline: pd.DataFrame) -> pd.DataFrame:
+    """P&L sintético coherente con el topline: mismas countries, year con coma y month como texto."""
+    rows = []
+    items = {"Revenues": 1.0, "Gross Profit": 0.09, "Personnel": -0.04, "OPEX": -0.02, "EBITDA": 0.03}
+    monthly = topline.groupby(["country", "month"])["revenue"].sum()
+    for (country, month), revenue in monthly.items():
+        stamp = pd.Timestamp(month)
+        for item, ratio in items.items():
+            rows.append({
+                "country": country, "subsidiary": "Jobandtalent", "year": f"{stamp.year:,}", "month": str(stamp.month),
+                "date_week": "2025_39", "item": item, "data_type": "Actuals", "amount": round(revenue * ratio, 2),
+            })
+    return pd.DataFrame(rows)
+
+
+class FakeQueryJob:
+    def __init__(self, client, sql: str, dry_run: bool = False):
+        self.client = client
+        self.sql = sql
+        self.dry_run = dry_run
+        self.state = "DONE"
+        self.total_bytes_processed = client.estimate_bytes(sql)
+        self._df = None if dry_run else client.execute(sql)
+
+    def reload(self):
+        pass
+
+    def result(self):
+        return self
+
+    def to_dataframe(self, *args, **kwargs) -> pd.DataFrame:
+        return self._df.copy()
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        table = pa.Table.from_pandas(self._df, preserve_index=False)
+        return iter(table.to_batches(max_chunksize=10000))
+
+
+class FakeBigQueryClient:
+    """bq_client sobre SQLite en memoria: ejecuta el SQL generado por build_query tal cual (SQLite acepta `tabla`)."""
+    def __init__(self, latency_scale: float = 1.0, csv_path: str = None):
+        self.latency_scale = latency_scale
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.lock = Lock()
+        topline = load_mock_data(csv_path)
+        pnl = build_pnl_data(topline)
+        self.row_bytes = {}
+        for table, df in ((TOPLINE_TABLE, topline), (PNL_TABLE, pnl)):
+            df.to_sql(table, self.conn, index=False)
+            self.row_bytes[table] = (len(df), 8 * len(df.columns))
+        self.jobs = 0
+
+    def estimate_bytes(self, sql: str) -> int:
+        for table, (rows, width) in self.row_bytes.items():
+            if table in sql:
+                return rows * width
+        return 0
+
+    def execute(self, sql: str) -> pd.DataFrame:
+        with self.lock:
+            return pd.read_sql_query(sql.strip().rstrip(";"), self.conn)
+
+    def query(self, sql: str, job_config=None, **kwargs) -> FakeQueryJob:
+        dry_run = bool(getattr(job_config, "dry_run", False))
+        if not dry_run:
+            self.jobs += 1
+            # El cliente real bloquea mientras crea el job: run_query lo llama desde el pool de threads
+            time.sleep(_sleep_seconds("bigquery", self.latency_scale))
+        return FakeQueryJob(self, sql, dry_run)
+
+
+# === ANTHROPIC ===
+
+def _usage(input_tokens: int, output_tokens: int):
+    return SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens,
+                           cache_read_input_tokens=0, cache_creation_input_tokens=0)
+
+
+def _message(model: str, content: list, request: dict):
+    text = "".join(getattr(block, "text", "") for block in content) or json.dumps(getattr(content[0], "input", {}))
+    return SimpleNamespace(model=model, content=content, stop_reason="end_turn",
+                           usage=_usage(len(json.dumps(request, default=str)) // 4, len(text) // 4))
+
+
+def _latency_class(model: str) -> str:
+    return "sonnet" if "sonnet" in model or "opus" in model else "haiku"
+
+
+def scripted_route(content) -> dict:
+    """Respuesta del router para la última pregunta conocida que aparece en el historial."""
+    text = content if isinstance(content, str) else json.dumps(content)
+    found = [(text.rfind(question), question) for question in QUESTIONS if question in text]
+    if not found:
+        return QUESTIONS["hello!"]
+    return json.loads(json.dumps(QUESTIONS[max(found)[1]]))
+
+
+class FakeStream:
+    def __init__(self, message, text: str, delay: float):
+        self.message = message
+        self.text = text
+        self.delay = delay
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        chunks = [self.text[i:i + 40] for i in range(0, len(self.text), 40)] or [""]
+        snapshot = ""
+        for chunk in chunks:
+            await asyncio.sleep(self.delay / len(chunks))
+            snapshot += chunk
+            yield SimpleNamespace(type="text", text=chunk, snapshot=snapshot)
+
+    async def get_final_message(self):
+        return self.message
+
+
+class FakeMessages:
+    def __init__(self, latency_scale: float):
+        self.latency_scale = latency_scale
+        self.calls = 0
+
+    async def create(self, model: str, messages: list, tools: list = None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(_sleep_seconds(_latency_class(model), self.latency_scale))
+        content = messages[-1]["content"]
+        request = {"messages": messages, "tools": tools, **kwargs}
+        route = scripted_route(content)
+        if tools:
+            return _message(model, [SimpleNamespace(type="tool_use", name=tools[0]["name"], input=route)], request)
+        # Modo serial: un JSON con la clasificación y los filtros, vale para cualquiera de los prompts
+        query = route.get("topline_query") or route.get("pnl_query") or {"filters": {}, "metrics": []}
+        text = json.dumps({**route, **query})
+        return _message(model, [SimpleNamespace(type="text", text=text)], request)
+
+    def stream(self, model: str, messages: list, **kwargs):
+        self.calls += 1
+        message = _message(model, [SimpleNamespace(type="text", text=ANSWER_TEXT)], {"messages": messages, **kwargs})
+        return FakeStream(message, ANSWER_TEXT, _sleep_seconds(_latency_class(model), self.latency_scale))
+
+
+class FakeBatches:
+    """Message Batches API: procesa todas las peticiones tras la latencia de "batch" y deja los resultados en memoria."""
+    def __init__(self, latency_scale: float):
+        self.latency_scale = latency_scale
+        self.batches = {}
+        self._ids = itertools.count(1)
+        self._tasks = set()
+
+    async def create(self, requests: list, **kwargs):
+        batch_id = f"msgbatch_{next(self._ids):06d}"
+        self.batches[batch_id] = {"status": "in_progress", "results": [], "requests": len(requests)}
+        task = asyncio.create_task(self._process(batch_id, requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return await self.retrieve(batch_id)
+
+    async def _process(self, batch_id: str, requests: list):
+        await asyncio.sleep(_sleep_seconds("batch", self.latency_scale))
+        results = []
+        for request in requests:
+            params = request["params"]
+            message = _message(params["model"], [SimpleNamespace(type="text", text=ANSWER_TEXT)], params)
+            results.append(SimpleNamespace(custom_id=request["custom_id"], result=SimpleNamespace(type="succeeded", message=message)))
+        self.batches[batch_id].update(status="ended", results=results)
+
+    async def retrieve(self, batch_id: str, **kwargs):
+        batch = self.batches[batch_id]
+        done = len(batch["results"])
+        return SimpleNamespace(id=batch_id, processing_status=batch["status"], request_counts=SimpleNamespace(
+            processing=batch["requests"] - done, succeeded=done, errored=0, canceled=0, expired=0))
+
+    async def results(self, batch_id: str, **kwargs):
+        async def entries():
+            for entry in self.batches[batch_id]["results"]:
+                yield entry
+        return entries()
+
+
+class FakeFiles:
+    def __init__(self, latency_scale: float):
+        self.latency_scale = latency_scale
+        self.uploaded = {}
+        self._ids = itertools.count(1)
+
+    async def upload(self, file, **kwargs):
+        await asyncio.sleep(_sleep_seconds("files", self.latency_scale))
+        file_id = f"file_{next(self._ids):06d}"
+        self.uploaded[file_id] = len(file[1])
+        return SimpleNamespace(id=file_id, filename=file[0], size_bytes=len(file[1]))
+
+    async def delete(self, file_id: str, **kwargs):
+        self.uploaded.pop(file_id, None)
+
+
+class FakeAnthropic:
+    """AsyncAnthropic con latencias configurables y respuestas guionizadas (QUESTIONS)."""
+    def __init__(self, *args, latency_scale: float = 1.0, **kwargs):
+        self.messages = FakeMessages(latency_scale)
+        self.messages.batches = FakeBatches(latency_scale)
+        self.beta = SimpleNamespace(messages=FakeMessages(latency_scale), files=FakeFiles(latency_scale))
+        self.models = SimpleNamespace(list=self._list_models)
+
+    async def _list_models(self, **kwargs):
+        return SimpleNamespace(data=[SimpleNamespace(id="claude-haiku-4-5-20251001")])
+
+
+# === SLACK ===
+
+class FakeSlackResponse:
+    def __init__(self, data: dict):
+        self.data = data
+        self.status_code = 200
+        self.headers = {}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+class FakeSlackClient:
+    """Métodos del AsyncWebClient que usa el bot. Guarda los mensajes por hilo para conversations_replies."""
+    def __init__(self, latency_scale: float = 1.0):
+        self.latency_scale = latency_scale
+        self.threads = {}
+        self.calls = {}
+        self._ts = itertools.count(1)
+
+    def new_ts(self) -> str:
+        return f"{time.time():.0f}.{next(self._ts):06d}"
+
+    def add_user_message(self, channel: str, thread_ts: str, text: str):
+        self.threads.setdefault((channel, thread_ts), []).append({"ts": thread_ts, "text": text, "user": "U_BENCH"})
+
+    async def _call(self, method: str, data: dict) -> FakeSlackResponse:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(_sleep_seconds("slack", self.latency_scale))
+        return FakeSlackResponse({"ok": True, **data})
+
+    async def chat_postMessage(self, channel: str, text: str, thread_ts: str = None, **kwargs):
+        ts = self.new_ts()
+        self.threads.setdefault((channel, thread_ts or ts), []).append({"ts": ts, "text": text, "bot_id": "B_BENCH"})
+        return await self._call("chat_postMessage", {"channel": channel, "ts": ts})
+
+    async def chat_update(self, channel: str, ts: str, text: str, **kwargs):
+        return await self._call("chat_update", {"channel": channel, "ts": ts, "text": text})
+
+    async def chat_postEphemeral(self, **kwargs):
+        return await self._call("chat_postEphemeral", {"message_ts": self.new_ts()})
+
+    async def conversations_replies(self, channel: str, ts: str, limit: int = 8, **kwargs):
+        messages = self.threads.get((channel, ts), [])[:limit]
+        return await self._call("conversations_replies", {"messages": messages})
+
+    async def auth_test(self, **kwargs):
+        return await self._call("auth_test", {"user_id": "U_BOT", "team": "benchmark"})
+
+    async def reactions_add(self, **kwargs):
+        return await self._call("reactions_add", {})
+
+    async def files_getUploadURLExternal(self, filename: str, length: int, **kwargs):
+        file_id = f"F{next(self._ts):08d}"
+        return await self._call("files_getUploadURLExternal", {"upload_url": f"https://files.slack.fake/upload/{file_id}", "file_id": file_id})
+
+    async def files_completeUploadExternal(self, files: list, **kwargs):
+        return await self._call("files_completeUploadExternal", {"files": files})
+
+
+# === INSTALACION ===
+
+def install(latency_scale: float = 1.0, cold: bool = False) -> SimpleNamespace:
+    """
+    Sustituye los constructores de los clientes externos y fija la configuración local.
+    Devuelve los fakes de BigQuery y Anthropic; el de Slack se conecta con attach_slack() tras importar app.
+    """
+    os.environ.update({
+        "ANTHROPIC_API_KEY": "fake", "SLACK_BOT_TOKEN": "xoxb-fake", "PROMPTS_PATH": PROMPTS_DIR,
+        "DEDUP_BACKEND": "memory", "THREAD_STATE_BACKEND": "memory", "BATCH_STATE_BACKEND": "memory", "INTENT_MODE": "combined",
+        "ANSWER_CACHE_PATH": "", "QUERY_CACHE_DIR": "",
+    })
+    if cold:
+        os.environ.update({"ANSWER_CACHE_TTL": "0", "QUERY_CACHE_MAX_BYTES": "0"})
+    import anthropic
+    from google.cloud import bigquery, firestore
+    bq = FakeBigQueryClient(latency_scale)
+    claude = FakeAnthropic(latency_scale=latency_scale)
+    bigquery.Client = lambda *args, **kwargs: bq
+    firestore.Client = lambda *args, **kwargs: None  # backends en memoria, Firestore no se usa
+    anthropic.AsyncAnthropic = lambda *args, **kwargs: claude
+    return SimpleNamespace(bq=bq, claude=claude, latency_scale=latency_scale)
+
+
+def attach_slack(latency_scale: float = 1.0, rate_limits: bool = False) -> FakeSlackClient:
+    """Conecta el Slack falso al transport compartido. Sin rate_limits los token buckets no frenan."""
+    import httpx
+    from app.utils_slack import transport as transport_module
+    from app.utils_slack.slack_utils import transport
+    slack = FakeSlackClient(latency_scale)
+    transport._client = slack
+    transport._http = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200)))
+    if not rate_limits:
+        transport_module.METHOD_LIMITS = {method: (10000.0, 10000) for method in transport_module.METHOD_LIMITS}
+        transport_module.DEFAULT_LIMIT = (10000.0, 10000)
+        transport._buckets.clear()
+    # Sin Storage Read API: los resultados se leen por la ruta REST (to_arrow_iterable del fake)
+    import app.bigQuery
+    app.bigQuery._storage_client = False
+    return slack
@@ -0,0 +1,85 @@
+"""
+Informe de tiempos de importación (cold start). Importa los módulos en un proceso nuevo con `python -X importtime`
+y lista lo que más pesa. Con --output/--baseline se guarda y compara entre versiones.
+
+    python app/tests/import_profile.py                      # lo que paga uvicorn antes de contestar (app.main)
+    python app/tests/import_profile.py --module app.slack_events --top 25
+    python app/tests/import_profile.py --output startup.json
+    python app/tests/import_profile.py --baseline startup.json
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile(module: str, runs: int = 3) -> dict:
+    """Mejor de `runs` procesos: el primero suele pagar la caché de disco de los .pyc."""
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=ROOT, capture_output=True, text=True, env={**os.environ, "WARMUP": "0"})
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr[-2000:])
+        modules = {}
+        for match in LINE.finditer(result.stderr):
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = {"self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000, "depth": len(indent) // 2}
+        total = modules.get(module, {}).get("cumulative_ms", 0.0)
+        if best is None or total < best["total_ms"]:
+            best = {"module": module, "total_ms": round(total, 1), "modules": modules}
+    return best
+
+
+def top_level(report: dict) -> dict:
+    """Tiempo propio sumado por paquete raíz (pandas, anthropic, google, fastapi...)."""
+    packages = {}
+    for name, stats in report["modules"].items():
+        root = name.split(".")[0]
+        packages[root] = packages.get(root, 0.0) + stats["self_ms"]
+    return packages
+
+
+def print_report(report: dict, top: int, baseline: dict = None):
+    print(f"\nimport {report['module']}: {report['total_ms']:.0f} ms")
+    if baseline:
+        print(f"baseline: {baseline['total_ms']:.0f} ms ({report['total_ms'] - baseline['total_ms']:+.0f} ms)")
+    packages = sorted(top_level(report).items(), key=lambda item: -item[1])[:top]
+    previous = top_level(baseline) if baseline else {}
+    print(f"\n{'package':<40}{'ms':>15}" + (f"{'Δ ms':>10}" if baseline else ""))
+    for name, ms in packages:
+        delta = f"{ms - previous[name]:>+10.0f}" if name in previous else (f"{'new':>10}" if baseline else "")
+        print(f"{name:<40}{ms:>15.1f}{delta}")
+    slowest = sorted(report["modules"].items(), key=lambda item: -item[1]["self_ms"])[:top]
+    print(f"\n{'module (self time)':<60}{'self ms':>10}")
+    for name, stats in slowest:
+        print(f"{name:<60}{stats['self_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time profile of the app (cold start)")
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="guarda el informe en JSON")
+    parser.add_argument("--baseline", help="JSON de un informe anterior para comparar")
+    args = parser.parse_args()
+
+    report = profile(args.module, args.runs)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, args.top, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
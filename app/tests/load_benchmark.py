@@ -0,0 +1,161 @@
+"""
+Benchmark de carga end-to-end: lanza preguntas contra POST /slack/events con Slack, Anthropic y BigQuery falsos
+(app/tests/fakes.py) y reporta p50/p95/p99 y preguntas por segundo de cada etapa.
+
+    python app/tests/load_benchmark.py --questions 200 --concurrency 20 --output baseline.json
+    python app/tests/load_benchmark.py --questions 200 --concurrency 20 --baseline baseline.json
+
+Se ejecuta como script (no con -m): los fakes tienen que instalarse antes de que se importe el paquete app.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+import numpy as np
+import fakes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(fakes.TESTS_DIR)))  # raíz del repo, para importar app
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(values), "p50": round(float(p50), 1), "p95": round(float(p95), 1), "p99": round(float(p99), 1)}
+
+
+def summarize(traces: list, acks: list, wall_seconds: float) -> dict:
+    stages = defaultdict(list)
+    for trace in traces:
+        for span in trace["spans"]:
+            stages[span["stage"]].append(span["ms"])
+    report = {"ack": percentiles(acks)}
+    for stage, values in sorted(stages.items()):
+        report[stage] = percentiles(values)
+    for stats in report.values():
+        stats["per_second"] = round(stats["count"] / wall_seconds, 2) if wall_seconds else 0
+    return {
+        "wall_seconds": round(wall_seconds, 2),
+        "questions": len(traces),
+        "questions_per_second": round(len(traces) / wall_seconds, 2) if wall_seconds else 0,
+        "cost_eur": round(sum(trace["cost_eur"] for trace in traces), 4),
+        "stages": report,
+    }
+
+
+def print_report(summary: dict, baseline: dict = None):
+    print(f"\n{summary['questions']} questions in {summary['wall_seconds']}s → "
+          f"{summary['questions_per_second']} q/s, fake cost €{summary['cost_eur']}")
+    header = f"{'stage':<38}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'per s':>8}"
+    if baseline:
+        header += f"{'Δp50':>9}{'Δp95':>9}"
+    print(header)
+    print("-" * len(header))
+    for stage, stats in summary["stages"].items():
+        line = f"{stage:<38}{stats['count']:>7}{stats['p50'] or 0:>10}{stats['p95'] or 0:>10}{stats['p99'] or 0:>10}{stats['per_second']:>8}"
+        previous = (baseline or {}).get("stages", {}).get(stage)
+        if baseline:
+            for key in ("p50", "p95"):
+                if previous and previous.get(key) and stats.get(key) is not None:
+                    line += f"{(stats[key] - previous[key]) / previous[key]:>+9.0%}"
+                else:
+                    line += f"{'new':>9}"
+        print(line)
+    if baseline:
+        delta = summary["questions_per_second"] - baseline.get("questions_per_second", 0)
+        print(f"\nq/s vs baseline: {baseline.get('questions_per_second')} → {summary['questions_per_second']} ({delta:+.2f})")
+
+
+async def run_benchmark(questions: int, concurrency: int, latency_scale: float, rate_limits: bool, seed: int) -> dict:
+    from app import AUTHORIZED_USERS
+    from app.main import app
+    from app.metrics import add_trace_sink
+    import httpx
+
+    # app.config deja el logging en DEBUG: durante el benchmark solo interesan avisos y errores
+    logging.getLogger().setLevel(logging.WARNING)
+    slack = fakes.attach_slack(latency_scale, rate_limits)
+    random.seed(seed)
+    traces, acks = [], []
+    done = {}
+
+    def on_trace(trace):
+        traces.append(trace)
+        event = done.get(trace.get("event_id"))
+        if event is not None:
+            event.set()
+
+    add_trace_sink(on_trace)
+    texts = list(fakes.QUESTIONS)
+    counter = itertools.count(1)
+
+    async def ask(client: httpx.AsyncClient, n: int):
+        thread_ts = slack.new_ts()
+        text = random.choice(texts)
+        slack.add_user_message("CBENCH", thread_ts, text)
+        event_id = f"EvBENCH{n:06d}"
+        done[event_id] = asyncio.Event()
+        body = {
+            "type": "event_callback", "event_id": event_id,
+            "event": {"type": "message", "user": AUTHORIZED_USERS[0], "channel": "CBENCH", "text": text, "ts": thread_ts},
+        }
+        started = time.perf_counter()
+        response = await client.post("/slack/events", json=body)
+        acks.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            print(f"⚠️ {event_id} rejected with {response.status_code}", file=sys.stderr)
+            return
+        await asyncio.wait_for(done[event_id].wait(), timeout=300)
+
+    async def user_loop(client: httpx.AsyncClient):
+        # Carga en bucle cerrado: cada usuario virtual espera su respuesta antes de preguntar de nuevo
+        while (n := next(counter)) <= questions:
+            try:
+                await ask(client, n)
+            except asyncio.TimeoutError:
+                print(f"⚠️ question {n} timed out", file=sys.stderr)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(user_loop(client) for _ in range(concurrency)))
+            wall = time.perf_counter() - started
+    summary = summarize(traces, acks, wall)
+    summary["config"] = {"questions": questions, "concurrency": concurrency, "latency_scale": latency_scale,
+                         "rate_limits": rate_limits, "slack_calls": slack.calls}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark with local fakes for Slack, Anthropic and BigQuery")
+    parser.add_argument("--questions", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplica las latencias simuladas (0 = sin latencia)")
+    parser.add_argument("--slack-rate-limits", action="store_true", help="mantiene los token buckets reales de Slack")
+    parser.add_argument("--cold", action="store_true", help="desactiva las caches de queries y respuestas")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="guarda el resultado en JSON (baseline)")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior para comparar")
+    args = parser.parse_args()
+
+    fakes.install(args.latency_scale, cold=args.cold)
+    summary = asyncio.run(run_benchmark(args.questions, args.concurrency, args.latency_scale, args.slack_rate_limits, args.seed))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(summary, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
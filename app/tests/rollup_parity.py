@@ -0,0 +1,117 @@
+"""
+Paridad del rollup en memoria con el SQL de build_query: mismas filas, mismo orden y mismos NULLs.
+Carga datos sintéticos (con NULLs en dimensiones y medidas) en SQLite, construye el cubo con la query de carga
+del RollupStore y compara RollupCube.query con la SQL de build_query ejecutada sobre la tabla sin agregar.
+
+    python app/tests/rollup_parity.py
+
+Se ejecuta como script (no con -m): los fakes tienen que instalarse antes de que se importe el paquete app.
+Sale con código 1 si algún caso no coincide.
+"""
+import math
+import os
+import random
+import sqlite3
+import sys
+import pandas as pd
+import fakes
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(fakes.TESTS_DIR)))  # raíz del repo, para importar app
+SNAPSHOT = "2025-09-29"
+COLUMNS = ["data_week", "week_label", "sfdc_name_l3", "am_name_l3", "country", "service_type_l3", "month",
+           "customer_type", "cohort", "data_type"]
+
+# filtros (sin el de snapshot) y métricas de cada caso, con la forma que produce el LLM
+CASES = {
+    "group by country": ({}, ["country", "revenue", "gross_profit"]),
+    "filter two countries": ({"country": ["ES", "FR"]}, ["country", "month", "revenue"]),
+    "scalar filter": ({"country": "UK"}, ["month", "revenue"]),
+    "integer column filtered as text": ({"cohort": ["2023"]}, ["cohort", "sfdc_name_l3", "revenue"]),
+    "NULL dimension groups": ({}, ["sfdc_name_l3", "cohort", "revenue"]),
+    "measure NULL in a whole group": ({"sfdc_name_l3": ["sf_nulls"]}, ["sfdc_name_l3", "month", "revenue", "gross_profit"]),
+    "date filter": ({"month": ["2025-01-01", "2025-02-01"]}, ["month", "data_type", "revenue"]),
+    "unknown value": ({"country": ["XX"]}, ["country", "revenue"]),
+    "week label": ({"week_label": ["w-0"], "data_type": ["actuals"]}, ["am_name_l3", "country", "revenue"]),
+    "order by several dims": ({}, ["data_type", "country", "am_name_l3", "service_type_l3", "gross_profit"]),
+}
+
+
+def synthetic_topline(rows: int = 3000, seed: int = 7) -> pd.DataFrame:
+    rng = random.Random(seed)
+    records = []
+    for _ in range(rows):
+        records.append({
+            "data_week": SNAPSHOT, "week_label": "w-0",
+            "sfdc_name_l3": rng.choice([f"sf{i}" for i in range(15)] + [None]),
+            "am_name_l3": rng.choice(["Ana", "Bruno", "Chloé", "Émile", None]),
+            "country": rng.choice(["ES", "FR", "UK", "DE", None]),
+            "service_type_l3": rng.choice(["Staffing", "Outsourcing"]),
+            "month": f"2025-{rng.randint(1, 12):02d}-01",
+            "customer_type": rng.choice(["Existing Business", "New Business"]),
+            "cohort": rng.choice([2021, 2022, 2023, 2024, None]),
+            "data_type": rng.choice(["actuals", "forecast"]),
+            "revenue": None if rng.random() < 0.05 else round(rng.uniform(-500, 90000), 2),
+            "gross_profit": None if rng.random() < 0.05 else round(rng.uniform(-100, 9000), 2),
+        })
+    # Un cliente sin ninguna medida: SUM() de solo NULLs tiene que salir NULL, no 0
+    for month in ("2025-01-01", "2025-02-01"):
+        records.append({**records[0], "sfdc_name_l3": "sf_nulls", "month": month, "revenue": None, "gross_profit": None})
+    records.append({**records[0], "data_week": "2025-09-22", "week_label": "w-1"})  # otra carga, fuera del cubo
+    return pd.DataFrame(records)
+
+
+def normalize(value):
+    from app.rollup import value_key
+    if value is None or (isinstance(value, float) and math.isnan(value)) or value is pd.NA:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # INT64 con NULLs sale como float de pandas en ambos lados
+    return value_key(value)
+
+
+def same_rows(expected: pd.DataFrame, got: pd.DataFrame, measures: list) -> str:
+    if list(expected.columns) != list(got.columns):
+        return f"columns {list(expected.columns)} != {list(got.columns)}"
+    if len(expected) != len(got):
+        return f"{len(expected)} rows in SQL, {len(got)} in the rollup"
+    for i, (a, b) in enumerate(zip(expected.itertuples(index=False), got.itertuples(index=False))):
+        for column, x, y in zip(expected.columns, a, b):
+            x, y = (pd.to_numeric(pd.Series([x, y]), errors="coerce").tolist() if column in measures
+                    else (normalize(x), normalize(y)))
+            if column in measures:
+                if math.isnan(x) != math.isnan(y) or (not math.isnan(x) and not math.isclose(x, y, abs_tol=1e-6)):
+                    return f"row {i} {column}: SQL {x} vs rollup {y}"
+            elif x != y:
+                return f"row {i} {column}: SQL {x!r} vs rollup {y!r}"
+    return ""
+
+
+def main() -> int:
+    fakes.install(latency_scale=0)
+    from app.bigQuery import build_query
+    from app.rollup import ROLLUP_TABLES, RollupCube, RollupStore
+    table = fakes.TOPLINE_TABLE
+    spec = ROLLUP_TABLES[table]
+    conn = sqlite3.connect(":memory:")
+    synthetic_topline().to_sql(table, conn, index=False, dtype={"cohort": "INTEGER"})
+    query = lambda sql: pd.read_sql_query(sql.strip().rstrip(";"), conn)
+    loaded = query(RollupStore(None, None).load_sql(table, SNAPSHOT))
+    cube = RollupCube(table, SNAPSHOT, loaded, spec["dims"], spec["measures"], spec["labels"])
+
+    failures = 0
+    for name, (where, metrics) in CASES.items():
+        snapshot = {} if "week_label" in where else {"data_week": [SNAPSHOT]}
+        filters = {"filters": {**snapshot, **where}, "metrics": metrics}
+        if not cube.serves(filters, spec["snapshot"]):
+            print(f"❌ {name}: the rollup does not serve {filters}")
+            failures += 1
+            continue
+        expected = query(build_query(filters, table, COLUMNS))
+        problem = same_rows(expected, cube.query(filters), spec["measures"])
+        print(f"{'❌' if problem else '✅'} {name} ({len(expected)} rows){': ' + problem if problem else ''}")
+        failures += bool(problem)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, timezone
+from app import logger, get_claude, get_db, THREAD_STATE_BACKEND, THREAD_STATE_REFRESH_SECONDS, THREAD_STATE_MAX_THREADS
+
+THREAD_TTL = timedelta(days=7)
+USER_SPEND_TTL = timedelta(days=2)  # los documentos de gasto diario caducan con la limpieza de hilos
+MAX_MESSAGES = 20
+BATCH_LIMIT = 500  # máximo de escrituras por batch de Firestore
+_current = ContextVar("thread_state", default=None)
+_current_user = ContextVar("thread_user", default=None)  # quien hizo la pregunta en curso, no quien abrió el hilo
+
+
+class ThreadState:
+    """
+    Estado de un hilo de Slack: mensajes, última query y ficheros ya subidos a la Files API de Anthropic.
+    Guarda aparte los cambios desde la última escritura: varias instancias pueden escribir el mismo hilo
+    y solo se mandan deltas (ver changes()).
+    """
+    def __init__(self, thread_id: str, channel_id: str = None, user_id: str = None, data: dict = None):
+        data = data or {}
+        self.thread_id = thread_id
+        self.channel_id = data.get("channel_id", channel_id)
+        self.user_id = data.get("user_id", user_id)
+        self.expireAt = data.get("expireAt") or datetime.now(timezone.utc) + THREAD_TTL
+        self._new_messages, self._new_datasets, self._cost_delta, self._query_changed = [], {}, 0.0, False
+        self.reload(data)
+
+    def reload(self, data: dict):
+        """Estado leído del backend más los cambios locales que aún no se han escrito."""
+        data = data or {}
+        messages = data.get("messages", [])
+        self.messages = (messages + [m for m in self._new_messages if m not in messages])[-MAX_MESSAGES:]
+        if not self._query_changed:
+            self.last_query = data.get("last_query")  # {"table", "filters", "sql", "fingerprint"}
+        self.datasets = {**data.get("datasets", {}), **self._new_datasets}  # fingerprint del dataset -> file_id de Anthropic
+        self.file_ids = list(dict.fromkeys((data.get("file_ids") or []) + list(self._new_datasets.values())))
+        self.cost_eur = data.get("cost_eur", 0.0) + self._cost_delta  # gasto LLM acumulado en el hilo (presupuesto del router)
+        self.loaded_at = time.monotonic()
+
+    @property
+    def claude_file_ids(self) -> list:
+        return list(self.datasets.values())
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._new_messages or self._new_datasets or self._cost_delta or self._query_changed)
+
+    def changes(self) -> dict:
+        """
+        Deltas desde la última escritura: campos fijos, uniones de arrays (mensajes, file_ids), claves nuevas
+        de mapas (datasets) e incrementos (coste). Nunca se reescribe lo que otra instancia haya añadido.
+        """
+        fields = {"thread_id": self.thread_id, "channel_id": self.channel_id, "user_id": self.user_id, "expireAt": self.expireAt}
+        if self._query_changed:
+            fields["last_query"] = self.last_query
+        change = {
+            "set": fields,
+            "union": {"messages": list(self._new_messages), "file_ids": list(self._new_datasets.values())},
+            "maps": {"datasets": dict(self._new_datasets)},
+            "increment": {"cost_eur": self._cost_delta},
+        }
+        self._new_messages, self._new_datasets, self._cost_delta, self._query_changed = [], {}, 0.0, False
+        return change
+
+    def restore(self, change: dict):
+        """La escritura falló: los deltas vuelven a quedar pendientes."""
+        self._new_messages = change["union"]["messages"] + self._new_messages
+        self._new_datasets = {**change["maps"]["datasets"], **self._new_datasets}
+        self._cost_delta += change["increment"]["cost_eur"]
+        self._query_changed = self._query_changed or "last_query" in change["set"]
+
+    def add_message(self, text: str):
+        if text:
+            self.messages = (self.messages + [text])[-MAX_MESSAGES:]
+            self._new_messages.append(text)
+
+    def add_dataset(self, key: str, file_id: str):
+        self.datasets[key] = file_id
+        self.file_ids.append(file_id)
+        self._new_datasets[key] = file_id
+
+    def add_cost(self, cost: float):
+        self.cost_eur += cost
+        self._cost_delta += cost
+
+    def record_query(self, table: str, filters: dict, sql: str, fingerprint: str):
+        self.last_query = {"table": table, "filters": filters, "sql": sql, "fingerprint": fingerprint}
+        self._query_changed = True
+
+    def reusable_query(self, table: str, filters: dict):
+        """
+        SQL de la query anterior si sirve para la nueva pregunta: misma tabla y mismos filtros, y la
+        anterior agrupaba por todas las dimensiones que pide la nueva (es igual o más detallada).
+        """
+        last = self.last_query
+        if not last or last["table"] != table:
+            return None
+        if (last["filters"].get("filters") or {}) != (filters.get("filters") or {}):
+            return None
+        if not set(filters.get("metrics") or []) <= set(last["filters"].get("metrics") or []):
+            return None
+        return last["sql"]
+
+
+class UserSpend:
+    """
+    Gasto LLM de un usuario en un día (presupuesto del router), compartido entre instancias: se guarda en el
+    mismo backend que los hilos y el gasto local se escribe como incremento, igual que el coste del hilo.
+    """
+    def __init__(self, user: str, day: str, data: dict = None):
+        self.user = user
+        self.day = day
+        self._delta = 0.0
+        self.reload(data)
+
+    @staticmethod
+    def doc_id(user: str, day: str) -> str:
+        return f"budget-{day}-{user}"
+
+    def reload(self, data: dict):
+        self.cost_eur = (data or {}).get("cost_eur", 0.0) + self._delta
+        self.loaded_at = time.monotonic()
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._delta)
+
+    def add_cost(self, cost: float):
+        self.cost_eur += cost
+        self._delta += cost
+
+    def changes(self) -> dict:
+        fields = {"user_id": self.user, "day": self.day, "expireAt": datetime.now(timezone.utc) + USER_SPEND_TTL}
+        change = {"set": fields, "union": {}, "maps": {}, "increment": {"cost_eur": self._delta}}
+        self._delta = 0.0
+        return change
+
+    def restore(self, change: dict):
+        self._delta += change["increment"]["cost_eur"]
+
+
+class MemoryThreadBackend:
+    """Stand-in local de Firestore (tests / desarrollo)."""
+    def __init__(self):
+        self.docs = {}
+
+    def get(self, thread_id: str):
+        return self.docs.get(thread_id)
+
+    def write_batch(self, changes: dict):
+        """Misma semántica que Firestore con merge=True, ArrayUnion e Increment."""
+        for thread_id, change in changes.items():
+            doc = self.docs.setdefault(thread_id, {})
+            doc.update(change["set"])
+            for field, values in change["union"].items():
+                doc[field] = doc.get(field, []) + [v for v in values if v not in doc.get(field, [])]
+            for field, mapping in change["maps"].items():
+                doc[field] = {**doc.get(field, {}), **mapping}
+            for field, delta in change["increment"].items():
+                doc[field] = doc.get(field, 0) + delta
+
+    def expired(self, now: datetime, limit: int = 100) -> list:
+        return [(k, v) for k, v in self.docs.items() if v["expireAt"] < now][:limit]
+
+    def delete(self, thread_ids: list):
+        for thread_id in thread_ids:
+            self.docs.pop(thread_id, None)
+
+
+class FirestoreThreadBackend:
+    def __init__(self, client_factory, collection: str = "slack-bot"):
+        self.client_factory = client_factory  # el cliente de Firestore se crea en el primer acceso
+        self.collection_name = collection
+
+    @property
+    def client(self):
+        return self.client_factory()
+
+    @property
+    def collection(self):
+        return self.client.collection(self.collection_name)
+
+    def get(self, thread_id: str):
+        doc = self.collection.document(thread_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def write_batch(self, changes: dict):
+        """merge=True: solo se tocan los campos del delta; arrays con ArrayUnion, coste con Increment."""
+        from google.cloud import firestore
+        items = list(changes.items())
+        for start in range(0, len(items), BATCH_LIMIT):
+            batch = self.client.batch()
+            for thread_id, change in items[start:start + BATCH_LIMIT]:
+                data = dict(change["set"])
+                data.update({field: firestore.ArrayUnion(values) for field, values in change["union"].items() if values})
+                data.update({field: mapping for field, mapping in change["maps"].items() if mapping})
+                data.update({field: firestore.Increment(delta) for field, delta in change["increment"].items() if delta})
+                batch.set(self.collection.document(thread_id), data, merge=True)
+            batch.commit()
+
+    def expired(self, now: datetime, limit: int = 100) -> list:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        query = self.collection.where(filter=FieldFilter("expireAt", "<", now)).limit(limit)
+        return [(doc.id, doc.to_dict()) for doc in query.stream()]
+
+    def delete(self, thread_ids: list):
+        for start in range(0, len(thread_ids), BATCH_LIMIT):
+            batch = self.client.batch()
+            for thread_id in thread_ids[start:start + BATCH_LIMIT]:
+                batch.delete(self.collection.document(thread_id))
+            batch.commit()
+
+
+class ThreadStateStore:
+    """
+    Hilos en memoria (LRU de `max_threads`) sobre el backend. Un hilo se relee pasados `refresh` segundos:
+    otra instancia pudo contestar en él. Guarda también el gasto diario de cada usuario (UserSpend).
+    """
+    def __init__(self, backend, refresh: float = THREAD_STATE_REFRESH_SECONDS, max_threads: int = THREAD_STATE_MAX_THREADS):
+        self.backend = backend
+        self.refresh = refresh
+        self.max_threads = max_threads
+        self._states = OrderedDict()
+        self._spend = {}  # doc id -> UserSpend del día
+        self._dirty = set()
+        self._lock = asyncio.Lock()
+
+    async def _read(self, thread_id: str):
+        try:
+            return await asyncio.to_thread(self.backend.get, thread_id)
+        except Exception as e:
+            logger.error("Could not load thread state %s: %s", thread_id, e)
+            return None
+
+    def _user_spend(self, user: str) -> UserSpend:
+        day = date.today().isoformat()
+        doc_id = UserSpend.doc_id(user, day)
+        spend = self._spend.get(doc_id)
+        if spend is None:
+            # Los días anteriores ya escritos se sueltan
+            for old_id in [i for i, s in self._spend.items() if s.day != day and i not in self._dirty]:
+                self._spend.pop(old_id)
+            spend = self._spend[doc_id] = UserSpend(user, day)
+            spend.loaded_at = float("-inf")  # aún sin leer del backend
+        return spend
+
+    async def load_user_spend(self, user: str) -> UserSpend:
+        """Gasto de hoy del usuario, releído del backend pasados `refresh` segundos (otras instancias suman)."""
+        spend = self._user_spend(user)
+        if time.monotonic() - spend.loaded_at > self.refresh:
+            data = await self._read(UserSpend.doc_id(user, spend.day))
+            spend.reload(data)
+        return spend
+
+    def user_spend(self, user: str) -> float:
+        spend = self._spend.get(UserSpend.doc_id(user, date.today().isoformat()))
+        return spend.cost_eur if spend else 0.0
+
+    def add_user_cost(self, user: str, cost: float):
+        spend = self._user_spend(user)
+        spend.add_cost(cost)
+        self._dirty.add(UserSpend.doc_id(user, spend.day))
+
+    async def load(self, thread_id: str, channel_id: str = None, user_id: str = None) -> ThreadState:
+        state = self._states.get(thread_id)
+        if state is None:
+            state = ThreadState(thread_id, channel_id, user_id, await self._read(thread_id))
+            self._states[thread_id] = state
+            self._evict()
+        else:
+            self._states.move_to_end(thread_id)
+            if time.monotonic() - state.loaded_at > self.refresh:
+                data = await self._read(thread_id)
+                if data is not None:
+                    state.reload(data)
+        return state
+
+    def _evict(self):
+        """Se sueltan los hilos menos usados que no tienen cambios sin escribir."""
+        for thread_id in list(self._states):
+            if len(self._states) <= self.max_threads:
+                break
+            state = self._states[thread_id]
+            if thread_id not in self._dirty and not state.pending:
+                self._states.pop(thread_id)
+
+    def mark_dirty(self, state: ThreadState):
+        self._dirty.add(state.thread_id)
+
+    async def flush(self):
+        """Escribe en un solo batch todos los hilos (y gastos de usuario) modificados desde el último flush."""
+        async with self._lock:
+            if not self._dirty:
+                return
+            states = {tid: self._states.get(tid) or self._spend.get(tid) for tid in self._dirty}
+            states = {tid: state for tid, state in states.items() if state is not None}
+            changes = {tid: state.changes() for tid, state in states.items()}
+            self._dirty.clear()
+            try:
+                await asyncio.to_thread(self.backend.write_batch, changes)
+                logger.debug("Thread state flushed: %s threads", len(changes))
+            except Exception as e:
+                logger.error("Could not flush thread state: %s", e)
+                for tid, change in changes.items():
+                    states[tid].restore(change)
+                self._dirty.update(changes)
+
+    async def cleanup_expired(self):
+        """Borra los hilos caducados y los ficheros que subieron a Anthropic."""
+        now = datetime.now(timezone.utc)
+        expired = await asyncio.to_thread(self.backend.expired, now)
+        for thread_id, data in expired:
+            # file_ids acumula todos los ficheros subidos al hilo, también los de otras instancias
+            for file_id in set(data.get("file_ids") or []) | set((data.get("datasets") or {}).values()):
+                try:
+                    await get_claude().beta.files.delete(file_id)
+                except Exception as e:
+                    logger.error(f"Could not delete file: {e}")
+            self._states.pop(thread_id, None)
+        if expired:
+            await asyncio.to_thread(self.backend.delete, [thread_id for thread_id, _ in expired])
+            logger.info("🧹 Expired threads cleaned: %s", len(expired))
+        # Los hilos en memoria caducados también se sueltan
+        for thread_id in [tid for tid, s in self._states.items() if s.expireAt < now and tid not in self._dirty]:
+            self._states.pop(thread_id, None)
+
+
+def build_store(backend_name: str = THREAD_STATE_BACKEND) -> ThreadStateStore:
+    if backend_name == "firestore":
+        return ThreadStateStore(FirestoreThreadBackend(get_db))
+    return ThreadStateStore(MemoryThreadBackend())
+
+
+thread_store = build_store()
+
+
+def current_thread_state():
+    return _current.get()
+
+
+def current_user():
+    return _current_user.get()
+
+
+def set_current_thread_state(state, user: str = None):
+    return _current.set(state), _current_user.set(user)
+
+
+def reset_current_thread_state(token):
+    state_token, user_token = token
+    _current.reset(state_token)
+    _current_user.reset(user_token)
+
+
+async def cleanup_loop(interval: float = 3600):
+    while True:
+        try:
+            await thread_store.flush()
+            await thread_store.cleanup_expired()
+        except Exception as e:
+            logger.error("Thread cleanup failed: %s", e)
+        await asyncio.sleep(interval)
@@ -98,3 +98,29 @@ def format_for_slack(text: str) -> str:
     # Limpieza final
     text = re.sub(r"\n{3,}", "\n\n", text)
     return text.strip()
+
+
+class IncrementalSlackFormatter:
+    """
+    format_for_slack para texto que llega en streaming: los párrafos cerrados (separados por línea en blanco)
+    se formatean una sola vez y solo se reformatea el párrafo en curso.
+    """
+    def __init__(self):
+        self.raw = ""
+        self._done = 0
+        self._formatted = []
+
+    def feed(self, delta: str) -> str:
+        self.raw += delta
+        boundary = self.raw.rfind("\n\n", self._done)
+        if boundary != -1:
+            for paragraph in re.split(r"\n{2,}", self.raw[self._done:boundary]):
+                formatted = format_for_slack(paragraph)
+                if formatted:
+                    self._formatted.append(formatted)
+            self._done = boundary + 2
+        return self.text()
+
+    def text(self) -> str:
+        tail = format_for_slack(self.raw[self._done:])
+        return "\n\n".join(self._formatted + ([tail] if tail else []))
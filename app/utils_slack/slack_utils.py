@@ -1,50 +1,65 @@
 import os
-import time
-import requests
-from datetime import datetime
-from slack_sdk import WebClient
+import asyncio
+import aiohttp
 from slack_sdk.errors import SlackApiError
 from app import logger
-from app import claude
+from app.utils_slack.format_utils import IncrementalSlackFormatter
+from app.utils_slack.transport import SlackTransport
+from app.utils_slack.thread_history import thread_history
+from app.metrics import timed
 
 SLACK_BOT_TOKEN = os.environ.get("SLACK_BOT_TOKEN")
-client = WebClient(token=SLACK_BOT_TOKEN)
+SLACK_UPDATE_INTERVAL = 1.5  # segundos entre chat.update del mismo mensaje (tier 3 ≈ 50/min)
+transport = SlackTransport(token=SLACK_BOT_TOKEN)
 
 
-def uploadFiles (response, filename) -> str:
-    file_bytes = response.read()
-    size = len(file_bytes)
-    response2 = client.files_getUploadURLExternal(
+async def uploadFiles (content, filename, size: int) -> str:
+    """
+    Sube un fichero a Slack. `content` puede ser bytes o un iterador asíncrono de chunks (se envía en streaming).
+    """
+    response2 = await transport.call(
+            "files_getUploadURLExternal",
             length=size,
             filename=filename
         )
     upload_url = response2["upload_url"]
     file_id = response2["file_id"]
 
-    upload_response = requests.post(
+    upload_response = await transport.post_bytes(
         upload_url,
-        headers={"Content-Type": "application/octet-stream"}, 
-        data=file_bytes
+        headers={"Content-Type": "application/octet-stream", "Content-Length": str(size)}, 
+        content=content
     )
     if upload_response.status_code != 200:
         print("Error uploading file:", upload_response.text)
     return file_id
 
 
-def completeUpload (channel: str, thread_ts: str, file_ids : list, text) -> str:
-        response = client.files_completeUploadExternal(
+async def completeUpload (channel: str, thread_ts: str, file_ids : list, text) -> str:
+        response = await transport.call(
+            "files_completeUploadExternal",
             files=file_ids,
             channel_id=channel,
             thread_ts=thread_ts,
             initial_comment=text
         )
         logger.debug(response)
+        # El mensaje con los ficheros no devuelve su ts: el hilo se relee de Slack en la próxima pregunta
+        thread_history.invalidate(channel, thread_ts)
 
 
-def get_thread_history(channel_id, thread_ts):
-
+@timed("get_thread_history")
+async def get_thread_history(channel_id, thread_ts):
+    """
+    Historial del hilo (primeros 8 mensajes, una línea "[fecha] texto" por mensaje). Sale de la cache
+    que alimentan los eventos y las respuestas del bot; conversations_replies solo en un fallo en frío.
+    """
+    cached = thread_history.get(channel_id, thread_ts)
+    if cached is not None:
+        return cached
     try:
-        response = client.conversations_replies(
+        response = await transport.call(
+            "conversations_replies",
             channel=channel_id,
             ts=thread_ts,
             limit=8
@@ -55,61 +70,58 @@ def get_thread_history(channel_id, thread_ts):
             return ""
 
         messages = response.get("messages", [])
-        if not messages:
-            return ""
-
-        formatted_messages = []
-        for msg in messages:
-            ts = msg.get("ts", "")
-            text = msg.get("text", "")
-            try:
-                ts_readable = datetime.fromtimestamp(float(ts)).strftime("%Y-%m-%d %H:%M:%S")
-            except Exception:
-                ts_readable = ts
-            formatted_messages.append(f"    [{ts_readable}] {text}")
-
-        return "\n".join(formatted_messages)
+        return thread_history.fill(channel_id, thread_ts, messages)
 
     except SlackApiError as e:
         logger.error(f"Slack API error: {e.response['error']}")
         return ""
 
 
-def send_message(channel, text, thread_ts=None):
+async def send_message(channel, text, thread_ts=None):
     """
     Envía un mensaje a Slack (en canal o dentro de un hilo)
     """
     try:
-        response = client.chat_postMessage(
+        response = await transport.call(
+            "chat_postMessage",
             channel=channel,
             text=text,
             thread_ts=thread_ts
         )
         logger.info(f"✅ Mensaje enviado a {channel}: {response['ts']}")
+        thread_history.add(channel, thread_ts, response["ts"], text, new_thread=not thread_ts)
         return response["ts"]
 
     except SlackApiError as e:
         logger.error(f"❌ Error al enviar mensaje: {e.response['error']}")
         return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"❌ Error de red al enviar mensaje: {e}")
+        return None
 
-def update_message(channel: str, ts: str, new_text: str):
+async def update_message(channel: str, ts: str, new_text: str):
     try:
-        response = client.chat_update(
+        response = await transport.chat_update(
             channel=channel,
             ts=ts,
             text=new_text
         )
         logger.info(f"✅ Mensaje actualizado en {channel}: {ts}")
+        thread_history.update(channel, ts, new_text)
         return response.data
 
     except SlackApiError as e:
         error_msg = e.response.get("error", "unknown_error")
         logger.error(f"❌ Error al actualizar mensaje: {error_msg}")
         return None
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"❌ Error de red al actualizar mensaje: {e}")
+        return None
     
-def add_reaction(channel: str, ts: str, threadts:str, emoji: str):
+async def add_reaction(channel: str, ts: str, threadts:str, emoji: str):
     try:
-        response = client.reactions_add(
+        response = await transport.call(
+            "reactions_add",
             channel=channel,
             name=emoji,
             thread_ts = threadts,
@@ -126,12 +138,72 @@ def add_reaction(channel: str, ts: str, threadts:str, emoji: str):
             logger.error(f"❌ Error al añadir reacción: {error_msg}")
         return None
     
-def send_thinking_messages(channel, user, threadts, stop_event):
+async def send_thinking_messages(channel, user, threadts, stop_event):
     i = 0
     while not stop_event.is_set():
         try:
-            client.chat_postEphemeral(channel=channel, user=user, thread_ts=threadts, text="Thinking...")
+            await transport.call("chat_postEphemeral", channel=channel, user=user, thread_ts=threadts, text="Thinking...")
         except SlackApiError as e:
             print(f"⚠️ Slack ephemeral error: {e.response.get('error', 'unknown')}")
         i += 1
-        time.sleep(5)  # cada 5 segundos
\ No newline at end of file
+        await asyncio.sleep(5)  # cada 5 segundos
+
+
+class MessageUpdateCoalescer:
+    """
+    Agrupa actualizaciones progresivas de un mensaje: como mucho un chat.update cada `min_interval`
+    segundos y siempre con el último texto recibido.
+    """
+    def __init__(self, channel: str, ts: str, min_interval: float = SLACK_UPDATE_INTERVAL, suffix: str = " ⏳"):
+        self.channel = channel
+        self.ts = ts
+        self.min_interval = min_interval
+        self.suffix = suffix
+        self.updates = 0
+        self._latest = None
+        self._sent = None
+        self._last_sent_at = 0.0
+        self._pending = None
+
+    def push(self, text: str):
+        self._latest = text
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0.0, self._last_sent_at + self.min_interval - loop.time()))
+        text = self._latest
+        if text and text != self._sent:
+            self._last_sent_at = loop.time()
+            self._sent = text
+            self.updates += 1
+            await update_message(self.channel, self.ts, text + self.suffix)
+
+    async def close(self):
+        """Cancela la actualización pendiente para que no llegue después de la respuesta final."""
+        if self._pending is not None and not self._pending.done():
+            self._pending.cancel()
+            try:
+                await self._pending
+            except asyncio.CancelledError:
+                pass
+        logger.debug("Progressive updates sent for %s: %s", self.ts, self.updates)
+
+
+class ProgressiveMessage:
+    """
+    Muestra en Slack la respuesta del LLM mientras llega: formatea los deltas de texto y los envía por el coalescer.
+    """
+    def __init__(self, channel: str, ts: str):
+        self.coalescer = MessageUpdateCoalescer(channel, ts)
+        self.formatter = IncrementalSlackFormatter()
+
+    def on_text(self, delta: str, snapshot: str):
+        if len(snapshot) == len(delta):
+            # Nuevo bloque de texto (code execution intercala texto y llamadas a herramientas)
+            self.formatter = IncrementalSlackFormatter()
+        self.coalescer.push(self.formatter.feed(delta))
+
+    async def close(self):
+        await self.coalescer.close()
@@ -0,0 +1,129 @@
+import time
+from collections import OrderedDict
+from datetime import datetime
+from app import logger, THREAD_HISTORY_TTL, THREAD_HISTORY_MAX_THREADS
+
+HISTORY_LIMIT = 8  # mensajes que devolvía conversations_replies (limit=8): los primeros del hilo
+
+
+def format_line(ts: str, text: str) -> str:
+    try:
+        ts_readable = datetime.fromtimestamp(float(ts)).strftime("%Y-%m-%d %H:%M:%S")
+    except Exception:
+        ts_readable = ts
+    return f"    [{ts_readable}] {text}"
+
+
+class ThreadHistory:
+    """Mensajes de un hilo por ts, con la línea ya formateada para el prompt."""
+    def __init__(self):
+        self.lines = {}  # ts -> línea formateada
+        self.complete = False
+        self.verified_at = 0.0
+
+    def put(self, ts: str, text: str):
+        self.lines[ts] = format_line(ts, text)
+
+    def render(self) -> str:
+        first = sorted(self.lines, key=float)[:HISTORY_LIMIT]
+        return "\n".join(self.lines[ts] for ts in first)
+
+
+class ThreadHistoryCache:
+    """
+    Historial de hilos en memoria alimentado por los eventos que ya llegan (mensajes, ediciones, borrados)
+    y por lo que publica el bot. Solo se llama a conversations_replies la primera vez que se ve un hilo
+    que no empezó aquí, o cuando caduca la TTL (otra instancia pudo contestar en el mismo hilo).
+    """
+    def __init__(self, ttl: int = THREAD_HISTORY_TTL, max_threads: int = THREAD_HISTORY_MAX_THREADS):
+        self.ttl = ttl
+        self.max_threads = max_threads
+        self._threads = OrderedDict()  # (channel, thread_ts) -> ThreadHistory
+        self._by_ts = {}  # (channel, ts) -> thread_ts
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "messages": 0, "updates": 0, "evictions": 0}
+
+    def _entry(self, channel: str, thread_ts: str, create: bool = True):
+        key = (channel, thread_ts)
+        entry = self._threads.get(key)
+        if entry is None and create:
+            entry = self._threads[key] = ThreadHistory()
+            while len(self._threads) > self.max_threads:
+                (old_channel, _), evicted = self._threads.popitem(last=False)
+                for ts in evicted.lines:
+                    self._by_ts.pop((old_channel, ts), None)
+                self.stats["evictions"] += 1
+        elif entry is not None:
+            self._threads.move_to_end(key)
+        return entry
+
+    def add(self, channel: str, thread_ts: str, ts: str, text: str, new_thread: bool = False):
+        """Mensaje nuevo. Si abre el hilo, el historial está completo sin preguntar a Slack."""
+        if not self.ttl or not channel or not ts:
+            return
+        entry = self._entry(channel, thread_ts or ts)
+        if new_thread and not entry.lines:
+            entry.complete, entry.verified_at = True, time.monotonic()
+        entry.put(ts, text or "")
+        self._by_ts[(channel, ts)] = thread_ts or ts
+        self.stats["messages"] += 1
+
+    def update(self, channel: str, ts: str, text: str):
+        thread_ts = self._by_ts.get((channel, ts))
+        entry = self._threads.get((channel, thread_ts)) if thread_ts else None
+        if entry is not None and ts in entry.lines:
+            entry.put(ts, text or "")
+            self.stats["updates"] += 1
+
+    def remove(self, channel: str, ts: str):
+        thread_ts = self._by_ts.pop((channel, ts), None)
+        entry = self._threads.get((channel, thread_ts)) if thread_ts else None
+        if entry is not None:
+            entry.lines.pop(ts, None)
+
+    def invalidate(self, channel: str, thread_ts: str):
+        """Algo se publicó en el hilo sin que sepamos su ts (p.ej. ficheros): la próxima vez se relee de Slack."""
+        entry = self._threads.get((channel, thread_ts))
+        if entry is not None:
+            entry.complete = False
+
+    def observe(self, event: dict):
+        """Aplica un evento de mensaje de Slack (nuevo, editado o borrado), sea de un usuario o de un bot."""
+        if event.get("type") != "message":
+            return
+        channel, subtype = event.get("channel"), event.get("subtype")
+        if subtype == "message_changed":
+            message = event.get("message", {})
+            self.update(channel, message.get("ts"), message.get("text"))
+        elif subtype == "message_deleted":
+            self.remove(channel, event.get("deleted_ts"))
+        elif event.get("ts"):
+            self.add(channel, event.get("thread_ts"), event["ts"], event.get("text"), new_thread=not event.get("thread_ts"))
+
+    def get(self, channel: str, thread_ts: str):
+        """Historial formateado o None si hay que leerlo de Slack."""
+        entry = self._entry(channel, thread_ts, create=False) if self.ttl else None
+        if entry is None or not entry.complete:
+            self.stats["misses"] += 1
+            return None
+        if time.monotonic() - entry.verified_at > self.ttl:
+            self.stats["expired"] += 1
+            return None
+        self.stats["hits"] += 1
+        return entry.render()
+
+    def fill(self, channel: str, thread_ts: str, messages: list) -> str:
+        """Mezcla lo leído con conversations_replies con lo que ya se había visto del hilo."""
+        entry = self._entry(channel, thread_ts) if self.ttl else ThreadHistory()
+        for msg in messages:
+            if msg.get("ts"):
+                entry.put(msg["ts"], msg.get("text", ""))
+        if not self.ttl:
+            return entry.render()
+        for ts in entry.lines:
+            self._by_ts[(channel, ts)] = thread_ts
+        entry.complete, entry.verified_at = True, time.monotonic()
+        logger.debug("🧵 Thread history cached: %s (%s messages)", thread_ts, len(entry.lines))
+        return entry.render()
+
+
+thread_history = ThreadHistoryCache()
@@ -0,0 +1,185 @@
+import asyncio
+import random
+import time
+from collections import defaultdict
+import aiohttp
+import httpx
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from app import logger
+from app.metrics import span
+
+# Peticiones por segundo y ráfaga por método (tiers de https://docs.slack.dev/apis/web-api/rate-limits)
+METHOD_LIMITS = {
+    "chat_postMessage": (1.0, 3),
+    "chat_update": (50 / 60, 5),
+    "chat_postEphemeral": (100 / 60, 10),
+    "conversations_replies": (50 / 60, 5),
+    "reactions_add": (50 / 60, 5),
+    "files_getUploadURLExternal": (100 / 60, 10),
+    "files_completeUploadExternal": (100 / 60, 10),
+}
+DEFAULT_LIMIT = (20 / 60, 3)
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+MAX_BACKOFF = 30.0
+
+
+class UpdateAbandoned(Exception):
+    """El chat_update que llevaba los textos agrupados se canceló antes de enviarse."""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Espera hasta tener un token (en orden de llegada). Devuelve los segundos esperados."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+    def penalize(self, seconds: float):
+        # Tras un 429 nadie más debe llamar al método hasta que pase el Retry-After
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = time.monotonic()
+
+
+class SlackTransport:
+    """
+    Cliente Slack compartido: sesión HTTP reutilizada, token bucket por método, reintentos con backoff
+    respetando Retry-After y colapso de chat_update pendientes sobre el mismo ts.
+    """
+    def __init__(self, token: str):
+        self.token = token
+        self._client = None
+        self._session = None
+        self._http = None
+        self._buckets = {}
+        self._pending_updates = {}
+        self.stats = defaultdict(lambda: defaultdict(float))
+
+    @property
+    def client(self) -> AsyncWebClient:
+        if self._client is None:
+            # La sesión aiohttp tiene que crearse dentro del event loop
+            connector = aiohttp.TCPConnector(limit=50, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._client = AsyncWebClient(token=self.token, session=self._session)
+        return self._client
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+        return self._http
+
+    def _bucket(self, method: str) -> TokenBucket:
+        if method not in self._buckets:
+            self._buckets[method] = TokenBucket(*METHOD_LIMITS.get(method, DEFAULT_LIMIT))
+        return self._buckets[method]
+
+    async def call(self, method: str, _acquired: bool = False, **kwargs):
+        bucket = self._bucket(method)
+        stats = self.stats[method]
+        for attempt in range(MAX_RETRIES + 1):
+            if not _acquired or attempt > 0:
+                stats["wait_seconds"] += await bucket.acquire()
+            stats["calls"] += 1
+            started = time.monotonic()
+            try:
+                with span(f"slack.{method}"):
+                    response = await getattr(self.client, method)(**kwargs)
+                stats["latency_seconds"] += time.monotonic() - started
+                return response
+            except SlackApiError as e:
+                status = e.response.status_code
+                if status == 429:
+                    delay = float(e.response.headers.get("Retry-After", e.response.headers.get("retry-after", 1)))
+                    bucket.penalize(delay)
+                    stats["rate_limited"] += 1
+                elif status >= 500:
+                    delay = min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt)
+                else:
+                    stats["errors"] += 1
+                    raise
+                last_error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt)
+                last_error = e
+            if attempt == MAX_RETRIES:
+                break
+            stats["retries"] += 1
+            logger.warning("Slack %s failed (%s), retry %s in %.1fs", method, last_error, attempt + 1, delay)
+            await asyncio.sleep(delay + random.uniform(0, 0.25))
+        stats["errors"] += 1
+        raise last_error
+
+    async def chat_update(self, channel: str, ts: str, text: str, **kwargs):
+        """
+        Si ya hay un update del mismo mensaje esperando turno, solo se sustituye su texto:
+        ambas llamadas reciben la misma respuesta y a Slack llega una única petición.
+        """
+        key = (channel, ts)
+        pending = self._pending_updates.get(key)
+        if pending is not None:
+            pending["kwargs"] = {**kwargs, "text": text}
+            self.stats["chat_update"]["collapsed"] += 1
+            try:
+                return await asyncio.shield(pending["future"])
+            except UpdateAbandoned:
+                # Quien iba a mandar nuestro texto se canceló antes de llegar a Slack: lo mandamos nosotros
+                return await self.chat_update(channel, ts, text, **kwargs)
+        future = asyncio.get_running_loop().create_future()
+        entry = {"kwargs": {**kwargs, "text": text}, "future": future}
+        self._pending_updates[key] = entry
+        try:
+            try:
+                self.stats["chat_update"]["wait_seconds"] += await self._bucket("chat_update").acquire()
+            finally:
+                self._pending_updates.pop(key, None)
+            response = await self.call("chat_update", _acquired=True, channel=channel, ts=ts, **entry["kwargs"])
+        except BaseException as e:
+            # La future se resuelve siempre: si no, los updates agrupados en ella esperarían para siempre
+            if not future.done():
+                future.set_exception(UpdateAbandoned() if isinstance(e, asyncio.CancelledError) else e)
+                future.exception()  # marcada como recuperada aunque nadie más espere
+            raise
+        future.set_result(response)
+        return response
+
+    async def post_bytes(self, url: str, content, headers: dict) -> httpx.Response:
+        stats = self.stats["upload"]
+        stats["calls"] += 1
+        started = time.monotonic()
+        with span("slack.upload"):
+            response = await self.http.post(url, headers=headers, content=content)
+        stats["latency_seconds"] += time.monotonic() - started
+        if response.status_code != 200:
+            stats["errors"] += 1
+        return response
+
+    async def close(self):
+        """Cierra la sesión aiohttp y el cliente httpx (al parar la app, con la cola ya drenada)."""
+        session, http = self._session, self._http
+        self._client, self._session, self._http = None, None, None
+        if session is not None and not session.closed:
+            await session.close()
+        if http is not None:
+            await http.aclose()
+
+    def metrics(self) -> dict:
+        return {method: dict(values) for method, values in self.stats.items()}
@@ -1,8 +1,13 @@
 from app import AUTHORIZED_USERS
 from app import logger
 
+# Subtipos que son un mensaje nuevo de un usuario; el resto (message_changed, message_deleted, bot_message,
+# channel_join...) solo alimentan el historial y no pasan por la deduplicación ni por la cola
+QUESTION_SUBTYPES = {None, "thread_broadcast", "file_share"}
+
 def is_valid_message_event(event: dict) -> bool:
-    return event.get("type") == "message" and not event.get("bot_id")
+    return (event.get("type") == "message" and not event.get("bot_id")
+            and event.get("subtype") in QUESTION_SUBTYPES and bool(event.get("text")))
 
 def is_authorized_user(user_id: str) -> bool:
     return user_id in AUTHORIZED_USERS
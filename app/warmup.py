@@ -0,0 +1,102 @@
+import asyncio
+import importlib
+import time
+from app import logger, STARTED_AT, DEDUP_BACKEND, THREAD_STATE_BACKEND, EXECUTION_MODE, get_claude, get_db
+from app.metrics import span
+
+startup = {}  # etapa -> segundos (gauge slackbot_startup_seconds)
+_pipeline = None
+_pipeline_lock = None
+
+
+async def load_pipeline():
+    """
+    Importa el pipeline de eventos (pandas, pyarrow, rapidfuzz, slack_sdk, SDKs de Google...) una sola vez
+    y fuera del event loop, para que el endpoint siga contestando mientras tanto.
+    """
+    global _pipeline, _pipeline_lock
+    if _pipeline is not None:
+        return _pipeline
+    if _pipeline_lock is None:
+        _pipeline_lock = asyncio.Lock()
+    async with _pipeline_lock:
+        if _pipeline is None:
+            started = time.perf_counter()
+            module = await asyncio.to_thread(importlib.import_module, "app.slack_events")
+            startup["pipeline_import"] = time.perf_counter() - started
+            logger.info("📦 Pipeline imported in %.0f ms", startup["pipeline_import"] * 1000)
+            _pipeline = module.handler
+    return _pipeline
+
+
+def record_ready():
+    startup["ready"] = time.perf_counter() - STARTED_AT
+    logger.info("🚀 App ready %.0f ms after import started", startup["ready"] * 1000)
+
+
+async def _warm_anthropic():
+    # Crear el cliente y hacer una llamada gratuita deja abierta la conexión TLS del pool
+    await get_claude().models.list(limit=1)
+
+
+async def _warm_slack():
+    from app.utils_slack.slack_utils import transport
+    await transport.call("auth_test")
+
+
+async def _warm_bigquery():
+    from app.bigQuery import SNAPSHOT_COLUMNS, latest_snapshot
+    await asyncio.gather(*(latest_snapshot(table) for table in SNAPSHOT_COLUMNS))
+
+
+async def _warm_firestore():
+    if "firestore" in (DEDUP_BACKEND, THREAD_STATE_BACKEND):
+        await asyncio.to_thread(get_db)
+
+
+async def _warm_customers():
+    from app.customer_index import get_customer_index
+    await get_customer_index()
+
+
+async def _warm_sandboxes():
+    if EXECUTION_MODE != "remote":
+        from app.local_executor import sandbox_pool
+        await sandbox_pool.prewarm()
+
+
+async def _warm_rollups():
+    from app.bigQuery import rollup_store
+    await rollup_store.prewarm()
+
+
+WARMUP_STEPS = {
+    "anthropic": _warm_anthropic,
+    "slack": _warm_slack,
+    "bigquery": _warm_bigquery,
+    "firestore": _warm_firestore,
+    "customer_index": _warm_customers,
+    "sandboxes": _warm_sandboxes,
+    "rollups": _warm_rollups,
+}
+
+
+async def _run_step(name: str, step):
+    started = time.perf_counter()
+    try:
+        with span(f"warmup.{name}"):
+            await step()
+        startup[f"warmup_{name}"] = time.perf_counter() - started
+    except Exception as e:
+        # El warm-up es best effort: si algo falla se creará en la primera petición
+        logger.warning("Warm-up %s failed: %s", name, e)
+
+
+async def warm_up():
+    """Tras arrancar: importa el pipeline y pre-abre clientes y conexiones en segundo plano."""
+    started = time.perf_counter()
+    await load_pipeline()
+    await asyncio.gather(*(_run_step(name, step) for name, step in WARMUP_STEPS.items()))
+    startup["warmup"] = time.perf_counter() - started
+    logger.info("🔥 Warm-up done in %.0f ms: %s", startup["warmup"] * 1000,
+                {name: round(seconds * 1000) for name, seconds in startup.items()})
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from app import logger, MAX_CONCURRENT_QUESTIONS, QUESTION_QUEUE_SIZE, ENQUEUE_TIMEOUT, SHUTDOWN_GRACE_SECONDS
+from app.warmup import load_pipeline
+from app.utils_slack.validators import is_valid_message_event, is_authorized_user
+
+INTERRUPTED_TEXT = "⚠️ I was restarted before I could answer this. Please send your question again."
+event_queue: asyncio.Queue | None = None
+worker_tasks: list = []
+in_flight = {}  # worker_id -> evento en proceso
+stopping = False
+
+
+async def worker(worker_id: int):
+    while True:
+        body = await event_queue.get()
+        in_flight[worker_id] = body
+        try:
+            handler = await load_pipeline()
+            await handler(body)
+        except Exception as e:
+            logger.exception("❌ Worker %s failed processing event %s: %s", worker_id, body.get("event_id"), e)
+        finally:
+            in_flight.pop(worker_id, None)
+            event_queue.task_done()
+
+
+def start_workers():
+    global event_queue
+    event_queue = asyncio.Queue(maxsize=QUESTION_QUEUE_SIZE)
+    for i in range(MAX_CONCURRENT_QUESTIONS):
+        worker_tasks.append(asyncio.create_task(worker(i)))
+    logger.info("Started %s workers (queue size %s)", MAX_CONCURRENT_QUESTIONS, QUESTION_QUEUE_SIZE)
+
+
+async def stop_workers(grace: float = SHUTDOWN_GRACE_SECONDS):
+    """
+    Drena la cola al parar (SIGTERM de Cloud Run): deja de aceptar eventos (503, Slack los reintenta en otra
+    instancia) y espera hasta `grace` segundos a que terminen las preguntas en curso y encoladas. Las que no
+    llegan se cancelan y se avisa en su hilo: Slack no reintenta eventos que ya recibieron 200.
+    """
+    global stopping
+    stopping = True
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(event_queue.join(), timeout=grace)
+        logger.info("Queue drained in %.1fs", time.monotonic() - started)
+    except asyncio.TimeoutError:
+        pass
+    interrupted = list(in_flight.values())
+    while not event_queue.empty():
+        interrupted.append(event_queue.get_nowait())
+        event_queue.task_done()
+    for task in worker_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, return_exceptions=True)
+    worker_tasks.clear()
+    if interrupted:
+        logger.warning("🛑 Shutdown after %.1fs: %s questions interrupted", time.monotonic() - started, len(interrupted))
+        await asyncio.gather(*(notify_interrupted(body) for body in interrupted), return_exceptions=True)
+
+
+async def notify_interrupted(body: dict):
+    event = body.get("event", {})
+    if not is_valid_message_event(event) or not is_authorized_user(event.get("user")):
+        return
+    from app.utils_slack.slack_utils import send_message
+    await send_message(event.get("channel"), INTERRUPTED_TEXT, event.get("thread_ts") or event.get("ts"))
+
+
+async def enqueue(body: dict) -> bool:
+    """
+    Encola el evento. Si la cola está llena espera hasta ENQUEUE_TIMEOUT y devuelve False (backpressure).
+    También devuelve False mientras se drena la cola al parar.
+    """
+    if stopping:
+        return False
+    try:
+        event_queue.put_nowait(body)
+        return True
+    except asyncio.QueueFull:
+        pass
+    try:
+        await asyncio.wait_for(event_queue.put(body), timeout=ENQUEUE_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def queue_stats() -> dict:
+    return {
+        "queued": event_queue.qsize() if event_queue else 0,
+        "maxsize": QUESTION_QUEUE_SIZE,
+        "workers": len(worker_tasks),
+        "in_flight": len(in_flight),
+    }